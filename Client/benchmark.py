@@ -0,0 +1,366 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import platform
+import statistics
+import sys
+import time
+from contextlib import contextmanager
+from multiprocessing import JoinableQueue, Process
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from main import generate_payloads
+from tracer.compositor import Compositor
+from tracer.framebuffer import FrameBuffer, TileUpdate
+from tracer.generators import random_field
+from tracer.objects import Payload, Scene, Sphere, SphereArray, TracerResult
+from tracer.scene import camera, get_scene, spheres
+from tracer.shared_context import ControlBlock, SharedContext
+
+# A case yields the function to time and the number of items it handles per call,
+# the timings are reported per item
+Case = Callable[..., Iterator[Tuple[Callable[[], object], int]]]
+
+CASES: Dict[str, Case] = {}
+
+RESOLUTIONS = {"1080p": (1920, 1080), "4k": (3840, 2160), "8k": (7680, 4320)}
+
+
+def case(name: str):
+    def register(f: Case) -> Case:
+        CASES[name] = f
+        return f
+
+    return register
+
+
+def make_result(
+    width: int, height: int, is_final: bool = False, x: int = 0, y: int = 0
+) -> TracerResult:
+    # Random samples in the layout of the worker, nothing is traced
+    rng = np.random.default_rng(0)
+    samples = rng.random((height, width, 3), np.float32)
+    return TracerResult(
+        b"".join(
+            [
+                TracerResult.HEADER.pack(x, y, width, height, 120, int(is_final)),
+                (samples * 255).astype(np.uint8).tobytes(),
+                samples.astype("<f4").tobytes(),
+                (b"" if is_final else b"0" * 36).ljust(36, b"\0"),
+            ]
+        )
+    )
+
+
+@case("tracer_result_parse")
+@contextmanager
+def tracer_result_parse(args):
+    raw = make_result(args.taskwidth, args.taskheight).raw
+    yield lambda: TracerResult(raw), 1
+
+
+@case("pixels_to_numpy_array")
+@contextmanager
+def pixels_to_numpy_array(args):
+    result = make_result(args.taskwidth, args.taskheight)
+    # The flip alone is a view, the copy is what the display paid for
+    yield lambda: np.ascontiguousarray(result.pixels_to_numpy_array()), 1
+
+
+@case("sphere_to_bytes")
+@contextmanager
+def sphere_to_bytes(args):
+    sphere: Sphere = spheres[0]
+    yield sphere.to_bytes, 1
+
+
+@case("scene_to_bytes_default")
+@contextmanager
+def scene_to_bytes_default(args):
+    scene = get_scene(1920, 1080, 7, 1)
+    yield scene.to_bytes, 1
+
+
+@case("scene_to_bytes_100k")
+@contextmanager
+def scene_to_bytes_100k(args):
+    scene = Scene(1920, 1080, 7, 1, camera, random_field(100000, 0))
+    yield scene.to_bytes, 1
+
+
+@case("sphere_array_from_spheres")
+@contextmanager
+def sphere_array_from_spheres(args):
+    yield lambda: SphereArray.from_spheres(spheres), len(spheres)
+
+
+def payloads_case(resolution: str) -> Case:
+    @contextmanager
+    def generate(args):
+        width, height = RESOLUTIONS[resolution]
+
+        def run():
+            # generate_payloads reports what it does, the output is not timed
+            with contextlib.redirect_stdout(io.StringIO()):
+                return generate_payloads(
+                    width, height, args.taskwidth, args.taskheight, 120
+                )
+
+        n_tiles = len(run())
+        yield run, n_tiles
+
+    return generate
+
+
+case("generate_payloads_4k")(payloads_case("4k"))
+case("generate_payloads_8k")(payloads_case("8k"))
+
+
+@case("payload_to_bytes")
+@contextmanager
+def payload_to_bytes(args):
+    payload = Payload(0, 0, args.taskwidth, args.taskheight, 120)
+    yield payload.to_bytes, 1
+
+
+@case("framebuffer_write")
+@contextmanager
+def framebuffer_write(args):
+    width, height = RESOLUTIONS["1080p"]
+    with FrameBuffer(height, width) as framebuffer:
+        result = make_result(args.taskwidth, args.taskheight)
+        yield lambda: framebuffer.write(result), 1
+
+
+@case("compositor_blit")
+@contextmanager
+def compositor_blit(args):
+    # What the display does for each update: tone mapping and outline of one tile
+    width, height = RESOLUTIONS["1080p"]
+    with FrameBuffer(height, width) as framebuffer:
+        compositor = Compositor(framebuffer)
+        update = framebuffer.write(make_result(args.taskwidth, args.taskheight))
+
+        def blit():
+            compositor.push(update)
+            compositor.compose()
+
+        yield blit, 1
+
+
+@case("compositor_refresh_1080p")
+@contextmanager
+def compositor_refresh(args):
+    width, height = RESOLUTIONS["1080p"]
+    with FrameBuffer(height, width) as framebuffer:
+        compositor = Compositor(framebuffer)
+        yield compositor.refresh, 1
+
+
+@case("context_flag_read")
+@contextmanager
+def context_flag_read(args):
+    # What the loops of the watcher, retriever and display check on each iteration
+    ctx = SharedContext(ControlBlock("localhost:5001"))
+    ctx.session_id = "00000000-0000-0000-0000-000000000000"
+    yield lambda: (bool(ctx.stop_watching_flag), ctx.session_id), 1
+
+
+def consume(queue) -> None:
+    while True:
+        item = queue.get()
+        queue.task_done()
+        if item is None:
+            break
+
+
+def queue_case(make_item: Callable[[argparse.Namespace], object]) -> Case:
+    @contextmanager
+    def transfer(args):
+        # Round trip through another process, the producer waits until the
+        # consumer took every item of the batch
+        queue = JoinableQueue()
+        consumer = Process(target=consume, args=(queue,))
+        consumer.start()
+        item = make_item(args)
+
+        def run():
+            for _ in range(args.batch):
+                queue.put(item)
+            queue.join()
+
+        try:
+            yield run, args.batch
+        finally:
+            queue.put(None)
+            consumer.join()
+
+    return transfer
+
+
+case("queue_transfer_result")(
+    queue_case(lambda args: make_result(args.taskwidth, args.taskheight))
+)
+case("queue_transfer_update")(
+    queue_case(lambda args: TileUpdate(0, 0, args.taskwidth, args.taskheight, 120, 0))
+)
+
+
+def measure(
+    run: Callable[[], object], items: int, min_time: float, repeat: int
+) -> Dict[str, float]:
+    # Calls per repeat are doubled until a repeat lasts min_time, the calibration
+    # doubles as warm up and is not reported
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            run()
+        if time.perf_counter() - start >= min_time:
+            break
+        loops *= 2
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(loops):
+            run()
+        timings.append(time.perf_counter() - start)
+    per_item = [t / (loops * items) for t in timings]
+    return {
+        "min": min(per_item),
+        "median": statistics.median(per_item),
+        "mean": statistics.mean(per_item),
+        "stdev": statistics.stdev(per_item) if len(per_item) > 1 else 0.0,
+        "loops": loops,
+        "items": items,
+        "repeat": repeat,
+    }
+
+
+def run_cases(args) -> Dict[str, Dict[str, float]]:
+    results = {}
+    for name, f in CASES.items():
+        if args.filter and not any(pattern in name for pattern in args.filter):
+            continue
+        with f(args) as (run, items):
+            results[name] = measure(run, items, args.min_time, args.repeat)
+        print(
+            f"{name:<28} median {format_time(results[name]['median'])}"
+            f"  min {format_time(results[name]['min'])}",
+            file=sys.stderr,
+        )
+    return results
+
+
+def format_time(seconds: float) -> str:
+    for unit, scale in (("s", 1.0), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:8.3f} {unit:<2}"
+    return f"{seconds / 1e-9:8.1f} ns"
+
+
+def compare(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    tolerance: float,
+) -> List[str]:
+    # Medians are compared, a case is a regression when it got slower by more than
+    # the tolerance. Returns the names of the regressions
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<28} not in baseline", file=sys.stderr)
+            continue
+        ratio = result["median"] / baseline[name]["median"]
+        status = ""
+        if ratio > 1 + tolerance:
+            status = "REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 - tolerance:
+            status = "improvement"
+        print(
+            f"{name:<28} {format_time(baseline[name]['median'])} -> "
+            f"{format_time(result['median'])}  x{ratio:6.3f}  {status}",
+            file=sys.stderr,
+        )
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of the client hot paths, results are written as JSON"
+    )
+    parser.add_argument(
+        "--filter",
+        help="only run the cases whose name contains one of these",
+        nargs="*",
+        default=None,
+    )
+    parser.add_argument("--list", help="list the cases and exit", action="store_true")
+    parser.add_argument(
+        "--output", help="JSON file for the results, stdout if not set", default=None
+    )
+    parser.add_argument("--baseline", help="JSON results to compare with", default=None)
+    parser.add_argument(
+        "--tolerance",
+        help="slowdown of the median over the baseline reported as a regression",
+        default=0.1,
+        type=float,
+    )
+    parser.add_argument(
+        "--repeat", help="number of timed repeats per case", default=7, type=int
+    )
+    parser.add_argument(
+        "--min_time", help="minimum duration of a repeat (s)", default=0.2, type=float
+    )
+    parser.add_argument(
+        "--batch", help="items per batch of the queue cases", default=256, type=int
+    )
+    parser.add_argument(
+        "--taskheight", help="height of a task in pixels", default=60, type=int
+    )
+    parser.add_argument(
+        "--taskwidth", help="width of a task in pixels", default=60, type=int
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.list:
+        print("\n".join(CASES))
+        return
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": multiprocessing.cpu_count(),
+            "taskwidth": args.taskwidth,
+            "taskheight": args.taskheight,
+            "time": time.time(),
+        },
+        "results": run_cases(args),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report["results"], baseline["results"], args.tolerance)
+        if regressions:
+            print(f"Regressions : {', '.join(regressions)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
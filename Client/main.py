@@ -1,27 +1,32 @@
 import argparse
-import copy
+import atexit
 import math
 import multiprocessing
 import time
-from datetime import timedelta
-from multiprocessing import Process, JoinableQueue
+from multiprocessing import Process
 from queue import Empty
-from typing import Optional, Tuple
+from typing import Dict, List, Optional, cast
 from select import select
 import sys
+import tempfile
 
-from armonik.client.results import ArmoniKResults
-from armonik.client.sessions import ArmoniKSessions
-from armonik.client.tasks import ArmoniKTasks
-from armonik.common.objects import TaskOptions, TaskDefinition
-from grpc import insecure_channel
-
+from tracer.adaptive import AdaptiveScheduler, tile_key
+from tracer.backend import Backend, create_backend, ensure_process, ensure_thread
+from tracer.convergence import ConvergenceController
+from tracer.cost_model import DEFAULT_COST_DIR, CostModel
+from tracer.deadline import DeadlinePlanner
 from tracer.display import start_display
-from tracer.objects import Scene, Payload
-from tracer.retriever import start_retriever
-from tracer.scene import get_scene
-from tracer.shared_context import SharedContext
-from tracer.watcher import start_watcher
+from tracer.framebuffer import FrameBuffer, TileUpdate
+from tracer.headless import start_headless
+from tracer.image_io import save_image
+from tracer.journal import Journal, JournalState
+from tracer.metrics import MetricsCollector, MetricsRecorder
+from tracer.objects import Payload, TracerResult
+from tracer.scene_file import load_scene
+from tracer.shared_context import ControlBlock, SharedContext
+from tracer.tile_cache import TileCache
+from tracer.trace_events import TraceRecorder, merge_traces, span
+from tracer.tonemap import TONE_MAPPING_OPERATORS, ToneMapper
 
 import logging
 
@@ -30,7 +35,50 @@ logging.basicConfig(level=logging.INFO)
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Client for PiTracer")
-    parser.add_argument("--server_url", help="server url", required=True)
+    parser.add_argument(
+        "--backend",
+        help="where to render the tiles",
+        choices=["armonik", "local"],
+        default="armonik",
+    )
+    parser.add_argument("--server_url", help="server url")
+    parser.add_argument(
+        "--runtime",
+        help="processes: watcher, retriever and display in processes of their own, "
+        "async: a single process with one event loop and the display on a thread",
+        choices=["processes", "async"],
+        default="processes",
+    )
+    parser.add_argument(
+        "--fake_server",
+        help="Start a local stand-in for ArmoniK rendering the tiles with this renderer",
+        choices=["stub", "engine"],
+        default=None,
+    )
+    parser.add_argument(
+        "--fake_workers",
+        help="number of tasks executed at once by --fake_server",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--fake_latency",
+        help="time added to each task of --fake_server (s)",
+        default=0.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--fake_failure_rate",
+        help="probability of a task of --fake_server to fail",
+        default=0.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--local_workers",
+        help="number of processes of the local backend (defaults to all cores)",
+        default=None,
+        type=int,
+    )
     parser.add_argument("--height", help="height of image", default=1080, type=int)
     parser.add_argument("--width", help="width of image", default=1920, type=int)
     parser.add_argument(
@@ -39,6 +87,11 @@ def parse_args():
     parser.add_argument(
         "--error_threshold", help="error threshold", default=5, type=float
     )
+    parser.add_argument(
+        "--scene",
+        help="scene file (.json, .toml or binary) or generator (random_field:count=1000,seed=0 or grid:size=10,seed=0), the default scene otherwise",
+        default=None,
+    )
     parser.add_argument("--killdepth", help="ray kill depth", default=7, type=int)
     parser.add_argument("--splitdepth", help="ray split depth", default=1, type=int)
     parser.add_argument(
@@ -48,105 +101,156 @@ def parse_args():
         "--taskwidth", help="width of a task in pixels", default=60, type=int
     )
     parser.add_argument(
-        "--use_polling", help="Use polling to watch results", default=True, type=bool
+        "--use_polling",
+        help="Poll the results instead of subscribing to their events",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--download_concurrency",
+        help="number of results downloaded in parallel",
+        default=8,
+        type=int,
+    )
+    parser.add_argument(
+        "--submit_chunk_size",
+        help="number of tasks created and submitted together",
+        default=64,
+        type=int,
+    )
+    parser.add_argument(
+        "--submit_concurrency",
+        help="number of task chunks being submitted at the same time",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--adaptive",
+        help="Refine tiles from the client, splitting the noisy ones and merging the calm ones",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--min_tile_size",
+        help="smallest tile size in pixels when splitting tiles with --adaptive",
+        default=8,
+        type=int,
+    )
+    parser.add_argument(
+        "--deadline",
+        help="Render the best image possible in this many seconds: the client plans the samples of each pass from the measured throughput and stops at the deadline",
+        default=None,
+        type=float,
+    )
+    parser.add_argument(
+        "--quality_target",
+        help="stop refining once the mean error over the image (same scale as --error_threshold) is under this",
+        default=None,
+        type=float,
+    )
+    parser.add_argument(
+        "--sample_budget",
+        help="stop refining once the image got this many samples per pixel on average",
+        default=None,
+        type=float,
+    )
+    parser.add_argument(
+        "--cost_aware",
+        help="Submit the most expensive tiles first, using costs measured on previous runs of the scene",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cost_dir",
+        help="directory where the tile costs of each scene are kept",
+        default=DEFAULT_COST_DIR,
+    )
+    parser.add_argument(
+        "--headless",
+        help="Render without a window and exit once the image is done",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--output",
+        help="where to save the final image (.png, or .exr, .pfm, .npy for the linear samples)",
+        default=None,
+    )
+    parser.add_argument(
+        "--stream",
+        help="video (.mp4, .avi, .mkv) or image sequence (frames/%%05d.png) of the progressive frames with --headless",
+        default=None,
+    )
+    parser.add_argument(
+        "--stream_fps", help="frame rate of --stream", default=10.0, type=float
+    )
+    parser.add_argument(
+        "--exposure",
+        help="exposure correction in stops applied when tone mapping",
+        default=0.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--tone_map",
+        help="tone mapping operator",
+        choices=TONE_MAPPING_OPERATORS,
+        default="clamp",
+    )
+    parser.add_argument(
+        "--journal",
+        help="directory where the image and the state of the tiles are kept as they come",
+        default=None,
+    )
+    parser.add_argument(
+        "--resume",
+        help="Continue the render recorded in --journal, in its session if it is still running",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="directory of the tile cache, tiles rendered before are not sent again",
+        default=None,
+    )
+    parser.add_argument(
+        "--cache_size",
+        help="size of the tile cache in MB",
+        default=1024,
+        type=int,
+    )
+    parser.add_argument(
+        "--trace",
+        help="Chrome trace (JSON) of all the processes written on exit, for Perfetto",
+        default=None,
+    )
+    parser.add_argument(
+        "--metrics_port",
+        help="serve the tile latencies in the Prometheus format on this port",
+        default=None,
+        type=int,
+    )
+    parser.add_argument(
+        "--metrics_report",
+        help="JSON file where the tile latencies are written on exit",
+        default=None,
     )
 
     parser.add_argument(
         "--no_auto_rerun", help="Disable auto-rerun", action="store_true"
     )
-    return parser.parse_args()
-
-
-def create_context(
-    context: SharedContext,
-    server_url: str,
-    error_threshold: float,
-) -> None:
-    print("Creating context...")
-    with insecure_channel(server_url) as channel:
-        options = TaskOptions(
-            max_duration=timedelta(seconds=300),
-            priority=1,
-            max_retries=1,
-            options={"n_threads": str(4), "errorMetricThreshold": str(error_threshold)},
-        )
-        context.session_id = ArmoniKSessions(channel).create_session(options)
-        context.task_options = options
-
-
-def send_scene(context: SharedContext, scene: Scene) -> str:
-    print("Sending scene...")
-    with insecure_channel(context.server_url) as channel:
-        scene_id = (
-            ArmoniKResults(channel)
-            .create_results({"scene": scene.to_bytes()}, context.session_id)["scene"]
-            .result_id
-        )
-        d: dict = copy.deepcopy(context.task_options.options)
-        d["sceneId"] = scene_id
-        context.task_options = TaskOptions(
-            max_duration=timedelta(seconds=300),
-            priority=1,
-            max_retries=1,
-            options=d,
-        )
-        print("Scene sent")
-        return scene_id
-
-
-def send_payloads(context: SharedContext, payloads: list[Payload]) -> dict[str, str]:
-    print("Sending payloads...")
-    with insecure_channel(context.server_url) as channel:
-        return {
-            k: r.result_id
-            for k, r in ArmoniKResults(channel)
-            .create_results(
-                {f"{p.coord_x}_{p.coord_y}": p.to_bytes() for p in payloads},
-                context.session_id,
-                20,
-            )
-            .items()
-        }
-
-
-def create_results(context: SharedContext, payloads: list[Payload]) -> dict[str, str]:
-    print("Creating results...")
-    with insecure_channel(context.server_url) as channel:
-        return {
-            k: r.result_id
-            for k, r in ArmoniKResults(channel)
-            .create_results_metadata(
-                [f"{p.coord_x}_{p.coord_y}" for p in payloads],
-                context.session_id,
-                100,
-            )
-            .items()
-        }
-
-
-def create_task_definitions(
-    scene: str,
-    payloads: dict[str, str],
-    results: dict[str, str],
-) -> dict[str, TaskDefinition]:
-    print("Creating task definitions...")
-    return {
-        k: TaskDefinition(
-            payload_id=p,
-            payload=b"",
-            expected_output_ids=[results[k]],
-            data_dependencies=[scene],
-        )
-        for k, p in payloads.items()
-    }
-
-
-def send_tasks(context: SharedContext, tasks: list[TaskDefinition]) -> None:
-    print("Sending tasks...")
-    with insecure_channel(context.server_url) as channel:
-        ArmoniKTasks(channel).submit_tasks(
-            context.session_id, tasks, context.task_options
-        )
+    args = parser.parse_args()
+    if args.backend == "armonik" and not (args.server_url or args.fake_server):
+        parser.error("--server_url is required with the armonik backend")
+    if args.fake_server and args.backend != "armonik":
+        parser.error("--fake_server requires the armonik backend")
+    if args.runtime == "async" and args.backend != "armonik":
+        parser.error("--runtime async requires the armonik backend")
+    if args.stream and not args.headless:
+        parser.error("--stream requires --headless")
+    if args.resume and not args.journal:
+        parser.error("--resume requires --journal")
+    if args.deadline is not None and args.adaptive:
+        parser.error("--deadline can't be combined with --adaptive")
+    # Both modes send every pass from the client, the workers don't refine
+    args.client_refinement = args.adaptive or args.deadline is not None
+    if args.resume and args.client_refinement:
+        parser.error("--resume can't continue an --adaptive or --deadline render")
+    return args
 
 
 def dist_from_center(center_x: int, center_y: int, payload: Payload) -> float:
@@ -179,65 +283,71 @@ def generate_payloads(
     )
 
 
-def cleanup(ctx: SharedContext):
-    print("Cleaning up")
-    try:
-        with insecure_channel(ctx.server_url) as channel:
-            ArmoniKSessions(channel).close_session(ctx.session_id)
-    except Exception as e:
-        print(f"Couldn't close session : {e}")
-        time.sleep(0.2)
-    try:
-        with insecure_channel(ctx.server_url) as channel:
-            ArmoniKSessions(channel).purge_session(ctx.session_id)
-    except Exception as e:
-        print(f"Couldn't purge session : {e}")
-        time.sleep(0.2)
-    try:
-        with insecure_channel(ctx.server_url) as channel:
-            ArmoniKSessions(channel).delete_session(ctx.session_id)
-    except Exception as e:
-        print(f"Couldn't delete session : {e}")
-        time.sleep(0.2)
+def submit(
+    backend: Backend,
+    context: SharedContext,
+    scene_id: str,
+    payloads: List[Payload],
+    cost_model: Optional[CostModel],
+    previous: Optional[List[Optional[TracerResult]]] = None,
+    priorities: Optional[List[int]] = None,
+) -> None:
+    if cost_model is not None:
+        if previous is not None:
+            by_tile = {tile_key(p): r for p, r in zip(payloads, previous)}
+        payloads = cost_model.order(payloads)
+        if previous is not None:
+            previous = [by_tile[tile_key(p)] for p in payloads]
+        priorities = cost_model.priorities(payloads)
+        cost_model.on_submit(payloads)
+    with span(context.trace, "submit", "main", tasks=len(payloads)):
+        backend.submit(context, scene_id, payloads, priorities, previous)
 
 
 def end_session(
-    ctx: SharedContext, watcher_process: Process, retriever_process: Process
+    ctx: SharedContext, backend: Backend, processes: Dict[str, Process]
 ) -> None:
     print("Stopping subprocesses")
-    ctx.stop_watching_flag = 1
-    ctx.stop_retrieving_flag = 1
-    watcher_process.join(5.0)
-    retriever_process.join(5.0)
-    cleanup(ctx)
+    backend.stop(ctx, processes)
+    backend.cleanup(ctx)
 
 
-def abort(ctx: SharedContext, *processes: Process):
+def abort(
+    ctx: SharedContext,
+    backend: Backend,
+    processes: Dict[str, Process],
+    keep_session: bool = False,
+):
     ctx.stop_display_flag = 1
     ctx.stop_retrieving_flag = 1
     ctx.stop_watching_flag = 1
     try:
         try:
-            with insecure_channel(ctx.server_url) as channel:
-                ArmoniKSessions(channel).cancel_session(ctx.session_id)
+            if keep_session:
+                # The tasks keep running, --resume gets their results later
+                print(f"Session {ctx.session_id} kept, continue it with --resume")
+                backend.stop(ctx, processes)
+            else:
+                backend.cancel(ctx)
         except KeyboardInterrupt:
             print("Stopping completely")
-            for p in processes:
+            for p in processes.values():
                 p.kill()
             exit(1)
         except Exception:
             print("Cannot cancel session")
-        for p in processes:
+        for p in processes.values():
             p.join(2.0)
-        cleanup(ctx)
+        if not keep_session:
+            backend.cleanup(ctx)
     except KeyboardInterrupt:
         print("Stopping completely")
-        for p in processes:
+        for p in processes.values():
             p.kill()
         exit(1)
     except Exception:
         print("Error while aborting")
-        for p in processes:
+        for p in processes.values():
             p.kill()
         exit(1)
     exit(0)
@@ -245,129 +355,274 @@ def abort(ctx: SharedContext, *processes: Process):
 
 def start_processes(
     args,
+    backend: Backend,
     context: SharedContext,
-    watcher_process: Optional[Process],
-    retriever_process: Optional[Process],
-    display_process: Optional[Process],
-) -> Tuple[Process, Process, Process]:
-    display_process = (
-        Process(
-            target=start_display,
-            args=(
-                args.height,
-                args.width,
-                context.params,
-                context.to_watch_queue,
-                context.to_retrieve_queue,
-                context.to_display_queue,
-                context.finalised_queue,
-            ),
-            daemon=True,
-        )
-        if display_process is None
-        or (not display_process.is_alive() and display_process.pid is not None)
-        else display_process
-    )
-    retriever_process = (
-        Process(
-            target=start_retriever,
-            args=(
-                context.params,
-                context.to_watch_queue,
-                context.to_retrieve_queue,
-                context.to_display_queue,
-                context.finalised_queue,
-            ),
-            daemon=True,
+    processes: Dict[str, Optional[Process]],
+) -> Dict[str, Process]:
+    # The display runs on a thread of the client with the async runtime
+    start = ensure_thread if args.runtime == "async" else ensure_process
+    if args.headless:
+        display_process = start(
+            processes.get("display"),
+            start_headless,
+            args.stream,
+            args.stream_fps,
+            ToneMapper(args.exposure, args.tone_map),
+            *context.process_args,
         )
-        if retriever_process is None
-        or (not retriever_process.is_alive() and retriever_process.pid is not None)
-        else retriever_process
-    )
-    watcher_process = (
-        Process(
-            target=start_watcher,
-            args=(
-                args.use_polling,
-                context.params,
-                context.to_watch_queue,
-                context.to_retrieve_queue,
-                context.to_display_queue,
-                context.finalised_queue,
-            ),
-            daemon=True,
+    else:
+        display_process = start(
+            processes.get("display"),
+            start_display,
+            args.height,
+            args.width,
+            ToneMapper(args.exposure, args.tone_map),
+            *context.process_args,
         )
-        if watcher_process is None
-        or (not watcher_process.is_alive() and watcher_process.pid is not None)
-        else watcher_process
-    )
-    if not display_process.is_alive():
-        display_process.start()
-    if not retriever_process.is_alive():
-        retriever_process.start()
-    if not watcher_process.is_alive():
-        watcher_process.start()
+    return {"display": display_process, **backend.start_processes(context, processes)}
+
 
-    return watcher_process, retriever_process, display_process
+def image_params(args) -> dict:
+    # What a journal can only be resumed with
+    return {
+        "width": args.width,
+        "height": args.height,
+        "taskwidth": args.taskwidth,
+        "taskheight": args.taskheight,
+        "samples": args.samples,
+        "killdepth": args.killdepth,
+        "splitdepth": args.splitdepth,
+        "scene": args.scene,
+    }
 
 
 def main(args):
     print("Hello PiTracer Demo!")
     run_demo = True
-    with multiprocessing.Manager() as manager:
+    journal = Journal(args.journal) if args.journal else None
+    resume = args.resume
+    if resume:
+        if not journal.exists:
+            print(f"Nothing to resume in {args.journal}")
+            exit(1)
+        if journal.load_session()["image"] != image_params(args):
+            print(f"The render in {args.journal} was started with other parameters")
+            exit(1)
+        if journal.replay().complete:
+            print(f"The render in {args.journal} is already complete")
+            exit(0)
+    elif journal is not None:
+        journal.reset()
+    scene = load_scene(
+        args.scene, args.width, args.height, args.killdepth, args.splitdepth
+    )
+    print(f"Scene with {len(scene.spheres)} spheres")
+    if args.fake_server:
+        from tracer.fake_armonik import Faults, start_fake_server
+
+        # Started before anything else, it is stopped with the client
+        ports = multiprocessing.Queue()
+        ensure_process(
+            None,
+            start_fake_server,
+            args.fake_server,
+            args.fake_workers,
+            Faults(
+                task_latency=args.fake_latency, task_failure_rate=args.fake_failure_rate
+            ),
+            ports,
+        )
+        args.server_url = f"localhost:{ports.get(timeout=30)}"
+    # Results refined by the client only hold the samples of their pass
+    cache = (
+        TileCache(
+            args.cache_dir,
+            args.cache_size << 20,
+            scene,
+            args.samples,
+            args.error_threshold,
+        )
+        if args.cache_dir and not args.client_refinement
+        else None
+    )
+    metrics = None
+    if args.metrics_port is not None or args.metrics_report:
+        metrics = MetricsRecorder()
+        collector = MetricsCollector(metrics, args.metrics_port, args.metrics_report)
+        # Every way out goes through exit(), abort() included
+        atexit.register(collector.close)
+    trace = None
+    if args.trace:
+        trace = TraceRecorder(tempfile.mkdtemp(prefix="pitracer-trace-"))
+        atexit.register(merge_traces, trace.directory, args.trace)
+    with FrameBuffer(
+        args.height,
+        args.width,
+        args.client_refinement,
+        path=journal.framebuffer_path if journal is not None else None,
+    ) as framebuffer:
+        backend = create_backend(args)
         context = SharedContext(
-            manager.list([args.server_url, "", None, logging.INFO, 0, 0, 0, 0]),
-            JoinableQueue(),
-            JoinableQueue(),
-            JoinableQueue(),
-            JoinableQueue(),
+            ControlBlock(args.server_url or ""),
+            *backend.create_queues(),
+            framebuffer,
+            journal,
+            cache,
+            metrics,
+            trace,
         )
-        watcher_process, retriever_process, display_process = None, None, None
+        processes: Dict[str, Process] = {}
         while run_demo:
-            create_context(context, args.server_url, args.error_threshold)
-            print("Context created")
-            scene_id = send_scene(
-                context,
-                get_scene(args.width, args.height, args.killdepth, args.splitdepth),
+            scene_id = None
+            state = JournalState()
+            if resume:
+                print(f"Resuming from {args.journal}")
+                state = journal.replay()
+                scene_id = backend.reattach(context, journal.load_session()["backend"])
+            else:
+                framebuffer.clear()
+            if scene_id is None:
+                backend.create_context(context, args.error_threshold)
+                print("Context created")
+                with span(context.trace, "send_scene", "main"):
+                    scene_id = backend.send_scene(context, scene)
+                state.pending.clear()
+                if journal is not None:
+                    journal.started(context.session_id)
+                    journal.save_session(
+                        {
+                            "backend": backend.session_info(context),
+                            "image": image_params(args),
+                        }
+                    )
+            cost_model = (
+                CostModel.for_scene(scene, args.cost_dir) if args.cost_aware else None
             )
 
-            payloads = generate_payloads(
-                args.width, args.height, args.taskwidth, args.taskheight, args.samples
-            )
+            with span(context.trace, "generate_payloads", "main"):
+                payloads = generate_payloads(
+                    args.width,
+                    args.height,
+                    args.taskwidth,
+                    args.taskheight,
+                    args.samples,
+                )
             print("Payloads generated")
             expected_finalized_tasks = len(payloads)
-            results = create_results(context, payloads)
-            print("Results created")
-            payload_ids = send_payloads(context, payloads)
-            print("Payloads sent")
+            already_final = len(state.final & {tile_key(p) for p in payloads})
+            if resume:
+                # Tiles are shown as they were, results still on their way are
+                # watched, and the tiles without any are rendered again
+                for update in state.updates.values():
+                    context.to_display_queue.put(update)
+                for result_id in state.pending:
+                    context.to_watch_queue.put(result_id)
+                waiting = set(state.pending.values())
+                payloads = [
+                    p
+                    for p in payloads
+                    if tile_key(p) not in state.final and tile_key(p) not in waiting
+                ]
+                print(
+                    f"{already_final} tiles done, {len(waiting)} on their way, "
+                    f"{len(payloads)} to send"
+                )
+                resume = False
+            previous: Optional[List[Optional[TracerResult]]] = None
+            if cache is not None:
+                # Cached tiles are shown right away, the final ones are not sent and
+                # the others are sent to be refined further
+                cached = [(p, cache.lookup(p)) for p in payloads]
+                for _, result in cached:
+                    if result is not None:
+                        context.publish(framebuffer.write(result))
+                cached = [(p, r) for p, r in cached if r is None or not r.isFinal]
+                print(
+                    f"{len(payloads) - len(cached)} tiles found in the cache, "
+                    f"{sum(r is not None for _, r in cached)} to refine"
+                )
+                payloads = [p for p, _ in cached]
+                previous = [r for _, r in cached]
+            scheduler = (
+                AdaptiveScheduler(payloads, args.error_threshold, args.min_tile_size)
+                if args.adaptive
+                else None
+            )
+            planner = (
+                DeadlinePlanner(payloads, args.deadline)
+                if args.deadline is not None
+                else None
+            )
+            controller = (
+                ConvergenceController(
+                    framebuffer, args.quality_target, args.sample_budget
+                )
+                if args.quality_target is not None or args.sample_budget is not None
+                else None
+            )
+            refinements: List[Payload] = []
+            priorities: List[int] = []
             context.stop_retrieving_flag = 0
             context.stop_watching_flag = 0
             context.stop_display_flag = 0
             try:
-                watcher_process, retriever_process, display_process = start_processes(
-                    args, context, watcher_process, retriever_process, display_process
-                )
-                task_definitions = create_task_definitions(
-                    scene_id, payload_ids, results
-                )
-                print("Task definitions created")
-                for r in results.values():
-                    context.to_watch_queue.put(r)
-                send_tasks(context, list(task_definitions.values()))
+                processes = start_processes(args, backend, context, processes)
+                print("Sending tasks...")
+                submit(backend, context, scene_id, payloads, cost_model, previous)
                 print("Tasks sent")
-                current_finalised_tasks = 0
-                done_tasks = 0
+                current_finalised_tasks = already_final
+                done_tasks = already_final
                 total_tasks = expected_finalized_tasks
                 start = time.perf_counter()
                 while True:
                     try:
-                        _, _, is_final = context.finalised_queue.get(timeout=0.20)
-                        if is_final:
+                        update = cast(
+                            TileUpdate, context.finalised_queue.get(timeout=0.20)
+                        )
+                        if update.is_final:
                             current_finalised_tasks += 1
                         else:
                             total_tasks += 1
                         done_tasks += 1
                         context.finalised_queue.task_done()
+                        if cost_model is not None:
+                            cost_model.observe(update)
+                        if controller is not None:
+                            controller.observe(update)
+                        if scheduler is not None:
+                            refinements.extend(scheduler.update(update))
+                            if refinements and (
+                                context.finalised_queue.empty()
+                                or len(refinements) >= args.submit_chunk_size
+                            ):
+                                submit(
+                                    backend,
+                                    context,
+                                    scene_id,
+                                    refinements,
+                                    cost_model,
+                                )
+                                total_tasks += len(refinements)
+                                refinements = []
+                        if planner is not None:
+                            for payload, priority in planner.update(update):
+                                refinements.append(payload)
+                                priorities.append(priority)
+                            if refinements and (
+                                context.finalised_queue.empty()
+                                or len(refinements) >= args.submit_chunk_size
+                            ):
+                                submit(
+                                    backend,
+                                    context,
+                                    scene_id,
+                                    refinements,
+                                    None,
+                                    priorities=priorities,
+                                )
+                                total_tasks += len(refinements)
+                                refinements = []
+                                priorities = []
                         end = time.perf_counter()
                         if end - start > 1:
                             start = end
@@ -375,30 +630,60 @@ def main(args):
                                 f"Completion : {done_tasks:04}/{total_tasks:04} ({done_tasks / total_tasks * 100:.1f}%)",
                                 end="\r",
                             )
-                        if current_finalised_tasks >= expected_finalized_tasks:
-                            print("\nDemo is done")
-                            break
                     except Empty:
                         print(
                             f"Completion : {done_tasks:04}/{total_tasks:04} ({done_tasks / total_tasks * 100:.1f}%)",
                             end="\r",
                         )
-                    check = [
-                        display_process.is_alive(),
-                        watcher_process.is_alive(),
-                        retriever_process.is_alive(),
-                    ]
-                    if not all(check):
-                        logging.error(f"Problem running one of the processes {check}")
-                        abort(
-                            context, display_process, watcher_process, retriever_process
+                    converged = (
+                        controller.converged() if controller is not None else None
+                    )
+                    if converged is not None:
+                        # Whatever is still queued would not visibly change the image
+                        print(f"\nImage converged : {converged}")
+                        backend.stop(context, processes)
+                        cancelled = backend.cancel_pending(context)
+                        print(f"{cancelled} pending tasks cancelled")
+                    if planner is not None and planner.expired:
+                        # Whatever comes back later is too late
+                        print("\nDeadline reached")
+                        backend.stop(context, processes)
+                        cancelled = backend.cancel_pending(context)
+                        print(f"{cancelled} pending tasks cancelled")
+                    if converged is not None or (
+                        scheduler.done
+                        if scheduler is not None
+                        else (
+                            planner.done
+                            if planner is not None
+                            else current_finalised_tasks >= expected_finalized_tasks
                         )
+                    ):
+                        print("\nDemo is done")
+                        if cost_model is not None:
+                            cost_model.save()
+                        if journal is not None:
+                            framebuffer.flush()
+                            journal.completed()
+                        if args.output:
+                            save_image(
+                                args.output,
+                                framebuffer,
+                                ToneMapper(args.exposure, args.tone_map),
+                            )
+                        break
+                    check = {n: p.is_alive() for n, p in processes.items()}
+                    if not all(check.values()):
+                        logging.error(f"Problem running one of the processes {check}")
+                        abort(context, backend, processes, journal is not None)
             except KeyboardInterrupt:
                 print("Process aborted")
-                abort(context, display_process, watcher_process, retriever_process)
+                abort(context, backend, processes, journal is not None)
             try:
-                end_session(context, watcher_process, retriever_process)
-                if args.no_auto_rerun:
+                end_session(context, backend, processes)
+                if args.headless:
+                    run_demo = False
+                elif args.no_auto_rerun:
                     run_demo = input("Re-run demo? Y/(N)").lower().strip() == "y"
                 else:
                     print("Re-run demo? (Auto run in 30s) (Y)/N")
@@ -410,8 +695,13 @@ def main(args):
             except EOFError:
                 run_demo = False
             if not run_demo:
-                abort(context, display_process, watcher_process, retriever_process)
+                # Lets the encoder finish the stream before everything is torn down
+                context.stop_display_flag = 1
+                processes["display"].join(10.0)
+                abort(context, backend, processes)
             else:
+                if journal is not None:
+                    journal.reset()
                 context.reset_display_flag = 1
 
 
@@ -0,0 +1,149 @@
+from typing import Dict, List, Tuple, Union
+
+from tracer.framebuffer import TileUpdate, split_sizes
+from tracer.objects import Payload
+
+TileKey = Tuple[int, int, int, int]
+
+
+def tile_key(tile: Union[Payload, TileUpdate]) -> TileKey:
+    return tile.coord_x, tile.coord_y, tile.task_width, tile.task_height
+
+
+def split_tile(key: TileKey) -> List[TileKey]:
+    # Same quadrant order as framebuffer.quadrant_errors
+    coord_x, coord_y, width, height = key
+    h1, h2 = split_sizes(height)
+    w1, w2 = split_sizes(width)
+    return [
+        (coord_x, coord_y, w1, h1),
+        (coord_x, coord_y + w1, w2, h1),
+        (coord_x + h1, coord_y, w1, h2),
+        (coord_x + h1, coord_y + w1, w2, h2),
+    ]
+
+
+def bounding_tile(keys: List[TileKey]) -> TileKey:
+    coord_x = min(k[0] for k in keys)
+    coord_y = min(k[1] for k in keys)
+    return (
+        coord_x,
+        coord_y,
+        max(k[1] + k[2] for k in keys) - coord_y,
+        max(k[0] + k[3] for k in keys) - coord_x,
+    )
+
+
+class AdaptiveScheduler:
+    # Client-side refinement driven by the error estimated on each returned tile:
+    # - converged tiles (error under the threshold) stop being refined
+    # - noisy tiles are split in quadrants and only the noisy quadrants are resent
+    # - tiles that are neither stay as they are, or are merged back with their
+    #   siblings into their parent when all of them are in that state
+    # The initial grid is grouped by 2x2 blocks so that easy regions can be merged too
+    def __init__(
+        self,
+        payloads: List[Payload],
+        error_threshold: float,
+        min_tile_size: int = 8,
+        split_factor: float = 4.0,
+        max_samples: int = 4096,
+    ):
+        self.error_threshold = error_threshold
+        self.split_threshold = error_threshold * split_factor
+        self.min_tile_size = min_tile_size
+        self.max_samples = max_samples
+        self.base_samples = max(p.samples for p in payloads)
+        self.base_area = max(p.task_width * p.task_height for p in payloads)
+        self.parents: Dict[TileKey, TileKey] = {}
+        self.children: Dict[TileKey, List[TileKey]] = {}
+        self.in_flight: Dict[TileKey, Payload] = {tile_key(p): p for p in payloads}
+        self.calm: Dict[TileKey, Payload] = {}
+        self.converged = 0
+
+        tile_width = max(p.task_width for p in payloads)
+        tile_height = max(p.task_height for p in payloads)
+        blocks: Dict[Tuple[int, int], List[TileKey]] = {}
+        for key in self.in_flight:
+            block = (key[0] // (2 * tile_height), key[1] // (2 * tile_width))
+            blocks.setdefault(block, []).append(key)
+        for keys in blocks.values():
+            if len(keys) > 1:
+                self.adopt(bounding_tile(keys), keys)
+
+    @property
+    def done(self) -> bool:
+        return not self.in_flight and not self.calm
+
+    def adopt(self, parent: TileKey, children: List[TileKey]) -> None:
+        self.children[parent] = children
+        for child in children:
+            self.parents[child] = parent
+
+    def payload(self, key: TileKey) -> Payload:
+        # Smaller tiles get more samples so that a task keeps about the same cost
+        area = key[2] * key[3]
+        samples = max(self.base_samples, self.base_samples * self.base_area // area)
+        return Payload(*key, min(samples, self.max_samples))
+
+    def send(self, keys: List[TileKey]) -> List[Payload]:
+        payloads = [self.payload(k) for k in keys]
+        self.in_flight.update(zip(keys, payloads))
+        return payloads
+
+    def release_siblings(self, key: TileKey) -> List[TileKey]:
+        # key can no longer be merged, so its siblings waiting for it are resent
+        parent = self.parents.get(key)
+        if parent is None:
+            return []
+        waiting = [s for s in self.children[parent] if s in self.calm]
+        for s in waiting:
+            del self.calm[s]
+        return waiting
+
+    def update(self, update: TileUpdate) -> List[Payload]:
+        key = tile_key(update)
+        if self.in_flight.pop(key, None) is None:
+            return []
+        if update.errors is None:
+            # Nothing to compare to yet, one more pass gives the first estimate
+            return self.send([key])
+
+        if (
+            update.error <= self.error_threshold
+            or update.n_samples_per_pixel >= self.max_samples
+        ):
+            self.converged += 1
+            return self.send(self.release_siblings(key))
+
+        if (
+            update.error > self.split_threshold
+            and min(key[2], key[3]) >= 2 * self.min_tile_size
+        ):
+            quadrants = split_tile(key)
+            self.adopt(key, quadrants)
+            noisy = [
+                q for q, e in zip(quadrants, update.errors) if e > self.error_threshold
+            ]
+            self.converged += len(quadrants) - len(noisy)
+            return self.send(noisy + self.release_siblings(key))
+
+        parent = self.parents.get(key)
+        if parent is None:
+            return self.send([key])
+        self.calm[key] = self.payload(key)
+        siblings = self.children[parent]
+        if all(s in self.calm for s in siblings):
+            for s in siblings:
+                del self.calm[s]
+                del self.parents[s]
+            del self.children[parent]
+            return self.send([parent])
+        if any(s not in self.calm and s not in self.in_flight for s in siblings):
+            del self.calm[key]
+            return self.send([key])
+        return []
+
+    def progress(self) -> float:
+        tiles = self.converged + len(self.in_flight) + len(self.calm)
+        return self.converged / tiles if tiles else 1.0
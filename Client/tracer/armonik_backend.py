@@ -0,0 +1,363 @@
+import copy
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from multiprocessing import Process
+from typing import Dict, List, Optional
+
+from armonik.client.results import ArmoniKResults
+from armonik.client.sessions import ArmoniKSessions
+from armonik.client.tasks import ArmoniKTasks
+from armonik.common import SessionStatus
+from armonik.common.objects import TaskOptions, TaskDefinition
+from grpc import Channel, insecure_channel
+
+from tracer.adaptive import tile_key
+from tracer.backend import Backend, ensure_process
+from tracer.objects import Scene, Payload, TracerResult
+from tracer.retriever import start_retriever
+from tracer.shared_context import SharedContext
+from tracer.trace_events import span
+from tracer.watcher import list_pending_results, start_watcher
+
+
+def create_context(
+    context: SharedContext,
+    server_url: str,
+    error_threshold: float,
+    client_refinement: bool = False,
+) -> None:
+    print("Creating context...")
+    with insecure_channel(server_url) as channel:
+        options = TaskOptions(
+            max_duration=timedelta(seconds=300),
+            priority=1,
+            max_retries=1,
+            options={
+                "n_threads": str(4),
+                "errorMetricThreshold": str(error_threshold),
+                "clientRefinement": str(client_refinement).lower(),
+            },
+        )
+        context.session_id = ArmoniKSessions(channel).create_session(options)
+        context.task_options = options
+
+
+def send_scene(context: SharedContext, scene: Scene) -> str:
+    print("Sending scene...")
+    with insecure_channel(context.server_url) as channel:
+        scene_id = (
+            ArmoniKResults(channel)
+            .create_results({"scene": scene.to_bytes()}, context.session_id)["scene"]
+            .result_id
+        )
+        d: dict = copy.deepcopy(context.task_options.options)
+        d["sceneId"] = scene_id
+        context.task_options = TaskOptions(
+            max_duration=timedelta(seconds=300),
+            priority=1,
+            max_retries=1,
+            options=d,
+        )
+        print("Scene sent")
+        return scene_id
+
+
+def send_payloads(
+    context: SharedContext, channel: Channel, payloads: list[Payload]
+) -> dict[str, str]:
+    return {
+        k: r.result_id
+        for k, r in ArmoniKResults(channel)
+        .create_results(
+            {f"{p.coord_x}_{p.coord_y}": p.to_bytes() for p in payloads},
+            context.session_id,
+            20,
+        )
+        .items()
+    }
+
+
+def send_previous_results(
+    context: SharedContext, channel: Channel, previous: dict[str, TracerResult]
+) -> dict[str, str]:
+    return {
+        k: r.result_id
+        for k, r in ArmoniKResults(channel)
+        .create_results(
+            {k: r.raw for k, r in previous.items()},
+            context.session_id,
+            20,
+        )
+        .items()
+    }
+
+
+def create_results(
+    context: SharedContext, channel: Channel, payloads: list[Payload]
+) -> dict[str, str]:
+    return {
+        k: r.result_id
+        for k, r in ArmoniKResults(channel)
+        .create_results_metadata(
+            [f"{p.coord_x}_{p.coord_y}" for p in payloads],
+            context.session_id,
+            100,
+        )
+        .items()
+    }
+
+
+def task_options_for(
+    options: TaskOptions, priority: int = 0, previous: Optional[str] = None
+) -> TaskOptions:
+    task_options = dict(options.options)
+    if previous is not None:
+        # Same option as the follow-up tasks created by the workers
+        task_options["previous"] = previous
+    return TaskOptions(
+        max_duration=options.max_duration,
+        priority=options.priority + priority,
+        max_retries=options.max_retries,
+        options=task_options,
+    )
+
+
+def create_task_definitions(
+    scene: str,
+    payloads: dict[str, str],
+    results: dict[str, str],
+    options: Optional[dict[str, TaskOptions]] = None,
+    previous: Optional[dict[str, str]] = None,
+) -> dict[str, TaskDefinition]:
+    previous = previous or {}
+    return {
+        k: TaskDefinition(
+            payload_id=p,
+            payload=b"",
+            expected_output_ids=[results[k]],
+            data_dependencies=[scene, previous[k]] if k in previous else [scene],
+            options=options.get(k) if options is not None else None,
+        )
+        for k, p in payloads.items()
+    }
+
+
+def send_tasks(
+    context: SharedContext, channel: Channel, tasks: list[TaskDefinition]
+) -> None:
+    ArmoniKTasks(channel).submit_tasks(context.session_id, tasks, context.task_options)
+
+
+def submit_chunk(
+    context: SharedContext,
+    channel: Channel,
+    scene_id: str,
+    payloads: list[Payload],
+    priorities: Optional[list[int]] = None,
+    previous: Optional[list[Optional[TracerResult]]] = None,
+) -> None:
+    trace = context.trace
+    with span(trace, "create_results", "submit", tasks=len(payloads)):
+        results = create_results(context, channel, payloads)
+    with span(trace, "send_payloads", "submit", tasks=len(payloads)):
+        payload_ids = send_payloads(context, channel, payloads)
+    keys = [f"{p.coord_x}_{p.coord_y}" for p in payloads]
+    previous_ids = {}
+    if previous is not None:
+        with span(trace, "send_previous_results", "submit", tasks=len(payloads)):
+            previous_ids = send_previous_results(
+                context,
+                channel,
+                {k: r for k, r in zip(keys, previous) if r is not None},
+            )
+    options = None
+    if priorities is not None or previous_ids:
+        # Relative priorities on top of the session one, follow-up tasks created by
+        # the workers keep theirs
+        options = {
+            k: task_options_for(
+                context.task_options,
+                priorities[i] - 1 if priorities is not None else 0,
+                previous_ids.get(k),
+            )
+            for i, k in enumerate(keys)
+        }
+    task_definitions = create_task_definitions(
+        scene_id, payload_ids, results, options, previous_ids
+    )
+    with span(trace, "send_tasks", "submit", tasks=len(payloads)):
+        send_tasks(context, channel, list(task_definitions.values()))
+    # Only watched once the tasks exist, a journal never waits for results that
+    # will not come. Results completing in between are caught up by the watcher
+    tiles = {f"{p.coord_x}_{p.coord_y}": tile_key(p) for p in payloads}
+    for k, r in results.items():
+        context.watch(r, tiles[k])
+
+
+def submit_payloads(
+    context: SharedContext,
+    scene_id: str,
+    payloads: list[Payload],
+    chunk_size: int,
+    concurrency: int,
+    priorities: Optional[list[int]] = None,
+    previous: Optional[list[Optional[TracerResult]]] = None,
+) -> None:
+    # Payloads are already ordered, the first chunks reach the workers while the
+    # following ones are still being created and uploaded
+    with insecure_channel(context.server_url) as channel, ThreadPoolExecutor(
+        concurrency
+    ) as executor:
+        chunks = [
+            executor.submit(
+                submit_chunk,
+                context,
+                channel,
+                scene_id,
+                payloads[i : i + chunk_size],
+                priorities[i : i + chunk_size] if priorities is not None else None,
+                previous[i : i + chunk_size] if previous is not None else None,
+            )
+            for i in range(0, len(payloads), chunk_size)
+        ]
+        for chunk in chunks:
+            chunk.result()
+
+
+def cancel_pending(ctx: SharedContext, rounds: int = 3) -> int:
+    # Tasks that were running when listed may create their follow-up task before
+    # being cancelled, a few rounds catch those
+    cancelled = 0
+    with insecure_channel(ctx.server_url) as channel:
+        results = ArmoniKResults(channel)
+        for _ in range(rounds):
+            pending = [
+                r.result_id for r in list_pending_results(results, ctx.session_id)
+            ]
+            if not pending:
+                break
+            tasks = set(results.get_owner_task_id(pending, ctx.session_id).values())
+            ArmoniKTasks(channel).cancel_tasks(list(tasks))
+            cancelled += len(tasks)
+    return cancelled
+
+
+def cleanup(ctx: SharedContext):
+    print("Cleaning up")
+    try:
+        with insecure_channel(ctx.server_url) as channel:
+            ArmoniKSessions(channel).close_session(ctx.session_id)
+    except Exception as e:
+        print(f"Couldn't close session : {e}")
+        time.sleep(0.2)
+    try:
+        with insecure_channel(ctx.server_url) as channel:
+            ArmoniKSessions(channel).purge_session(ctx.session_id)
+    except Exception as e:
+        print(f"Couldn't purge session : {e}")
+        time.sleep(0.2)
+    try:
+        with insecure_channel(ctx.server_url) as channel:
+            ArmoniKSessions(channel).delete_session(ctx.session_id)
+    except Exception as e:
+        print(f"Couldn't delete session : {e}")
+        time.sleep(0.2)
+
+
+class ArmoniKBackend(Backend):
+    def __init__(self, args):
+        self.server_url = args.server_url
+        self.use_polling = args.use_polling
+        self.download_concurrency = args.download_concurrency
+        self.submit_chunk_size = args.submit_chunk_size
+        self.submit_concurrency = args.submit_concurrency
+        self.client_refinement = args.client_refinement
+
+    def create_context(self, context: SharedContext, error_threshold: float) -> None:
+        create_context(
+            context, self.server_url, error_threshold, self.client_refinement
+        )
+
+    def send_scene(self, context: SharedContext, scene: Scene) -> str:
+        return send_scene(context, scene)
+
+    def start_processes(
+        self, context: SharedContext, processes: Dict[str, Optional[Process]]
+    ) -> Dict[str, Process]:
+        return {
+            "retriever": ensure_process(
+                processes.get("retriever"),
+                start_retriever,
+                self.download_concurrency,
+                *context.process_args,
+            ),
+            "watcher": ensure_process(
+                processes.get("watcher"),
+                start_watcher,
+                self.use_polling,
+                *context.process_args,
+            ),
+        }
+
+    def submit(
+        self,
+        context: SharedContext,
+        scene_id: str,
+        payloads: List[Payload],
+        priorities: Optional[List[int]] = None,
+        previous: Optional[List[Optional[TracerResult]]] = None,
+    ) -> None:
+        submit_payloads(
+            context,
+            scene_id,
+            payloads,
+            self.submit_chunk_size,
+            self.submit_concurrency,
+            priorities,
+            previous,
+        )
+
+    def session_info(self, context: SharedContext) -> dict:
+        return {
+            "session_id": context.session_id,
+            "options": dict(context.task_options.options),
+        }
+
+    def reattach(self, context: SharedContext, session: dict) -> Optional[str]:
+        try:
+            with insecure_channel(self.server_url) as channel:
+                status = (
+                    ArmoniKSessions(channel).get_session(session["session_id"]).status
+                )
+        except Exception as e:
+            print(f"Couldn't find session {session['session_id']} : {e}")
+            return None
+        if status != SessionStatus.RUNNING:
+            print(f"Session {session['session_id']} is no longer running")
+            return None
+        context.session_id = session["session_id"]
+        context.task_options = TaskOptions(
+            max_duration=timedelta(seconds=300),
+            priority=1,
+            max_retries=1,
+            options=session["options"],
+        )
+        return session["options"]["sceneId"]
+
+    def stop(self, context: SharedContext, processes: Dict[str, Process]) -> None:
+        context.stop_watching_flag = 1
+        context.stop_retrieving_flag = 1
+        for name in ("watcher", "retriever"):
+            if name in processes:
+                processes[name].join(5.0)
+
+    def cancel(self, context: SharedContext) -> None:
+        with insecure_channel(context.server_url) as channel:
+            ArmoniKSessions(channel).cancel_session(context.session_id)
+
+    def cancel_pending(self, context: SharedContext) -> int:
+        return cancel_pending(context)
+
+    def cleanup(self, context: SharedContext) -> None:
+        cleanup(context)
@@ -0,0 +1,452 @@
+import asyncio
+import queue
+from concurrent.futures import CancelledError, Future, TimeoutError
+from itertools import islice
+from multiprocessing import Process
+from threading import Thread, get_ident
+from typing import Coroutine, Dict, List, Optional
+
+import grpc
+from armonik.common import Direction, Result, ResultStatus
+from armonik.common.objects import TaskDefinition, TaskOptions
+from armonik.protogen.client.events_service_pb2_grpc import EventsStub
+from armonik.protogen.client.results_service_pb2_grpc import ResultsStub
+from armonik.protogen.client.tasks_service_pb2_grpc import TasksStub
+from armonik.protogen.common.events_common_pb2 import (
+    EVENTS_ENUM_RESULT_STATUS_UPDATE,
+    EventSubscriptionRequest,
+)
+from armonik.protogen.common.results_common_pb2 import (
+    CreateResultsMetaDataRequest,
+    CreateResultsRequest,
+    DownloadResultDataRequest,
+    ListResultsRequest,
+)
+from armonik.protogen.common.tasks_common_pb2 import SubmitTasksRequest
+
+from tracer.adaptive import tile_key
+from tracer.armonik_backend import (
+    ArmoniKBackend,
+    create_task_definitions,
+    task_options_for,
+)
+from tracer.metrics import DOWNLOAD_END, DOWNLOAD_START
+from tracer.objects import Payload, TracerResult
+from tracer.retriever import downloaded
+from tracer.shared_context import SharedContext
+from tracer.trace_events import instant, span
+from tracer.watcher import (
+    POLL_MIN_INTERVAL,
+    RESULT_COMPLETED_AT_FILTER,
+    FinishedResultsReporter,
+    completed,
+    finished_results_filter,
+    poll_interval,
+)
+
+
+def batched(items: list, size: int) -> List[list]:
+    it = iter(items)
+    return list(iter(lambda: list(islice(it, size)), []))
+
+
+class LoopQueue:
+    # Queue of the shared context whose consumer is a coroutine: put can be called
+    # from any thread, items are only handed to the event loop
+    def __init__(self, loop: asyncio.AbstractEventLoop, loop_thread: int):
+        self.loop = loop
+        self.loop_thread = loop_thread
+        self.queue = asyncio.Queue()
+
+    def put(self, item) -> None:
+        if get_ident() == self.loop_thread:
+            self.queue.put_nowait(item)
+        else:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class LoopTask:
+    # Coroutine of the event loop standing in for a process, main checks and stops
+    # it the same way
+    def __init__(self, future: Future):
+        self.future = future
+
+    def is_alive(self) -> bool:
+        return not self.future.done()
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        try:
+            self.future.result(timeout)
+        except (CancelledError, TimeoutError):
+            pass
+
+    def kill(self) -> None:
+        self.future.cancel()
+
+
+class AsyncArmoniKBackend(ArmoniKBackend):
+    # Submission, event watching and downloads are coroutines of a single event loop
+    # of the client process sharing one channel, results go from the stream to the
+    # framebuffer without crossing a process. Session management is left to the
+    # blocking calls of ArmoniKBackend, it's not on the way of the tiles
+    def __init__(self, args):
+        super().__init__(args)
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, daemon=True, name="asyncio")
+        self.thread.start()
+        self.channel: Optional[grpc.aio.Channel] = None
+
+    def run(self, coroutine: Coroutine) -> Future:
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def create_queues(self) -> tuple:
+        return (
+            LoopQueue(self.loop, self.thread.ident),
+            LoopQueue(self.loop, self.thread.ident),
+            queue.Queue(),
+            queue.Queue(),
+        )
+
+    async def open_channel(self) -> grpc.aio.Channel:
+        # Created from the loop it's used on
+        if self.channel is None:
+            self.channel = grpc.aio.insecure_channel(self.server_url)
+        return self.channel
+
+    def start_processes(
+        self, context: SharedContext, processes: Dict[str, Optional[Process]]
+    ) -> Dict[str, LoopTask]:
+        self.run(self.open_channel()).result()
+        tasks = {}
+        for name, coroutine in (
+            ("retriever", self.retrieve_results),
+            ("watcher", self.watch_results),
+        ):
+            task = processes.get(name)
+            if not isinstance(task, LoopTask) or not task.is_alive():
+                task = LoopTask(self.run(coroutine(context)))
+            tasks[name] = task
+        return tasks
+
+    async def cancel_tasks(self, close: bool = False) -> None:
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if close and self.channel is not None:
+            await self.channel.close()
+            self.channel = None
+
+    def stop(self, context: SharedContext, processes: Dict[str, Process]) -> None:
+        context.stop_watching_flag = 1
+        context.stop_retrieving_flag = 1
+        self.run(self.cancel_tasks()).result(5.0)
+
+    def cleanup(self, context: SharedContext) -> None:
+        # Also reached without stop when the session is cancelled
+        self.run(self.cancel_tasks(close=True)).result(5.0)
+        super().cleanup(context)
+
+    def submit(
+        self,
+        context: SharedContext,
+        scene_id: str,
+        payloads: List[Payload],
+        priorities: Optional[List[int]] = None,
+        previous: Optional[List[Optional[TracerResult]]] = None,
+    ) -> None:
+        self.run(
+            self.submit_payloads(context, scene_id, payloads, priorities, previous)
+        ).result()
+
+    async def submit_payloads(
+        self,
+        context: SharedContext,
+        scene_id: str,
+        payloads: List[Payload],
+        priorities: Optional[List[int]],
+        previous: Optional[List[Optional[TracerResult]]],
+    ) -> None:
+        # Same chunks as the threads of ArmoniKBackend, started in order
+        slots = asyncio.Semaphore(self.submit_concurrency)
+        size = self.submit_chunk_size
+
+        async def chunk(i: int) -> None:
+            async with slots:
+                await self.submit_chunk(
+                    context,
+                    scene_id,
+                    payloads[i : i + size],
+                    priorities[i : i + size] if priorities is not None else None,
+                    previous[i : i + size] if previous is not None else None,
+                )
+
+        await asyncio.gather(*(chunk(i) for i in range(0, len(payloads), size)))
+
+    async def create_results(
+        self, session_id: str, data: Dict[str, bytes], batch_size: int
+    ) -> Dict[str, str]:
+        client = ResultsStub(self.channel)
+        responses = await asyncio.gather(
+            *(
+                client.CreateResults(
+                    CreateResultsRequest(
+                        results=[
+                            CreateResultsRequest.ResultCreate(name=k, data=data[k])
+                            for k in keys
+                        ],
+                        session_id=session_id,
+                    )
+                )
+                for keys in batched(list(data), batch_size)
+            )
+        )
+        return {r.name: r.result_id for response in responses for r in response.results}
+
+    async def create_results_metadata(
+        self, session_id: str, names: List[str], batch_size: int
+    ) -> Dict[str, str]:
+        client = ResultsStub(self.channel)
+        responses = await asyncio.gather(
+            *(
+                client.CreateResultsMetaData(
+                    CreateResultsMetaDataRequest(
+                        results=[
+                            CreateResultsMetaDataRequest.ResultCreate(name=k)
+                            for k in keys
+                        ],
+                        session_id=session_id,
+                    )
+                )
+                for keys in batched(names, batch_size)
+            )
+        )
+        return {r.name: r.result_id for response in responses for r in response.results}
+
+    async def send_tasks(
+        self,
+        session_id: str,
+        tasks: List[TaskDefinition],
+        options: TaskOptions,
+        batch_size: int = 100,
+    ) -> None:
+        client = TasksStub(self.channel)
+        await asyncio.gather(
+            *(
+                client.SubmitTasks(
+                    SubmitTasksRequest(
+                        session_id=session_id,
+                        task_creations=[
+                            SubmitTasksRequest.TaskCreation(
+                                expected_output_keys=t.expected_output_ids,
+                                payload_id=t.payload_id,
+                                data_dependencies=t.data_dependencies,
+                                task_options=(
+                                    t.options.to_message() if t.options else None
+                                ),
+                            )
+                            for t in batch
+                        ],
+                        task_options=options.to_message(),
+                    )
+                )
+                for batch in batched(tasks, batch_size)
+            )
+        )
+
+    async def submit_chunk(
+        self,
+        context: SharedContext,
+        scene_id: str,
+        payloads: List[Payload],
+        priorities: Optional[List[int]],
+        previous: Optional[List[Optional[TracerResult]]],
+    ) -> None:
+        trace = context.trace
+        session_id = context.session_id
+        keys = [f"{p.coord_x}_{p.coord_y}" for p in payloads]
+        with span(trace, "create_results", "submit", tasks=len(payloads)):
+            results = await self.create_results_metadata(session_id, keys, 100)
+        with span(trace, "send_payloads", "submit", tasks=len(payloads)):
+            payload_ids = await self.create_results(
+                session_id, {k: p.to_bytes() for k, p in zip(keys, payloads)}, 20
+            )
+        previous_ids = {}
+        if previous is not None:
+            with span(trace, "send_previous_results", "submit", tasks=len(payloads)):
+                previous_ids = await self.create_results(
+                    session_id,
+                    {k: r.raw for k, r in zip(keys, previous) if r is not None},
+                    20,
+                )
+        options = None
+        if priorities is not None or previous_ids:
+            options = {
+                k: task_options_for(
+                    context.task_options,
+                    priorities[i] - 1 if priorities is not None else 0,
+                    previous_ids.get(k),
+                )
+                for i, k in enumerate(keys)
+            }
+        task_definitions = create_task_definitions(
+            scene_id, payload_ids, results, options, previous_ids
+        )
+        with span(trace, "send_tasks", "submit", tasks=len(payloads)):
+            await self.send_tasks(
+                session_id, list(task_definitions.values()), context.task_options
+            )
+        tiles = {k: tile_key(p) for k, p in zip(keys, payloads)}
+        for k, r in results.items():
+            context.watch(r, tiles[k])
+
+    async def backfill(
+        self, ctx: SharedContext, reporter: FinishedResultsReporter
+    ) -> None:
+        client = ResultsStub(self.channel)
+        result_filter = finished_results_filter(ctx.session_id, reporter.watermark)
+        page = 0
+        total = 1
+        while total > page * 100:
+            response = await client.ListResults(
+                ListResultsRequest(
+                    page=page,
+                    page_size=100,
+                    filters=result_filter.to_disjunction().to_message(),
+                    sort=ListResultsRequest.Sort(
+                        field=RESULT_COMPLETED_AT_FILTER.field,
+                        direction=Direction.ASC,
+                    ),
+                )
+            )
+            total = response.total
+            for r in response.results:
+                reporter.listed(Result.from_message(r))
+            page += 1
+
+    async def follow_results(
+        self, ctx: SharedContext, reporter: FinishedResultsReporter, tasks: dict
+    ) -> None:
+        while True:
+            try:
+                if self.use_polling:
+                    with span(ctx.trace, "backfill", "watcher"):
+                        await self.backfill(ctx, reporter)
+                    await asyncio.sleep(poll_interval(tasks))
+                    continue
+                subscription = EventsStub(self.channel).GetEvents(
+                    EventSubscriptionRequest(
+                        session_id=ctx.session_id,
+                        returned_events=[EVENTS_ENUM_RESULT_STATUS_UPDATE],
+                    )
+                )
+                with span(ctx.trace, "backfill", "watcher"):
+                    await self.backfill(ctx, reporter)
+                async for e in subscription:
+                    instant(
+                        ctx.trace,
+                        "event",
+                        "watcher",
+                        result_id=e.result_status_update.result_id,
+                        status=e.result_status_update.status,
+                    )
+                    reporter.report(
+                        e.result_status_update.result_id,
+                        e.result_status_update.status,
+                    )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Exception while watching results : {e}")
+                await asyncio.sleep(POLL_MIN_INTERVAL)
+
+    async def watch_results(self, ctx: SharedContext) -> None:
+        # Same bookkeeping as start_watcher, a result is retrieved once it's both
+        # watched and completed
+        print("Started watching")
+        followed_tasks = {}
+        statuses = LoopQueue(self.loop, self.thread.ident)
+        reporter = FinishedResultsReporter(statuses, followed_tasks)
+
+        async def watched() -> None:
+            while True:
+                result_id = await ctx.to_watch_queue.get()
+                status = followed_tasks.setdefault(result_id, ResultStatus.UNSPECIFIED)
+                if status == ResultStatus.COMPLETED:
+                    completed(ctx, result_id)
+
+        follower = asyncio.ensure_future(
+            self.follow_results(ctx, reporter, followed_tasks)
+        )
+        watcher = asyncio.ensure_future(watched())
+        try:
+            while True:
+                result_id, result_status = await statuses.get()
+                old_status = followed_tasks.get(result_id, None)
+                followed_tasks[result_id] = result_status
+                if result_status == ResultStatus.ABORTED:
+                    print("ABORTED RESULT")
+                    break
+                if result_status == ResultStatus.COMPLETED and old_status not in [
+                    ResultStatus.COMPLETED,
+                    None,
+                ]:
+                    completed(ctx, result_id)
+        finally:
+            print("Stopping watcher...")
+            follower.cancel()
+            watcher.cancel()
+
+    async def download(
+        self, ctx: SharedContext, result_id: str, slots: asyncio.Semaphore
+    ) -> None:
+        client = ResultsStub(self.channel)
+        try:
+            while True:
+                try:
+                    if ctx.metrics is not None:
+                        ctx.metrics.record(DOWNLOAD_START, result_id)
+                    with span(ctx.trace, "download", "retriever", result_id=result_id):
+                        data = b"".join(
+                            [
+                                chunk.data_chunk
+                                async for chunk in client.DownloadResultData(
+                                    DownloadResultDataRequest(
+                                        result_id=result_id,
+                                        session_id=ctx.session_id,
+                                    )
+                                )
+                            ]
+                        )
+                    if ctx.metrics is not None:
+                        ctx.metrics.record(DOWNLOAD_END, result_id)
+                    # Decoding, framebuffer and cache writes stay off the loop, the
+                    # slot is held until they are done
+                    await asyncio.to_thread(downloaded, ctx, result_id, data)
+                    return
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"Exception while retrieving results : {e}")
+                    await asyncio.sleep(0.5)
+        finally:
+            slots.release()
+
+    async def retrieve_results(self, ctx: SharedContext) -> None:
+        print("Started retrieving")
+        slots = asyncio.Semaphore(self.download_concurrency)
+        downloads = set()
+        try:
+            while True:
+                await slots.acquire()
+                result_id = await ctx.to_retrieve_queue.get()
+                download = asyncio.ensure_future(self.download(ctx, result_id, slots))
+                downloads.add(download)
+                download.add_done_callback(downloads.discard)
+        finally:
+            for download in list(downloads):
+                download.cancel()
+            print("Retriever Exited")
@@ -0,0 +1,104 @@
+from abc import ABC, abstractmethod
+from multiprocessing import JoinableQueue, Process
+from threading import Thread
+from typing import Callable, Dict, List, Optional
+
+from tracer.objects import Payload, Scene, TracerResult
+from tracer.shared_context import SharedContext
+
+
+def ensure_process(
+    process: Optional[Process], target: Callable, *args, daemon: bool = True
+) -> Process:
+    if process is None or (not process.is_alive() and process.pid is not None):
+        # Named after what it runs, for the traces
+        process = Process(target=target, args=args, daemon=daemon, name=target.__name__)
+    if not process.is_alive():
+        process.start()
+    return process
+
+
+class Worker(Thread):
+    # Thread standing in for one of the processes when everything runs in the client
+    # process. It can't be killed, being a daemon it doesn't outlive the client
+    def kill(self) -> None:
+        pass
+
+
+def ensure_thread(thread: Optional[Worker], target: Callable, *args) -> Worker:
+    if thread is None or not thread.is_alive():
+        thread = Worker(target=target, args=args, daemon=True, name=target.__name__)
+        thread.start()
+    return thread
+
+
+# Where the tiles get rendered. The rest of the client (payload generation, display,
+# completion tracking) only goes through these methods, and every backend must feed
+# its results to ctx.to_display_queue and ctx.finalised_queue.
+# Payloads are submitted in the given order, priorities (one per payload, higher
+# goes first) are only a hint for the backends that support them. A previous result
+# given for a payload is refined instead of starting the tile over
+class Backend(ABC):
+    def create_queues(self) -> tuple:
+        # to_watch, to_retrieve, to_display and finalised queues of the shared context
+        return JoinableQueue(), JoinableQueue(), JoinableQueue(), JoinableQueue()
+
+    @abstractmethod
+    def create_context(self, context: SharedContext, error_threshold: float) -> None:
+        pass
+
+    @abstractmethod
+    def send_scene(self, context: SharedContext, scene: Scene) -> str:
+        pass
+
+    def start_processes(
+        self, context: SharedContext, processes: Dict[str, Optional[Process]]
+    ) -> Dict[str, Process]:
+        return {}
+
+    @abstractmethod
+    def submit(
+        self,
+        context: SharedContext,
+        scene_id: str,
+        payloads: List[Payload],
+        priorities: Optional[List[int]] = None,
+        previous: Optional[List[Optional[TracerResult]]] = None,
+    ) -> None:
+        pass
+
+    def session_info(self, context: SharedContext) -> dict:
+        return {"session_id": context.session_id}
+
+    def reattach(self, context: SharedContext, session: dict) -> Optional[str]:
+        # Returns the scene id if the session saved by session_info is still running,
+        # None when it has to be started over
+        return None
+
+    def stop(self, context: SharedContext, processes: Dict[str, Process]) -> None:
+        pass
+
+    def cancel(self, context: SharedContext) -> None:
+        pass
+
+    def cancel_pending(self, context: SharedContext) -> int:
+        # Cancels the tasks that didn't complete yet, the session stays usable.
+        # Called once the results are no longer watched, returns how many there were
+        return 0
+
+    def cleanup(self, context: SharedContext) -> None:
+        pass
+
+
+def create_backend(args) -> Backend:
+    if args.backend == "local":
+        from tracer.local_backend import LocalBackend
+
+        return LocalBackend(args)
+    if args.runtime == "async":
+        from tracer.async_backend import AsyncArmoniKBackend
+
+        return AsyncArmoniKBackend(args)
+    from tracer.armonik_backend import ArmoniKBackend
+
+    return ArmoniKBackend(args)
@@ -0,0 +1,129 @@
+from colorsys import hsv_to_rgb
+from queue import Empty
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from tracer.adaptive import TileKey, tile_key
+from tracer.framebuffer import FrameBuffer, TileUpdate
+from tracer.metrics import DISPLAYED, MetricsRecorder
+from tracer.tonemap import ToneMapper
+
+
+def color_from_samples(
+    n_samples: int,
+    min_samples: int,
+    max_samples: int,
+    from_hue: float = 0.66,
+    to_hue: float = 0.0,
+) -> Tuple[int, int, int]:
+    n_samples = max(min(n_samples, max_samples), min_samples)
+    factor = (n_samples - min_samples) / (max_samples - min_samples)
+    rgb = hsv_to_rgb(to_hue * factor + from_hue * (1 - factor), 1.0, 1.0)
+    return int(rgb[2] * 255), int(rgb[1] * 255), int(rgb[0] * 255)
+
+
+class Compositor:
+    # Builds the displayed image from the framebuffer. Updates are drained from the
+    # queue in bulk and only the newest one of each tile is kept, the samples are read
+    # from the framebuffer anyway so the intermediate ones have nothing to add.
+    # Only the updated tiles are tone mapped, the whole frame is when the tone
+    # mapping changes.
+    # The sample count outlines of the unfinished tiles live in their own layer,
+    # blended over the tiles they belong to
+    def __init__(
+        self,
+        framebuffer: FrameBuffer,
+        tone_mapper: Optional[ToneMapper] = None,
+        max_batch: int = 4096,
+        metrics: Optional[MetricsRecorder] = None,
+    ):
+        self.framebuffer = framebuffer
+        self.tone_mapper = tone_mapper if tone_mapper is not None else ToneMapper()
+        self.max_batch = max_batch
+        self.metrics = metrics
+        shape = (framebuffer.height, framebuffer.width)
+        self.image = np.zeros((*shape, 3), np.uint8)
+        self.overlay = np.zeros((*shape, 3), np.uint8)
+        self.overlay_mask = np.zeros(shape, np.bool_)
+        self.show_overlay = True
+        self.pending: Dict[TileKey, TileUpdate] = {}
+        # Results of every update folded into the pending one of a tile, all of them
+        # are displayed when it is
+        self.result_ids: Dict[TileKey, List[str]] = {}
+
+    def drain(self, queue, timeout: float) -> int:
+        # Waits at most timeout for the first update, then takes whatever is queued
+        n = 0
+        try:
+            update = queue.get(timeout=timeout)
+            while True:
+                self.push(update)
+                queue.task_done()
+                n += 1
+                if n >= self.max_batch:
+                    break
+                update = queue.get_nowait()
+        except Empty:
+            pass
+        return n
+
+    def push(self, update: TileUpdate) -> None:
+        # Results of a tile can be downloaded out of order, the most sampled one wins
+        key = tile_key(update)
+        if self.metrics is not None and update.result_id:
+            self.result_ids.setdefault(key, []).append(update.result_id)
+        current = self.pending.get(key)
+        if current is None or (
+            update.is_final,
+            update.n_samples_per_pixel,
+        ) >= (current.is_final, current.n_samples_per_pixel):
+            self.pending[key] = update
+
+    def compose(self) -> bool:
+        if not self.pending:
+            return False
+        for key, update in self.pending.items():
+            rows, cols = self.framebuffer.region(update)
+            self.overlay_mask[rows, cols] = False
+            if not update.is_final:
+                self.draw_outline(update, rows, cols)
+            self.blit(rows, cols)
+            if self.metrics is not None:
+                for result_id in self.result_ids.pop(key, []):
+                    self.metrics.record(DISPLAYED, result_id)
+        self.pending.clear()
+        return True
+
+    def draw_outline(self, update: TileUpdate, rows: slice, cols: slice) -> None:
+        color = color_from_samples(update.n_samples_per_pixel, 100, 500)
+        self.overlay[rows.start, cols] = color
+        self.overlay[rows.stop - 1, cols] = color
+        self.overlay[rows, cols.start] = color
+        self.overlay[rows, cols.stop - 1] = color
+        self.overlay_mask[rows.start, cols] = True
+        self.overlay_mask[rows.stop - 1, cols] = True
+        self.overlay_mask[rows, cols.start] = True
+        self.overlay_mask[rows, cols.stop - 1] = True
+
+    def blit(self, rows: slice, cols: slice) -> None:
+        self.image[rows, cols] = self.tone_mapper(self.framebuffer.samples[rows, cols])
+        if self.show_overlay:
+            np.copyto(
+                self.image[rows, cols],
+                self.overlay[rows, cols],
+                where=self.overlay_mask[rows, cols, None],
+            )
+
+    def toggle_overlay(self) -> None:
+        self.show_overlay = not self.show_overlay
+        self.refresh()
+
+    def refresh(self) -> None:
+        self.blit(slice(None), slice(None))
+
+    def clear(self) -> None:
+        self.pending.clear()
+        self.result_ids.clear()
+        self.image.fill(0)
+        self.overlay_mask.fill(False)
@@ -0,0 +1,68 @@
+from typing import Optional
+
+import numpy as np
+
+from tracer.framebuffer import FrameBuffer, TileUpdate
+
+
+class ConvergenceController:
+    # Image-wide stopping rule on top of the per-tile one of the workers. The error
+    # of each tile (mean squared difference between its last two passes, on the
+    # 0-255 scale of errorMetricThreshold) is spread over its pixels, rendering stops
+    # once the mean over the image is under the quality target, or once the image
+    # got the sample budget on average. Pixels without an estimate yet keep the image
+    # from converging
+    def __init__(
+        self,
+        framebuffer: FrameBuffer,
+        quality_target: Optional[float] = None,
+        sample_budget: Optional[float] = None,
+    ):
+        self.framebuffer = framebuffer
+        self.quality_target = quality_target
+        self.sample_budget = sample_budget
+        self.n_pixels = framebuffer.height * framebuffer.width
+        self.counts = framebuffer.counts.copy()
+        self.sample_sum = int(self.counts.sum())
+        # What was rendered before (a resumed journal) passed the per-tile rule, it
+        # is assumed to be at the target
+        self.known = self.counts > 0
+        self.errors = np.where(self.known, quality_target or 0.0, 0.0)
+        self.error_sum = float(self.errors.sum())
+        self.known_pixels = int(self.known.sum())
+
+    def observe(self, update: TileUpdate) -> None:
+        region = self.framebuffer.region(update)
+        counts = self.framebuffer.counts[region]
+        self.sample_sum += int(counts.sum()) - int(self.counts[region].sum())
+        self.counts[region] = counts
+        if update.errors is None:
+            return
+        self.error_sum += update.error * counts.size - float(self.errors[region].sum())
+        self.known_pixels += counts.size - int(self.known[region].sum())
+        self.errors[region] = update.error
+        self.known[region] = True
+
+    @property
+    def error(self) -> float:
+        if self.known_pixels < self.n_pixels:
+            return np.inf
+        return self.error_sum / self.n_pixels
+
+    @property
+    def samples_per_pixel(self) -> float:
+        return self.sample_sum / self.n_pixels
+
+    def converged(self) -> Optional[str]:
+        # Why rendering can stop, None while it can't
+        if self.quality_target is not None and self.error <= self.quality_target:
+            return f"image error {self.error:.2f} under {self.quality_target}"
+        if (
+            self.sample_budget is not None
+            and self.samples_per_pixel >= self.sample_budget
+        ):
+            return (
+                f"{self.samples_per_pixel:.1f} samples per pixel, "
+                f"budget of {self.sample_budget}"
+            )
+        return None
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import math
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from tracer.adaptive import TileKey, tile_key
+from tracer.framebuffer import TileUpdate
+from tracer.local_engine import LocalScene, camera_rays, trace
+from tracer.objects import Payload, Scene
+
+DEFAULT_COST_DIR = os.path.join("~", ".cache", "pitracer", "costs")
+PROBE_STRIDE = 8
+PRIORITY_LEVELS = 4
+SMOOTHING = 0.5
+
+
+def scene_hash(scene: Scene) -> str:
+    return hashlib.sha256(scene.to_bytes()).hexdigest()[:16]
+
+
+def probe_scene(scene: Scene, stride: int = PROBE_STRIDE, seed: int = 0) -> np.ndarray:
+    # One sample every stride pixels in each direction, rendered locally to count
+    # the intersection tests, a good proxy of the cost of a pixel on the workers
+    local_scene = LocalScene(scene)
+    rows = np.arange(0, scene.img_height, stride)
+    cols = np.arange(0, scene.img_width, stride)
+    pixels = (rows[:, None] * scene.img_width + cols).ravel()
+    rng = np.random.default_rng(seed)
+    origins, directions = camera_rays(
+        local_scene, Payload(0, 0, scene.img_width, scene.img_height, 1), pixels, rng
+    )
+    rays = np.zeros(len(pixels), np.int64)
+    trace(
+        local_scene, origins, directions, np.arange(len(pixels)), len(pixels), rng, rays
+    )
+    return rays.reshape(len(rows), len(cols)).astype(np.float64)
+
+
+def smooth(previous: Optional[float], value: float) -> float:
+    if previous is None:
+        return value
+    return SMOOTHING * value + (1 - SMOOTHING) * previous
+
+
+class CostModel:
+    # Estimated cost of each tile in seconds per sample. Tiles that were rendered
+    # before use their measured time, the others are estimated from the probe,
+    # scaled by the measured seconds per intersection test.
+    # Measurements are the time between the submission of a tile (or the previous
+    # completion, if later, since the tasks queue up behind each other) and its
+    # completion
+    def __init__(self, path: str, probe: Optional[np.ndarray] = None):
+        self.path = path
+        self.probe = probe
+        self.stride = PROBE_STRIDE
+        self.costs: Dict[TileKey, float] = {}
+        self.seconds_per_ray: Optional[float] = None
+        self.submitted: Dict[TileKey, Tuple[float, int]] = {}
+        self.last_completion = 0.0
+
+    @classmethod
+    def for_scene(cls, scene: Scene, cost_dir: str = DEFAULT_COST_DIR) -> "CostModel":
+        model = cls(
+            os.path.join(os.path.expanduser(cost_dir), f"{scene_hash(scene)}.json")
+        )
+        if os.path.exists(model.path):
+            print(f"Loading tile costs from {model.path}")
+            model.load()
+        else:
+            print("Probing scene costs...")
+            model.probe = probe_scene(scene)
+        return model
+
+    def probed_rays(self, key: TileKey) -> float:
+        coord_x, coord_y, width, height = key
+        row = coord_x // self.stride
+        col = coord_y // self.stride
+        cells = self.probe[
+            row : max(row + 1, math.ceil((coord_x + height) / self.stride)),
+            col : max(col + 1, math.ceil((coord_y + width) / self.stride)),
+        ]
+        return float(cells.mean()) * width * height if cells.size else 0.0
+
+    def estimate(self, key: TileKey) -> float:
+        if key in self.costs:
+            return self.costs[key]
+        if self.probe is not None:
+            return self.probed_rays(key) * (self.seconds_per_ray or 1.0)
+        if self.costs:
+            # Unknown tile shape, fall back on the mean cost of a pixel
+            per_pixel = [c / (k[2] * k[3]) for k, c in self.costs.items()]
+            return float(np.mean(per_pixel)) * key[2] * key[3]
+        return float(key[2] * key[3])
+
+    def order(self, payloads: List[Payload]) -> List[Payload]:
+        # Longest job first, sorted is stable so equal costs keep their order
+        return sorted(payloads, key=lambda p: -self.estimate(tile_key(p)) * p.samples)
+
+    def priorities(self, payloads: List[Payload]) -> List[int]:
+        costs = [self.estimate(tile_key(p)) * p.samples for p in payloads]
+        # Tiles costing the same share the same priority
+        ranks = np.searchsorted(np.sort(costs), costs)
+        return [1 + int(r * PRIORITY_LEVELS // len(payloads)) for r in ranks]
+
+    def on_submit(self, payloads: List[Payload]) -> None:
+        now = time.perf_counter()
+        for p in payloads:
+            self.submitted[tile_key(p)] = now, p.samples
+
+    def observe(self, update: TileUpdate) -> None:
+        now = time.perf_counter()
+        key = tile_key(update)
+        if key in self.submitted:
+            submitted, samples = self.submitted.pop(key)
+            cost = (now - max(submitted, self.last_completion)) / max(1, samples)
+            self.costs[key] = smooth(self.costs.get(key), cost)
+            rays = self.probed_rays(key) if self.probe is not None else 0.0
+            if rays > 0:
+                self.seconds_per_ray = smooth(self.seconds_per_ray, cost / rays)
+            if not update.is_final:
+                # The worker submits the follow-up task when it completes this one
+                self.submitted[key] = now, samples
+        self.last_completion = now
+
+    def load(self) -> None:
+        with open(self.path) as f:
+            data = json.load(f)
+        self.costs = {
+            tuple(int(v) for v in k.split("_")): c for k, c in data["costs"].items()
+        }
+        self.seconds_per_ray = data.get("seconds_per_ray")
+        if data.get("probe") is not None:
+            self.stride = data["stride"]
+            self.probe = np.array(data["probe"], np.float64)
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        data = {
+            "costs": {"_".join(map(str, k)): c for k, c in self.costs.items()},
+            "seconds_per_ray": self.seconds_per_ray,
+            "stride": self.stride,
+            "probe": self.probe.tolist() if self.probe is not None else None,
+        }
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+        print(f"Tile costs saved to {self.path}")
@@ -0,0 +1,107 @@
+import time
+from typing import Dict, List, Optional, Tuple
+
+from tracer.adaptive import TileKey, tile_key
+from tracer.cost_model import PRIORITY_LEVELS, smooth
+from tracer.framebuffer import TileUpdate
+from tracer.objects import Payload
+
+# Share of the time left a single pass may take, so that the last passes still come
+# back before the deadline
+PASS_FRACTION = 0.5
+
+
+class DeadlinePlanner:
+    # Best image by the deadline rather than every tile under the threshold. The
+    # client drives the refinement: each returned tile is sent again with the number
+    # of samples that brings it to the level the whole image can reach by the
+    # deadline, at the throughput measured so far. The further below that level a
+    # tile is, the higher its priority, more so as the deadline nears. Past the
+    # deadline (or when a pass would no longer come back in time) nothing is sent
+    # and the render ends with what is in the framebuffer
+    def __init__(
+        self,
+        payloads: List[Payload],
+        deadline: float,
+        max_samples: int = 4096,
+    ):
+        self.start = time.perf_counter()
+        self.deadline = self.start + deadline
+        self.max_samples = max_samples
+        self.base_samples = max(p.samples for p in payloads)
+        self.n_pixels = sum(p.task_width * p.task_height for p in payloads)
+        self.samples: Dict[TileKey, int] = {}
+        # Sum of the samples of all the pixels
+        self.sample_sum = 0
+        self.in_flight: Dict[TileKey, Tuple[float, int]] = {}
+        self.pixel_samples = 0
+        # Seconds per pixel sample of a task, and between the submission of a task
+        # and its result
+        self.task_cost: Optional[float] = None
+        self.latency: Optional[float] = None
+        self.on_submit(payloads)
+
+    @property
+    def remaining(self) -> float:
+        return self.deadline - time.perf_counter()
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining <= 0
+
+    @property
+    def done(self) -> bool:
+        return self.expired or not self.in_flight
+
+    @property
+    def throughput(self) -> float:
+        # Pixel samples per second over the whole render
+        return self.pixel_samples / max(1e-6, time.perf_counter() - self.start)
+
+    def on_submit(self, payloads: List[Payload]) -> None:
+        now = time.perf_counter()
+        for p in payloads:
+            self.in_flight[tile_key(p)] = now, p.samples
+
+    def target(self) -> float:
+        # Samples per pixel the image can reach by the deadline
+        return (
+            self.sample_sum + self.throughput * max(0.0, self.remaining)
+        ) / self.n_pixels
+
+    def priority(self, samples: int, target: float) -> int:
+        deficit = max(0.0, min(1.0, (target - samples) / target)) if target else 0.0
+        urgency = min(1.0, 1 - self.remaining / (self.deadline - self.start))
+        return 1 + round(deficit * urgency * (PRIORITY_LEVELS - 1))
+
+    def update(self, update: TileUpdate) -> List[Tuple[Payload, int]]:
+        # Next pass of the tile with its priority, if it has one
+        key = tile_key(update)
+        if key not in self.in_flight:
+            return []
+        now = time.perf_counter()
+        submitted, samples = self.in_flight.pop(key)
+        area = key[2] * key[3]
+        self.pixel_samples += area * samples
+        self.task_cost = smooth(self.task_cost, (now - submitted) / (area * samples))
+        self.latency = smooth(self.latency, now - submitted)
+        self.sample_sum += area * (
+            update.n_samples_per_pixel - self.samples.get(key, 0)
+        )
+        self.samples[key] = update.n_samples_per_pixel
+        if update.n_samples_per_pixel >= self.max_samples:
+            return []
+        if self.remaining < self.latency:
+            return []
+        target = self.target()
+        fit = int(self.remaining * PASS_FRACTION / (self.task_cost * area))
+        samples = min(
+            max(int(target) - update.n_samples_per_pixel, self.base_samples),
+            fit,
+            self.max_samples - update.n_samples_per_pixel,
+        )
+        if samples <= 0:
+            return []
+        payload = Payload(*key, samples)
+        self.on_submit([payload])
+        return [(payload, self.priority(update.n_samples_per_pixel, target))]
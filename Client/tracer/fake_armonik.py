@@ -0,0 +1,973 @@
+import argparse
+import heapq
+import itertools
+import operator
+import random
+import signal
+import struct
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from queue import Empty, Queue
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import grpc
+import numpy as np
+from armonik.common import ResultStatus, TaskStatus
+from armonik.protogen.client.events_service_pb2_grpc import (
+    EventsServicer,
+    add_EventsServicer_to_server,
+)
+from armonik.protogen.client.results_service_pb2_grpc import (
+    ResultsServicer,
+    add_ResultsServicer_to_server,
+)
+from armonik.protogen.client.sessions_service_pb2_grpc import (
+    SessionsServicer,
+    add_SessionsServicer_to_server,
+)
+from armonik.protogen.client.tasks_service_pb2_grpc import (
+    TasksServicer,
+    add_TasksServicer_to_server,
+)
+from armonik.protogen.common.events_common_pb2 import (
+    EVENTS_ENUM_RESULT_STATUS_UPDATE,
+    EVENTS_ENUM_TASK_STATUS_UPDATE,
+    EventSubscriptionResponse,
+)
+from armonik.protogen.common.objects_pb2 import TaskOptions
+from armonik.protogen.common.results_common_pb2 import (
+    CreateResultsMetaDataResponse,
+    CreateResultsResponse,
+    DownloadResultDataResponse,
+    GetOwnerTaskIdResponse,
+    GetResultResponse,
+    ListResultsResponse,
+    ResultRaw,
+    ResultsServiceConfigurationResponse,
+)
+from armonik.protogen.common.results_fields_pb2 import (
+    RESULT_RAW_ENUM_FIELD_COMPLETED_AT,
+    RESULT_RAW_ENUM_FIELD_CREATED_AT,
+    RESULT_RAW_ENUM_FIELD_NAME,
+    RESULT_RAW_ENUM_FIELD_OWNER_TASK_ID,
+    RESULT_RAW_ENUM_FIELD_RESULT_ID,
+    RESULT_RAW_ENUM_FIELD_SESSION_ID,
+    RESULT_RAW_ENUM_FIELD_SIZE,
+    RESULT_RAW_ENUM_FIELD_STATUS,
+)
+from armonik.protogen.common.session_status_pb2 import (
+    SESSION_STATUS_CANCELLED,
+    SESSION_STATUS_CLOSED,
+    SESSION_STATUS_DELETED,
+    SESSION_STATUS_PURGED,
+    SESSION_STATUS_RUNNING,
+)
+from armonik.protogen.common.sessions_common_pb2 import (
+    CancelSessionResponse,
+    CloseSessionResponse,
+    CreateSessionReply,
+    DeleteSessionResponse,
+    GetSessionResponse,
+    PurgeSessionResponse,
+    SessionRaw,
+)
+from armonik.protogen.common.tasks_common_pb2 import (
+    CancelTasksResponse,
+    SubmitTasksResponse,
+    TaskSummary,
+)
+from armonik.protogen.common.sort_direction_pb2 import SORT_DIRECTION_DESC
+from google.protobuf.timestamp_pb2 import Timestamp
+
+from tracer.local_engine import LocalScene, compute_payload, encode_result
+from tracer.objects import Payload, Scene, TracerResult
+
+# Size of the chunks of the result downloads
+DATA_CHUNK_SIZE = 1 << 16
+# Priority of the follow-up tasks, as set by SampleComputerService
+FOLLOW_UP_PRIORITY = 8
+DEFAULT_ERROR_THRESHOLD = 10.0
+PAYLOAD = struct.Struct("<5i")
+
+# Result, payload and previous result of a task, its error threshold, returns the
+# TracerResult bytes, the next result id is filled in afterwards
+Renderer = Callable[[str, bytes, Payload, Optional[TracerResult], float], bytes]
+
+
+class StubRenderer:
+    # No tracing: each tile gets a flat color picked from its position, plus noise
+    # shrinking with the samples, and is final once it went through passes tasks
+    def __init__(self, passes: int = 2):
+        self.passes = passes
+
+    def __call__(
+        self,
+        scene_id: str,
+        scene: bytes,
+        payload: Payload,
+        previous: Optional[TracerResult],
+        error_threshold: float,
+    ) -> bytes:
+        n_previous = previous.n_samples_per_pixel if previous is not None else 0
+        n_next = payload.samples + n_previous
+        color = np.random.default_rng((payload.coord_x, payload.coord_y)).uniform(
+            0.2, 0.8, 3
+        )
+        noise = np.random.default_rng().normal(
+            0.0, 0.2 / np.sqrt(n_next), (payload.task_height * payload.task_width, 3)
+        )
+        samples = np.clip(color + noise, 0.0, 1.0).astype(np.float32)
+        return encode_result(
+            payload, n_next, n_next >= self.passes * payload.samples, samples
+        )
+
+
+class EngineRenderer:
+    # The local CPU engine, scenes are parsed once per scene result
+    def __init__(self):
+        self.scenes: Dict[str, LocalScene] = {}
+        self.lock = threading.Lock()
+
+    def __call__(
+        self,
+        scene_id: str,
+        scene: bytes,
+        payload: Payload,
+        previous: Optional[TracerResult],
+        error_threshold: float,
+    ) -> bytes:
+        with self.lock:
+            if scene_id not in self.scenes:
+                self.scenes[scene_id] = LocalScene(Scene.from_bytes(scene))
+            local_scene = self.scenes[scene_id]
+        return compute_payload(local_scene, payload, previous, error_threshold)
+
+
+RENDERERS: Dict[str, Callable[[], Renderer]] = {
+    "stub": StubRenderer,
+    "engine": EngineRenderer,
+}
+
+
+@dataclass
+class Faults:
+    # Latencies in seconds, rates as the probability of each call or execution
+    task_latency: float = 0.0
+    task_jitter: float = 0.0
+    rpc_latency: float = 0.0
+    # Failed executions are retried up to the max_retries of the task, then its
+    # results are aborted
+    task_failure_rate: float = 0.0
+    download_failure_rate: float = 0.0
+    # Event streams are cut after an event with this probability
+    stream_drop_rate: float = 0.0
+
+
+@dataclass
+class FakeSession:
+    session_id: str
+    options: TaskOptions
+    status: int = SESSION_STATUS_RUNNING
+    created_at: float = field(default_factory=time.time)
+
+
+@dataclass
+class FakeResult:
+    result_id: str
+    session_id: str
+    name: str
+    status: int = ResultStatus.CREATED
+    data: Optional[bytes] = None
+    owner_task_id: str = ""
+    created_at: float = field(default_factory=time.time)
+    completed_at: Optional[float] = None
+
+    def to_message(self) -> ResultRaw:
+        message = ResultRaw(
+            session_id=self.session_id,
+            name=self.name,
+            owner_task_id=self.owner_task_id,
+            status=self.status,
+            created_at=timestamp(self.created_at),
+            result_id=self.result_id,
+            size=len(self.data) if self.data is not None else 0,
+        )
+        if self.completed_at is not None:
+            message.completed_at.CopyFrom(timestamp(self.completed_at))
+        return message
+
+
+@dataclass
+class FakeTask:
+    task_id: str
+    session_id: str
+    payload_id: str
+    data_dependencies: List[str]
+    expected_output_ids: List[str]
+    options: TaskOptions
+    status: int = TaskStatus.SUBMITTED
+    retries: int = 0
+    created_at: float = field(default_factory=time.time)
+
+    def to_summary(self) -> TaskSummary:
+        return TaskSummary(
+            id=self.task_id,
+            session_id=self.session_id,
+            status=self.status,
+            options=self.options,
+            created_at=timestamp(self.created_at),
+            count_data_dependencies=len(self.data_dependencies),
+            count_expected_output_ids=len(self.expected_output_ids),
+        )
+
+
+def timestamp(t: float) -> Timestamp:
+    ts = Timestamp()
+    ts.FromNanoseconds(int(t * 1e9))
+    return ts
+
+
+def seconds(ts: Timestamp) -> float:
+    return ts.seconds + ts.nanos * 1e-9
+
+
+RESULT_FIELDS: Dict[int, Callable[[FakeResult], object]] = {
+    RESULT_RAW_ENUM_FIELD_SESSION_ID: lambda r: r.session_id,
+    RESULT_RAW_ENUM_FIELD_NAME: lambda r: r.name,
+    RESULT_RAW_ENUM_FIELD_OWNER_TASK_ID: lambda r: r.owner_task_id,
+    RESULT_RAW_ENUM_FIELD_STATUS: lambda r: r.status,
+    RESULT_RAW_ENUM_FIELD_CREATED_AT: lambda r: r.created_at,
+    RESULT_RAW_ENUM_FIELD_COMPLETED_AT: lambda r: r.completed_at,
+    RESULT_RAW_ENUM_FIELD_RESULT_ID: lambda r: r.result_id,
+    RESULT_RAW_ENUM_FIELD_SIZE: lambda r: len(r.data) if r.data is not None else 0,
+}
+# Indexed by the operator enums of filters_common.proto
+STRING_OPERATORS = [
+    operator.eq,
+    operator.ne,
+    operator.contains,
+    lambda a, b: b not in a,
+    str.startswith,
+    str.endswith,
+]
+ORDER_OPERATORS = [
+    operator.eq,
+    operator.ne,
+    operator.lt,
+    operator.le,
+    operator.ge,
+    operator.gt,
+]
+
+
+def field_matches(value, condition) -> bool:
+    kind = condition.WhichOneof("value_condition")
+    if kind == "filter_string":
+        f = condition.filter_string
+        return STRING_OPERATORS[f.operator](value, f.value)
+    if kind == "filter_status":
+        f = condition.filter_status
+        return (value == f.value) != bool(f.operator)
+    if kind == "filter_date":
+        # Results that are not completed have no date to compare
+        f = condition.filter_date
+        return value is not None and ORDER_OPERATORS[f.operator](
+            value, seconds(f.value)
+        )
+    if kind == "filter_number":
+        f = condition.filter_number
+        return ORDER_OPERATORS[f.operator](value, f.value)
+    raise ValueError(f"Unsupported filter {kind}")
+
+
+def result_matches(result: FakeResult, filters) -> bool:
+    # Disjunction of conjunctions, no condition at all matches everything
+    if not filters.ListFields():
+        return True
+    return any(
+        all(
+            field_matches(
+                RESULT_FIELDS[condition.field.result_raw_field.field](result),
+                condition,
+            )
+            for condition in getattr(conjunction, "and")
+        )
+        for conjunction in getattr(filters, "or")
+    )
+
+
+class FakeArmoniK:
+    # Sessions, results and tasks of an ArmoniK control plane, kept in memory.
+    # Tasks run on a pool of threads, highest priority first, once all their data
+    # dependencies are completed. They behave like SampleComputerService: a task
+    # whose tile is not final submits the follow-up task refining it, with the
+    # previous result in its options, before completing its own result
+    def __init__(
+        self,
+        renderer: Renderer,
+        workers: int = 4,
+        faults: Optional[Faults] = None,
+        seed: Optional[int] = None,
+    ):
+        self.renderer = renderer
+        self.faults = faults if faults is not None else Faults()
+        self.random = random.Random(seed)
+        self.lock = threading.Condition()
+        self.sessions: Dict[str, FakeSession] = {}
+        self.results: Dict[str, FakeResult] = {}
+        self.tasks: Dict[str, FakeTask] = {}
+        # Tasks waiting for each result, and the number of results each one waits for
+        self.dependents: Dict[str, List[str]] = {}
+        self.missing: Dict[str, int] = {}
+        self.ready: List[Tuple[int, int, str]] = []
+        self.sequence = itertools.count()
+        self.subscribers: List[Tuple[str, Set[int], Queue]] = []
+        self.running = True
+        self.workers = [
+            threading.Thread(target=self.work, daemon=True) for _ in range(workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self) -> None:
+        with self.lock:
+            self.running = False
+            self.lock.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+    def delay(self) -> None:
+        if self.faults.rpc_latency > 0:
+            time.sleep(self.faults.rpc_latency)
+
+    def fails(self, rate: float) -> bool:
+        return rate > 0 and self.random.random() < rate
+
+    # Everything below expects the lock to be held
+
+    def session(self, session_id: str) -> FakeSession:
+        if session_id not in self.sessions:
+            raise KeyError(f"Session {session_id} not found")
+        return self.sessions[session_id]
+
+    def result(self, result_id: str) -> FakeResult:
+        if result_id not in self.results:
+            raise KeyError(f"Result {result_id} not found")
+        return self.results[result_id]
+
+    def task(self, task_id: str) -> FakeTask:
+        if task_id not in self.tasks:
+            raise KeyError(f"Task {task_id} not found")
+        return self.tasks[task_id]
+
+    def notify(self, session_id: str, kind: int, event) -> None:
+        for subscribed, kinds, events in self.subscribers:
+            if subscribed == session_id and (not kinds or kind in kinds):
+                events.put(event)
+
+    def create_session(self, options: TaskOptions) -> FakeSession:
+        session = FakeSession(str(uuid.uuid4()), options)
+        self.sessions[session.session_id] = session
+        return session
+
+    def create_result(
+        self, session_id: str, name: str, data: Optional[bytes] = None
+    ) -> FakeResult:
+        self.session(session_id)
+        result = FakeResult(str(uuid.uuid4()), session_id, name)
+        self.results[result.result_id] = result
+        if data is not None:
+            self.complete_result(result, data)
+        return result
+
+    def set_result_status(self, result: FakeResult, status: int) -> None:
+        result.status = status
+        self.notify(
+            result.session_id,
+            EVENTS_ENUM_RESULT_STATUS_UPDATE,
+            EventSubscriptionResponse(
+                session_id=result.session_id,
+                result_status_update=EventSubscriptionResponse.ResultStatusUpdate(
+                    result_id=result.result_id, status=status
+                ),
+            ),
+        )
+
+    def set_task_status(self, task: FakeTask, status: int) -> None:
+        task.status = status
+        self.notify(
+            task.session_id,
+            EVENTS_ENUM_TASK_STATUS_UPDATE,
+            EventSubscriptionResponse(
+                session_id=task.session_id,
+                task_status_update=EventSubscriptionResponse.TaskStatusUpdate(
+                    task_id=task.task_id, status=status
+                ),
+            ),
+        )
+
+    def complete_result(self, result: FakeResult, data: bytes) -> None:
+        result.data = data
+        result.completed_at = time.time()
+        self.set_result_status(result, ResultStatus.COMPLETED)
+        for task_id in self.dependents.pop(result.result_id, []):
+            self.missing[task_id] -= 1
+            if self.missing[task_id] == 0:
+                del self.missing[task_id]
+                self.enqueue(self.tasks[task_id])
+
+    def abort_result(self, result: FakeResult) -> None:
+        if result.status == ResultStatus.CREATED:
+            self.set_result_status(result, ResultStatus.ABORTED)
+
+    def enqueue(self, task: FakeTask) -> None:
+        heapq.heappush(
+            self.ready, (-task.options.priority, next(self.sequence), task.task_id)
+        )
+        self.lock.notify()
+
+    def submit_task(
+        self,
+        session_id: str,
+        payload_id: str,
+        data_dependencies: List[str],
+        expected_output_ids: List[str],
+        options: TaskOptions,
+    ) -> FakeTask:
+        task = FakeTask(
+            str(uuid.uuid4()),
+            session_id,
+            payload_id,
+            list(data_dependencies),
+            list(expected_output_ids),
+            options,
+        )
+        for result_id in expected_output_ids:
+            self.result(result_id).owner_task_id = task.task_id
+        self.tasks[task.task_id] = task
+        missing = [
+            r
+            for r in {payload_id, *data_dependencies}
+            if self.result(r).status != ResultStatus.COMPLETED
+        ]
+        if missing:
+            self.missing[task.task_id] = len(missing)
+            for result_id in missing:
+                self.dependents.setdefault(result_id, []).append(task.task_id)
+        else:
+            self.enqueue(task)
+        return task
+
+    def cancel_task(self, task: FakeTask) -> None:
+        # Queued tasks are skipped by the workers, running ones are dropped when done
+        if task.status in (TaskStatus.SUBMITTED, TaskStatus.PROCESSING):
+            self.set_task_status(task, TaskStatus.CANCELLED)
+            for result_id in task.expected_output_ids:
+                self.abort_result(self.results[result_id])
+
+    def cancel_session(self, session: FakeSession) -> None:
+        session.status = SESSION_STATUS_CANCELLED
+        for task in list(self.tasks.values()):
+            if task.session_id == session.session_id:
+                self.cancel_task(task)
+
+    def purge_session(self, session: FakeSession) -> None:
+        session.status = SESSION_STATUS_PURGED
+        for result in self.results.values():
+            if result.session_id == session.session_id:
+                result.data = None
+
+    def delete_session(self, session: FakeSession) -> None:
+        session.status = SESSION_STATUS_DELETED
+        del self.sessions[session.session_id]
+        self.results = {
+            k: r for k, r in self.results.items() if r.session_id != session.session_id
+        }
+        self.tasks = {
+            k: t for k, t in self.tasks.items() if t.session_id != session.session_id
+        }
+
+    def task_counts(self) -> Dict[str, int]:
+        return dict(Counter(TaskStatus(t.status).name for t in self.tasks.values()))
+
+    # Workers
+
+    def work(self) -> None:
+        while True:
+            with self.lock:
+                while self.running and not self.ready:
+                    self.lock.wait()
+                if not self.running:
+                    return
+                _, _, task_id = heapq.heappop(self.ready)
+                task = self.tasks.get(task_id)
+                if task is None or task.status != TaskStatus.SUBMITTED:
+                    continue
+                self.set_task_status(task, TaskStatus.PROCESSING)
+                try:
+                    inputs = self.task_inputs(task)
+                except KeyError as e:
+                    self.task_failed(task, e)
+                    continue
+            try:
+                output = self.execute(task, *inputs)
+            except Exception as e:
+                with self.lock:
+                    self.task_failed(task, e)
+                continue
+            with self.lock:
+                self.task_done(task, output)
+
+    def task_inputs(self, task: FakeTask) -> tuple:
+        options = task.options.options
+        scene_id = options["sceneId"]
+        previous_id = options.get("previous", "")
+        previous = self.results.get(previous_id) if previous_id else None
+        return (
+            scene_id,
+            self.results[scene_id].data,
+            self.results[task.payload_id].data,
+            previous.data if previous is not None else None,
+        )
+
+    def execute(
+        self,
+        task: FakeTask,
+        scene_id: str,
+        scene: bytes,
+        payload: bytes,
+        previous: Optional[bytes],
+    ) -> bytearray:
+        faults = self.faults
+        if faults.task_latency > 0 or faults.task_jitter > 0:
+            time.sleep(
+                max(0.0, self.random.gauss(faults.task_latency, faults.task_jitter))
+            )
+        if self.fails(faults.task_failure_rate):
+            raise RuntimeError("Injected task failure")
+        options = task.options.options
+        try:
+            error_threshold = float(options.get("errorMetricThreshold", ""))
+        except ValueError:
+            error_threshold = DEFAULT_ERROR_THRESHOLD
+        output = bytearray(
+            self.renderer(
+                scene_id,
+                scene,
+                Payload(*PAYLOAD.unpack_from(payload)),
+                TracerResult(previous) if previous is not None else None,
+                error_threshold,
+            )
+        )
+        if options.get("clientRefinement", "").lower() == "true":
+            header = list(TracerResult.HEADER.unpack_from(output))
+            header[5] = 1
+            TracerResult.HEADER.pack_into(output, 0, *header)
+        return output
+
+    def task_failed(self, task: FakeTask, error: Exception) -> None:
+        if task.status != TaskStatus.PROCESSING:
+            return
+        if task.retries < task.options.max_retries:
+            print(f"Task {task.task_id} failed, retrying : {error}")
+            task.retries += 1
+            self.set_task_status(task, TaskStatus.SUBMITTED)
+            self.enqueue(task)
+            return
+        print(f"Task {task.task_id} failed : {error}")
+        self.set_task_status(task, TaskStatus.ERROR)
+        for result_id in task.expected_output_ids:
+            self.abort_result(self.results[result_id])
+
+    def task_done(self, task: FakeTask, output: bytearray) -> None:
+        # Cancelled while running, or its session is gone
+        if task.status != TaskStatus.PROCESSING or task.task_id not in self.tasks:
+            return
+        result = self.results[task.expected_output_ids[0]]
+        if not TracerResult.HEADER.unpack_from(output)[5]:
+            next_payload = self.create_result(
+                task.session_id, "payload", self.results[task.payload_id].data
+            )
+            next_result = self.create_result(task.session_id, "result")
+            options = TaskOptions()
+            options.CopyFrom(task.options)
+            options.options["previous"] = result.result_id
+            options.priority = FOLLOW_UP_PRIORITY
+            self.submit_task(
+                task.session_id,
+                next_payload.result_id,
+                [result.result_id, options.options["sceneId"]],
+                [next_result.result_id],
+                options,
+            )
+            output[-36:] = next_result.result_id.encode("ascii").ljust(36, b"\0")
+        self.complete_result(result, bytes(output))
+        self.set_task_status(task, TaskStatus.COMPLETED)
+
+
+def not_found(context, e: KeyError):
+    context.abort(grpc.StatusCode.NOT_FOUND, e.args[0])
+
+
+class FakeSessions(SessionsServicer):
+    def __init__(self, armonik: FakeArmoniK):
+        self.armonik = armonik
+
+    def CreateSession(self, request, context):
+        self.armonik.delay()
+        with self.armonik.lock:
+            session = self.armonik.create_session(request.default_task_option)
+        return CreateSessionReply(session_id=session.session_id)
+
+    def session_raw(self, session: FakeSession) -> SessionRaw:
+        return SessionRaw(
+            session_id=session.session_id,
+            status=session.status,
+            options=session.options,
+            created_at=timestamp(session.created_at),
+        )
+
+    def apply(self, request, context, action=None):
+        self.armonik.delay()
+        with self.armonik.lock:
+            try:
+                session = self.armonik.session(request.session_id)
+            except KeyError as e:
+                not_found(context, e)
+            if action is not None:
+                action(session)
+            return self.session_raw(session)
+
+    def GetSession(self, request, context):
+        return GetSessionResponse(session=self.apply(request, context))
+
+    def CancelSession(self, request, context):
+        return CancelSessionResponse(
+            session=self.apply(request, context, self.armonik.cancel_session)
+        )
+
+    def CloseSession(self, request, context):
+        def close(session: FakeSession) -> None:
+            session.status = SESSION_STATUS_CLOSED
+
+        return CloseSessionResponse(session=self.apply(request, context, close))
+
+    def PurgeSession(self, request, context):
+        return PurgeSessionResponse(
+            session=self.apply(request, context, self.armonik.purge_session)
+        )
+
+    def DeleteSession(self, request, context):
+        return DeleteSessionResponse(
+            session=self.apply(request, context, self.armonik.delete_session)
+        )
+
+
+class FakeResults(ResultsServicer):
+    def __init__(self, armonik: FakeArmoniK):
+        self.armonik = armonik
+
+    def CreateResultsMetaData(self, request, context):
+        self.armonik.delay()
+        with self.armonik.lock:
+            try:
+                results = [
+                    self.armonik.create_result(request.session_id, r.name)
+                    for r in request.results
+                ]
+            except KeyError as e:
+                not_found(context, e)
+            return CreateResultsMetaDataResponse(
+                results=[r.to_message() for r in results]
+            )
+
+    def CreateResults(self, request, context):
+        self.armonik.delay()
+        with self.armonik.lock:
+            try:
+                results = [
+                    self.armonik.create_result(request.session_id, r.name, r.data)
+                    for r in request.results
+                ]
+            except KeyError as e:
+                not_found(context, e)
+            return CreateResultsResponse(results=[r.to_message() for r in results])
+
+    def GetResult(self, request, context):
+        self.armonik.delay()
+        with self.armonik.lock:
+            try:
+                return GetResultResponse(
+                    result=self.armonik.result(request.result_id).to_message()
+                )
+            except KeyError as e:
+                not_found(context, e)
+
+    def GetOwnerTaskId(self, request, context):
+        self.armonik.delay()
+        with self.armonik.lock:
+            try:
+                owners = [
+                    GetOwnerTaskIdResponse.MapResultTask(
+                        result_id=r, task_id=self.armonik.result(r).owner_task_id
+                    )
+                    for r in request.result_id
+                ]
+            except KeyError as e:
+                not_found(context, e)
+            return GetOwnerTaskIdResponse(
+                session_id=request.session_id, result_task=owners
+            )
+
+    def ListResults(self, request, context):
+        self.armonik.delay()
+        with self.armonik.lock:
+            results = [
+                r
+                for r in self.armonik.results.values()
+                if result_matches(r, request.filters)
+            ]
+        sort_field = RESULT_FIELDS.get(
+            request.sort.field.result_raw_field.field,
+            RESULT_FIELDS[RESULT_RAW_ENUM_FIELD_STATUS],
+        )
+
+        def key(r: FakeResult):
+            # Dates that are not set come first
+            value = sort_field(r)
+            return value is not None, value if value is not None else 0
+
+        results.sort(key=key, reverse=request.sort.direction == SORT_DIRECTION_DESC)
+        start = request.page * request.page_size
+        return ListResultsResponse(
+            results=[
+                r.to_message() for r in results[start : start + request.page_size]
+            ],
+            page=request.page,
+            page_size=request.page_size,
+            total=len(results),
+        )
+
+    def DownloadResultData(self, request, context):
+        self.armonik.delay()
+        if self.armonik.fails(self.armonik.faults.download_failure_rate):
+            context.abort(grpc.StatusCode.UNAVAILABLE, "Injected download failure")
+        with self.armonik.lock:
+            try:
+                data = self.armonik.result(request.result_id).data
+            except KeyError as e:
+                not_found(context, e)
+        if data is None:
+            context.abort(
+                grpc.StatusCode.NOT_FOUND, f"Result {request.result_id} has no data"
+            )
+        for start in range(0, max(len(data), 1), DATA_CHUNK_SIZE):
+            yield DownloadResultDataResponse(
+                data_chunk=data[start : start + DATA_CHUNK_SIZE]
+            )
+
+    def GetServiceConfiguration(self, request, context):
+        return ResultsServiceConfigurationResponse(data_chunk_max_size=DATA_CHUNK_SIZE)
+
+
+class FakeTasks(TasksServicer):
+    def __init__(self, armonik: FakeArmoniK):
+        self.armonik = armonik
+
+    def SubmitTasks(self, request, context):
+        self.armonik.delay()
+        with self.armonik.lock:
+            try:
+                session = self.armonik.session(request.session_id)
+                if session.status != SESSION_STATUS_RUNNING:
+                    context.abort(
+                        grpc.StatusCode.FAILED_PRECONDITION,
+                        f"Session {session.session_id} is not running",
+                    )
+                default_options = (
+                    request.task_options
+                    if request.HasField("task_options")
+                    else session.options
+                )
+                tasks = [
+                    self.armonik.submit_task(
+                        session.session_id,
+                        t.payload_id,
+                        t.data_dependencies,
+                        t.expected_output_keys,
+                        (
+                            t.task_options
+                            if t.HasField("task_options")
+                            else default_options
+                        ),
+                    )
+                    for t in request.task_creations
+                ]
+            except KeyError as e:
+                not_found(context, e)
+            return SubmitTasksResponse(
+                task_infos=[
+                    SubmitTasksResponse.TaskInfo(
+                        task_id=t.task_id,
+                        expected_output_ids=t.expected_output_ids,
+                        data_dependencies=t.data_dependencies,
+                        payload_id=t.payload_id,
+                    )
+                    for t in tasks
+                ]
+            )
+
+    def CancelTasks(self, request, context):
+        self.armonik.delay()
+        with self.armonik.lock:
+            try:
+                tasks = [self.armonik.task(t) for t in request.task_ids]
+            except KeyError as e:
+                not_found(context, e)
+            for task in tasks:
+                self.armonik.cancel_task(task)
+            return CancelTasksResponse(tasks=[t.to_summary() for t in tasks])
+
+
+class FakeEvents(EventsServicer):
+    # Only the status updates of results and tasks are sent, the filters of the
+    # subscription are ignored
+    def __init__(self, armonik: FakeArmoniK):
+        self.armonik = armonik
+
+    def GetEvents(self, request, context):
+        self.armonik.delay()
+        events = Queue()
+        subscriber = (request.session_id, set(request.returned_events), events)
+        with self.armonik.lock:
+            self.armonik.subscribers.append(subscriber)
+        try:
+            while context.is_active():
+                try:
+                    event = events.get(timeout=0.25)
+                except Empty:
+                    continue
+                yield event
+                if self.armonik.fails(self.armonik.faults.stream_drop_rate):
+                    context.abort(grpc.StatusCode.UNAVAILABLE, "Injected stream drop")
+        finally:
+            with self.armonik.lock:
+                self.armonik.subscribers.remove(subscriber)
+
+
+def serve(
+    armonik: FakeArmoniK, address: str = "localhost:0", max_workers: int = 64
+) -> Tuple[grpc.Server, int]:
+    # Each event stream and download in flight holds one of the max_workers threads
+    server = grpc.server(ThreadPoolExecutor(max_workers))
+    add_SessionsServicer_to_server(FakeSessions(armonik), server)
+    add_ResultsServicer_to_server(FakeResults(armonik), server)
+    add_TasksServicer_to_server(FakeTasks(armonik), server)
+    add_EventsServicer_to_server(FakeEvents(armonik), server)
+    port = server.add_insecure_port(address)
+    server.start()
+    return server, port
+
+
+def run_server(
+    address: str,
+    renderer: str,
+    workers: int,
+    faults: Faults,
+    report_interval: float = 0.0,
+    ports: Optional[Queue] = None,
+) -> None:
+    armonik = FakeArmoniK(RENDERERS[renderer](), workers, faults)
+    server, port = serve(armonik, address)
+    print(f"Fake ArmoniK listening on port {port} with the {renderer} renderer")
+    if ports is not None:
+        ports.put(port)
+    try:
+        # Returns True when the wait timed out
+        while server.wait_for_termination(report_interval or None):
+            with armonik.lock:
+                print(f"Tasks : {armonik.task_counts()}")
+    except KeyboardInterrupt:
+        pass
+    server.stop(1.0)
+    armonik.stop()
+
+
+def start_fake_server(renderer: str, workers: int, faults: Faults, ports) -> None:
+    # Started by the client, which stops it when it exits. Ctrl-C is left to the
+    # client so that it can still cancel its session
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run_server("localhost:0", renderer, workers, faults, ports=ports)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for the ArmoniK control plane used by the client"
+    )
+    parser.add_argument("--host", help="address to listen on", default="localhost")
+    parser.add_argument("--port", help="port to listen on", default=5001, type=int)
+    parser.add_argument(
+        "--renderer", help="how tiles are rendered", choices=RENDERERS, default="stub"
+    )
+    parser.add_argument(
+        "--workers", help="number of tasks executed at once", default=4, type=int
+    )
+    parser.add_argument(
+        "--task_latency", help="time added to each task (s)", default=0.0, type=float
+    )
+    parser.add_argument(
+        "--task_jitter",
+        help="standard deviation of the time added to each task (s)",
+        default=0.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--rpc_latency", help="time added to each call (s)", default=0.0, type=float
+    )
+    parser.add_argument(
+        "--task_failure_rate",
+        help="probability of a task execution to fail",
+        default=0.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--download_failure_rate",
+        help="probability of a download to fail",
+        default=0.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--stream_drop_rate",
+        help="probability of an event stream to be cut after each event",
+        default=0.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--report_interval",
+        help="seconds between two reports of the task statuses, 0 to disable",
+        default=5.0,
+        type=float,
+    )
+    args = parser.parse_args()
+    run_server(
+        f"{args.host}:{args.port}",
+        args.renderer,
+        args.workers,
+        Faults(
+            args.task_latency,
+            args.task_jitter,
+            args.rpc_latency,
+            args.task_failure_rate,
+            args.download_failure_rate,
+            args.stream_drop_rate,
+        ),
+        args.report_interval,
+    )
+
+
+if __name__ == "__main__":
+    main()
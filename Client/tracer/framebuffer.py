@@ -0,0 +1,160 @@
+import os
+from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional, Tuple
+
+import numpy as np
+
+from tracer.objects import TracerResult
+
+
+@dataclass
+class TileUpdate:
+    coord_x: int
+    coord_y: int
+    task_width: int
+    task_height: int
+    n_samples_per_pixel: int
+    is_final: int
+    # Mean squared difference (0-255 scale, like the worker) between the tile before
+    # and after the update, for each quadrant of the tile in the order of
+    # split_quadrants. None when nothing was known about the tile before
+    errors: Optional[Tuple[float, float, float, float]] = None
+    # Result the update comes from, when it has one
+    result_id: Optional[str] = None
+
+    @classmethod
+    def from_result(cls, result: TracerResult) -> "TileUpdate":
+        return cls(
+            result.coord_x,
+            result.coord_y,
+            result.task_width,
+            result.task_height,
+            result.n_samples_per_pixel,
+            result.isFinal,
+        )
+
+    @property
+    def error(self) -> float:
+        return float(np.mean(self.errors)) if self.errors is not None else np.inf
+
+
+def split_sizes(size: int) -> Tuple[int, int]:
+    return size // 2, size - size // 2
+
+
+def quadrant_errors(
+    error_map: np.ndarray,
+) -> Optional[Tuple[float, float, float, float]]:
+    h1, _ = split_sizes(error_map.shape[0])
+    w1, _ = split_sizes(error_map.shape[1])
+    quadrants = [
+        error_map[:h1, :w1],
+        error_map[:h1, w1:],
+        error_map[h1:, :w1],
+        error_map[h1:, w1:],
+    ]
+    # Degenerate quadrants of 1-pixel tiles inherit the error of the whole tile
+    whole = float(np.mean(error_map))
+    return tuple(float(np.mean(q)) if q.size else whole for q in quadrants)
+
+
+class FrameBuffer:
+    # Image shared by every process of the client. Tiles are written in place by
+    # whoever downloads them, only TileUpdates go through the queues.
+    # It keeps the linear float samples of the results and the number of samples per
+    # pixel, the 8-bit pixels of the results are not used: tone mapping is done on
+    # display. With accumulate, results only hold new samples (the client drives the
+    # refinement) and are merged into what is already there.
+    # With a path, the memory is a file mapping instead, that outlives the client
+    def __init__(
+        self,
+        height: int,
+        width: int,
+        accumulate: bool = False,
+        name: Optional[str] = None,
+        path: Optional[str] = None,
+    ):
+        self.height = height
+        self.width = width
+        self.accumulate = accumulate
+        self.path = path
+        n_pixels = height * width
+        self.shm = None
+        self.mmap = None
+        self.owner_pid = None
+        if path is not None:
+            exists = os.path.exists(path) and os.path.getsize(path) == n_pixels * 16
+            self.mmap = np.memmap(
+                path, np.uint8, "r+" if exists else "w+", 0, n_pixels * 16
+            )
+            buffer = self.mmap
+        else:
+            self.shm = SharedMemory(name, create=name is None, size=n_pixels * 16)
+            self.owner_pid = os.getpid() if name is None else None
+            buffer = self.shm.buf
+        self.samples = np.ndarray((height, width, 3), np.float32, buffer)
+        self.counts = np.ndarray((height, width), np.int32, buffer, n_pixels * 12)
+
+    def __reduce__(self):
+        return FrameBuffer, (
+            self.height,
+            self.width,
+            self.accumulate,
+            self.shm.name if self.shm is not None else None,
+            self.path,
+        )
+
+    def __enter__(self) -> "FrameBuffer":
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def region(self, update: TileUpdate) -> Tuple[slice, slice]:
+        return (
+            slice(
+                self.height - update.coord_x - update.task_height,
+                self.height - update.coord_x,
+            ),
+            slice(update.coord_y, update.coord_y + update.task_width),
+        )
+
+    def write(self, result: TracerResult) -> TileUpdate:
+        update = TileUpdate.from_result(result)
+        region = self.region(update)
+        samples = np.flip(result.samples, axis=0)
+        previous = self.samples[region].copy()
+        previous_counts = self.counts[region].copy()
+        if self.accumulate:
+            counts = previous_counts + result.n_samples_per_pixel
+            samples = (
+                previous * previous_counts[..., None]
+                + samples * result.n_samples_per_pixel
+            ) / counts[..., None]
+            update.n_samples_per_pixel = int(counts.min())
+        else:
+            counts = result.n_samples_per_pixel
+        self.samples[region] = samples
+        self.counts[region] = counts
+        if previous_counts.min() > 0:
+            diff = 255 * (samples - previous)
+            update.errors = quadrant_errors(np.flip((diff * diff).mean(axis=2), 0))
+        return update
+
+    def clear(self) -> None:
+        self.samples.fill(0)
+        self.counts.fill(0)
+
+    def flush(self) -> None:
+        if self.mmap is not None:
+            self.mmap.flush()
+
+    def close(self) -> None:
+        self.flush()
+        del self.samples, self.counts
+        self.mmap = None
+        if self.shm is not None:
+            self.shm.close()
+            if self.owner_pid == os.getpid():
+                self.shm.unlink()
@@ -0,0 +1,78 @@
+from typing import Callable, Dict
+
+import numpy as np
+
+from tracer.objects import Reflection, SphereArray
+from tracer.scene import spheres as default_spheres
+
+# Inner bounds of the room of the default scene, x from the left to the right wall,
+# y from the floor to the ceiling, z from the back wall to the camera
+ROOM_MIN = np.array([-5.0, 0.0, 0.0], np.float32)
+ROOM_MAX = np.array([104.0, 81.6, 150.0], np.float32)
+# Fraction of the room filled by random spheres, whatever their number
+FILL_RATIO = 0.05
+
+
+def room() -> SphereArray:
+    # Walls, floor and ceiling of the default scene, with its light
+    spheres = SphereArray.from_spheres(default_spheres)
+    return spheres[(spheres.radius >= 1e4) | (spheres.emission.max(axis=1) > 1)]
+
+
+def random_field(count: int = 1000, seed: int = 0) -> SphereArray:
+    rng = np.random.default_rng(seed)
+    volume = float(np.prod(ROOM_MAX - ROOM_MIN))
+    mean_radius = (3 * volume * FILL_RATIO / (4 * np.pi * count)) ** (1 / 3)
+    radius = rng.uniform(0.5, 1.5, count) * mean_radius
+    position = rng.uniform(
+        ROOM_MIN + radius[:, None], np.maximum(ROOM_MAX - radius[:, None], ROOM_MIN)
+    )
+    return room() + SphereArray.from_arrays(
+        radius,
+        position,
+        color=rng.uniform(0.1, 0.95, (count, 3)),
+        reflection=rng.choice(
+            [Reflection.DIFF, Reflection.SPEC, Reflection.REFR],
+            count,
+            p=[0.6, 0.2, 0.2],
+        ),
+    )
+
+
+def grid(size: int = 10, seed: int = 0) -> SphereArray:
+    # size x size spheres resting on the floor
+    rng = np.random.default_rng(seed)
+    spacing = (ROOM_MAX[[0, 2]] - ROOM_MIN[[0, 2]]) / size
+    radius = 0.4 * float(spacing.min())
+    i, j = np.meshgrid(np.arange(size), np.arange(size), indexing="ij")
+    count = size * size
+    position = np.empty((count, 3), np.float32)
+    position[:, 0] = ROOM_MIN[0] + (i.ravel() + 0.5) * spacing[0]
+    position[:, 1] = radius
+    position[:, 2] = ROOM_MIN[2] + (j.ravel() + 0.5) * spacing[1]
+    return room() + SphereArray.from_arrays(
+        np.full(count, radius),
+        position,
+        color=rng.uniform(0.1, 0.95, (count, 3)),
+        reflection=(i + j).ravel() % 3,
+    )
+
+
+GENERATORS: Dict[str, Callable[..., SphereArray]] = {
+    "random_field": random_field,
+    "grid": grid,
+}
+
+
+def generate(spec: str) -> SphereArray:
+    # name:key=value,key=value like random_field:count=100000,seed=42
+    name, _, params = spec.partition(":")
+    if name not in GENERATORS:
+        raise ValueError(
+            f"Unknown scene generator {name}, available : {', '.join(GENERATORS)}"
+        )
+    kwargs = {}
+    for param in filter(None, params.split(",")):
+        key, _, value = param.partition("=")
+        kwargs[key.strip()] = int(value)
+    return GENERATORS[name](**kwargs)
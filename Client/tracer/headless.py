@@ -0,0 +1,78 @@
+import time
+from threading import Thread
+from traceback import format_exception
+from typing import Optional
+
+from tracer.compositor import Compositor
+from tracer.image_io import open_stream
+from tracer.shared_context import SharedContext, Token
+from tracer.trace_events import span
+from tracer.tonemap import ToneMapper
+
+
+def encode_frames(
+    ctx: SharedContext,
+    stream_path: Optional[str],
+    fps: float,
+    tone_mapper: ToneMapper,
+    cancellation_token: Token,
+):
+    # Same compositing as the window, without the outlines. Frames are written at a
+    # fixed rate whether tiles came in or not so that the video plays in real time
+    compositor = Compositor(ctx.framebuffer, tone_mapper, metrics=ctx.metrics)
+    compositor.show_overlay = False
+    writer = None
+    try:
+        if stream_path:
+            writer = open_stream(
+                stream_path, fps, ctx.framebuffer.width, ctx.framebuffer.height
+            )
+            print(f"Streaming frames to {stream_path} at {fps} fps")
+        period = 1.0 / fps
+        next_frame = time.perf_counter()
+        while not cancellation_token.is_set:
+            if ctx.reset_display_flag:
+                compositor.clear()
+                ctx.reset_display_flag = 0
+            next_frame += period
+            remaining = next_frame - time.perf_counter()
+            while remaining > 0:
+                compositor.drain(ctx.to_display_queue, remaining)
+                remaining = next_frame - time.perf_counter()
+            with span(ctx.trace, "compose", "display", tiles=len(compositor.pending)):
+                compositor.compose()
+            if writer is not None:
+                with span(ctx.trace, "present", "display"):
+                    writer.write(compositor.image)
+        # Last frame with everything that was received
+        while compositor.drain(ctx.to_display_queue, 0.0):
+            pass
+        compositor.compose()
+        if writer is not None:
+            writer.write(compositor.image)
+    except Exception as e:
+        print(
+            f"Exception while encoding frames : {format_exception(type(e), e, e.__traceback__)}"
+        )
+    finally:
+        if writer is not None:
+            writer.release()
+    print("Encoder Exited")
+
+
+def start_headless(
+    stream_path: Optional[str], fps: float, tone_mapper: ToneMapper, *ctx
+):
+    ctx = SharedContext(*ctx)
+    token = Token()
+    thread = Thread(
+        target=encode_frames, args=(ctx, stream_path, fps, tone_mapper, token)
+    )
+    try:
+        thread.start()
+        ctx.stop_display_flag.wait()
+    except KeyboardInterrupt:
+        pass
+    print("Stopping encoder...")
+    token.cancel()
+    thread.join()
@@ -0,0 +1,82 @@
+import os
+from typing import Optional
+
+import numpy as np
+
+# The OpenCV wheels only write EXR files when asked to, this has to be set before
+# the first EXR file is written
+os.environ.setdefault("OPENCV_IO_ENABLE_OPENEXR", "1")
+
+import cv2  # noqa: E402
+
+from tracer.framebuffer import FrameBuffer  # noqa: E402
+from tracer.tonemap import ToneMapper  # noqa: E402
+
+VIDEO_CODECS = {".mp4": "mp4v", ".avi": "MJPG", ".mkv": "mp4v"}
+
+
+def write_pfm(path: str, samples: np.ndarray) -> None:
+    # Little-endian RGB PFM, rows are stored bottom to top
+    height, width = samples.shape[:2]
+    with open(path, "wb") as f:
+        f.write(f"PF\n{width} {height}\n-1.0\n".encode("ascii"))
+        f.write(np.flip(samples, axis=0).astype("<f4").tobytes())
+
+
+def save_image(
+    path: str, framebuffer: FrameBuffer, tone_mapper: Optional[ToneMapper] = None
+) -> None:
+    # HDR formats get the linear samples as they are, the others are tone mapped
+    extension = os.path.splitext(path)[1].lower()
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if extension == ".npy":
+        np.save(path, framebuffer.samples)
+    elif extension == ".pfm":
+        write_pfm(path, framebuffer.samples)
+    elif extension == ".exr":
+        if not cv2.imwrite(path, np.ascontiguousarray(framebuffer.samples[..., ::-1])):
+            raise ValueError(f"Couldn't write {path}")
+    else:
+        tone_mapper = tone_mapper if tone_mapper is not None else ToneMapper()
+        if not cv2.imwrite(path, tone_mapper(framebuffer.samples)):
+            raise ValueError(f"Couldn't write {path}")
+    print(f"Image saved to {path}")
+
+
+class ImageSequence:
+    # Same interface as cv2.VideoWriter, path is a pattern like frames/%05d.png
+    def __init__(self, path: str):
+        self.path = path
+        self.index = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def write(self, image: np.ndarray) -> None:
+        cv2.imwrite(self.path % self.index, image)
+        self.index += 1
+
+    def release(self) -> None:
+        pass
+
+
+def open_stream(path: str, fps: float, width: int, height: int):
+    if "%" in path:
+        return ImageSequence(path)
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in VIDEO_CODECS:
+        raise ValueError(
+            f"Unknown stream format {path}, use a video ({', '.join(VIDEO_CODECS)}) "
+            f"or an image sequence pattern like frames/%05d.png"
+        )
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    writer = cv2.VideoWriter(
+        path, cv2.VideoWriter_fourcc(*VIDEO_CODECS[extension]), fps, (width, height)
+    )
+    if not writer.isOpened():
+        raise ValueError(f"Couldn't open {path} for writing")
+    return writer
@@ -0,0 +1,145 @@
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Set
+
+from tracer.adaptive import TileKey
+from tracer.framebuffer import TileUpdate
+
+FRAMEBUFFER_FILE = "framebuffer.bin"
+INDEX_FILE = "tiles.log"
+SESSION_FILE = "session.json"
+
+
+@dataclass
+class JournalState:
+    # Latest update of each tile, the tiles that are done, and the results that are
+    # still expected with the tile they belong to
+    updates: Dict[TileKey, TileUpdate] = field(default_factory=dict)
+    final: Set[TileKey] = field(default_factory=set)
+    pending: Dict[str, TileKey] = field(default_factory=dict)
+    complete: bool = False
+
+
+class Journal:
+    # Everything needed to pick up a render where it was left: the framebuffer mapped
+    # from a file of the journal directory, the session, and an append-only index of
+    # the results that were expected and received for each tile. Tiles are written in
+    # the framebuffer before being marked received, a crash in between only means
+    # downloading them again.
+    # Lines are appended with a single write on a file opened with O_APPEND, so the
+    # processes of the client can all write to it
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.fd: Optional[int] = None
+
+    def __reduce__(self):
+        return Journal, (self.directory,)
+
+    @property
+    def framebuffer_path(self) -> str:
+        return os.path.join(self.directory, FRAMEBUFFER_FILE)
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.directory, INDEX_FILE)
+
+    @property
+    def session_path(self) -> str:
+        return os.path.join(self.directory, SESSION_FILE)
+
+    @property
+    def exists(self) -> bool:
+        return os.path.exists(self.session_path)
+
+    def reset(self) -> None:
+        # The index is truncated rather than removed, the other processes keep
+        # appending to it through the descriptors they already have
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.index_path):
+            os.truncate(self.index_path, 0)
+        if os.path.exists(self.session_path):
+            os.remove(self.session_path)
+
+    def append(self, entry: dict) -> None:
+        if self.fd is None:
+            self.fd = os.open(
+                self.index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+            )
+        os.write(self.fd, (json.dumps(entry) + "\n").encode("utf-8"))
+
+    def watched(self, result_id: str, tile: TileKey) -> None:
+        self.append({"watch": result_id, "tile": list(tile)})
+
+    def received(self, result_id: Optional[str], update: TileUpdate) -> None:
+        self.append(
+            {
+                "received": result_id,
+                "tile": [
+                    update.coord_x,
+                    update.coord_y,
+                    update.task_width,
+                    update.task_height,
+                ],
+                "samples": update.n_samples_per_pixel,
+                "final": update.is_final,
+            }
+        )
+
+    def started(self, session_id: str) -> None:
+        # Results expected from the previous sessions will never come
+        self.append({"session": session_id})
+
+    def completed(self) -> None:
+        self.append({"complete": True})
+
+    def save_session(self, session: dict) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = f"{self.session_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(session, f)
+        os.replace(tmp, self.session_path)
+
+    def load_session(self) -> dict:
+        with open(self.session_path) as f:
+            return json.load(f)
+
+    def replay(self) -> JournalState:
+        state = JournalState()
+        if not os.path.exists(self.index_path):
+            return state
+        with open(self.index_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line cut short by a crash
+                    continue
+                if "complete" in entry:
+                    state.complete = True
+                    continue
+                if "session" in entry:
+                    state.complete = False
+                    state.pending.clear()
+                    continue
+                tile = tuple(entry["tile"])
+                if "watch" in entry:
+                    state.pending[entry["watch"]] = tile
+                    continue
+                state.pending.pop(entry["received"], None)
+                update = TileUpdate(*tile, entry["samples"], entry["final"])
+                current = state.updates.get(tile)
+                if current is None or (
+                    update.is_final,
+                    update.n_samples_per_pixel,
+                ) >= (current.is_final, current.n_samples_per_pixel):
+                    state.updates[tile] = update
+                if update.is_final:
+                    state.final.add(tile)
+        state.pending = {r: t for r, t in state.pending.items() if t not in state.final}
+        return state
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
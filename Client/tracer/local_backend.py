@@ -0,0 +1,131 @@
+import os
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import List, Optional, Set
+
+from tracer.adaptive import tile_key
+from tracer.backend import Backend
+from tracer.local_engine import LocalScene, compute_payload
+from tracer.metrics import COMPLETED, SUBMITTED
+from tracer.objects import Payload, Scene, TracerResult
+from tracer.shared_context import SharedContext
+from tracer.trace_events import span, tile_label
+
+_current_scene: Optional[LocalScene] = None
+
+
+def _load_scene(scene: Scene) -> None:
+    global _current_scene
+    _current_scene = LocalScene(scene)
+
+
+def _render(payload: Payload, previous: Optional[bytes], error_threshold: float):
+    return compute_payload(
+        _current_scene,
+        payload,
+        TracerResult(previous) if previous is not None else None,
+        error_threshold,
+    )
+
+
+class LocalBackend(Backend):
+    def __init__(self, args):
+        self.n_workers = args.local_workers or os.cpu_count()
+        self.error_threshold = args.error_threshold
+        self.client_refinement = args.client_refinement
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.pending: Set[Future] = set()
+
+    def create_context(self, context: SharedContext, error_threshold: float) -> None:
+        context.session_id = f"local-{uuid.uuid4()}"
+        self.error_threshold = error_threshold
+
+    def send_scene(self, context: SharedContext, scene: Scene) -> str:
+        print(f"Starting {self.n_workers} local workers...")
+        self.shutdown()
+        # Like the ArmoniK workers, each process keeps the current scene around
+        self.executor = ProcessPoolExecutor(
+            self.n_workers, initializer=_load_scene, initargs=(scene,)
+        )
+        return "scene"
+
+    def submit(
+        self,
+        context: SharedContext,
+        scene_id: str,
+        payloads: List[Payload],
+        priorities: Optional[List[int]] = None,
+        previous: Optional[List[Optional[TracerResult]]] = None,
+    ) -> None:
+        # The pool runs the tasks in submission order, there is nothing else to do
+        # with priorities
+        for i, p in enumerate(payloads):
+            result = previous[i] if previous is not None else None
+            self._submit(context, p, result.raw if result is not None else None)
+
+    def _submit(
+        self, context: SharedContext, payload: Payload, previous: Optional[bytes]
+    ) -> None:
+        executor = self.executor
+        if executor is None:
+            return
+        try:
+            future = executor.submit(_render, payload, previous, self.error_threshold)
+        except RuntimeError:
+            # The pool is shutting down
+            return
+        # Stands for the result id of the ArmoniK tasks in the metrics
+        result_id = str(uuid.uuid4())
+        if context.metrics is not None:
+            context.metrics.record(SUBMITTED, result_id, tile_key(payload))
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+        future.add_done_callback(
+            lambda f: self._on_done(context, payload, f, result_id)
+        )
+
+    def _on_done(
+        self, context: SharedContext, payload: Payload, future: Future, result_id: str
+    ):
+        if future.cancelled():
+            return
+        try:
+            result = TracerResult(future.result())
+        except Exception as e:
+            print(f"Exception while rendering locally : {e}")
+            return
+        if context.metrics is not None:
+            context.metrics.record(COMPLETED, result_id)
+        if context.cache is not None:
+            context.cache.store(result)
+        # Same refinement loop as SampleComputerService
+        if self.client_refinement:
+            result.isFinal = 1
+        elif not result.isFinal:
+            self._submit(context, payload, result.raw)
+        with span(
+            context.trace,
+            "decode",
+            "local",
+            result_id=result_id,
+            tile=tile_label(tile_key(payload)),
+            samples=result.n_samples_per_pixel,
+        ):
+            context.publish(context.framebuffer.write(result), result_id)
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def stop(self, context: SharedContext, processes) -> None:
+        self.shutdown()
+
+    def cancel(self, context: SharedContext) -> None:
+        self.shutdown()
+
+    def cancel_pending(self, context: SharedContext) -> int:
+        # The running tasks finish but their follow-ups are not submitted
+        pending = len(self.pending)
+        self.shutdown()
+        return pending
@@ -0,0 +1,309 @@
+import struct
+from typing import Optional, Tuple, Union
+
+import numpy as np
+
+from tracer.objects import Payload, Reflection, Scene, TracerResult
+
+AIR_REFRACTION_INDEX = 1.0
+GLASS_REFRACTION_INDEX = 1.5
+AIR_TO_GLASS_REFRACTION_INDEX = AIR_REFRACTION_INDEX / GLASS_REFRACTION_INDEX
+GLASS_TO_AIR_REFRACTION_INDEX = GLASS_REFRACTION_INDEX / AIR_REFRACTION_INDEX
+BASE_REFLECTANCE = (GLASS_REFRACTION_INDEX - AIR_REFRACTION_INDEX) ** 2 / (
+    (GLASS_REFRACTION_INDEX + AIR_REFRACTION_INDEX) ** 2
+)
+GAMMA = 1 / 2.2
+EPSILON = 7e-2
+DEFAULT_ERROR_THRESHOLD = 10.0
+NEXT_RESULT_ID_SIZE = 36
+
+# Upper bound on the number of ray/sphere pairs evaluated at once
+MAX_BATCH_ELEMENTS = 1 << 21
+
+RESULT_HEADER = struct.Struct("<6i")
+
+
+def _normalize(v: np.ndarray) -> np.ndarray:
+    return v / np.linalg.norm(v, axis=-1, keepdims=True)
+
+
+def _dot(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return np.einsum("ij,ij->i", a, b)
+
+
+class LocalScene:
+    def __init__(self, scene: Scene):
+        self.img_width = scene.img_width
+        self.img_height = scene.img_height
+        self.kill_depth = scene.kill_depth
+        self.split_depth = scene.split_depth
+        spheres = scene.spheres
+        self.radius = spheres.radius.astype(np.float64)
+        self.position = spheres.position.astype(np.float64)
+        self.emission = spheres.emission.astype(np.float64)
+        self.color = spheres.color.astype(np.float64)
+        self.reflection = spheres.reflection.astype(np.int32)
+
+        camera = scene.camera
+        self.camera_length = camera.length
+        self.camera_position = np.array(camera.position, np.float64)
+        self.camera_direction = _normalize(np.array(camera.direction, np.float64))
+        self.inc_x = np.array(
+            [scene.img_width * camera.cst / scene.img_height, 0.0, 0.0]
+        )
+        self.inc_y = camera.cst * _normalize(
+            np.cross(self.inc_x, self.camera_direction)
+        )
+
+    @property
+    def n_spheres(self) -> int:
+        return len(self.radius)
+
+
+def intersect(
+    scene: LocalScene, origins: np.ndarray, directions: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Same closest-hit formulation as SphereList.Intersect, one row per ray
+    fx = origins[:, 0:1] - scene.position[:, 0]
+    fy = origins[:, 1:2] - scene.position[:, 1]
+    fz = origins[:, 2:3] - scene.position[:, 2]
+    dx, dy, dz = directions[:, 0:1], directions[:, 1:2], directions[:, 2:3]
+    b = -(fx * dx + fy * dy + fz * dz)
+    r2 = scene.radius * scene.radius
+    f2 = fx * fx + fy * fy + fz * fz
+    delta = r2 - (f2 - b * b)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        q = b + np.where(b < 0, -1.0, 1.0) * np.sqrt(np.maximum(delta, 0.0))
+        t0 = (f2 - r2) / q
+    t = np.where(t0 > EPSILON, t0, q)
+    t = np.where((delta > 0) & (t > EPSILON), t, np.inf)
+    ids = np.argmin(t, axis=1)
+    distances = t[np.arange(len(ids)), ids]
+    return np.where(np.isfinite(distances), ids, -1), distances
+
+
+def random_hemisphere(rng: np.random.Generator, normals: np.ndarray) -> np.ndarray:
+    v = np.empty_like(normals)
+    todo = np.arange(len(normals))
+    while len(todo):
+        candidates = rng.random((len(todo), 3)) * 2 - 1
+        length2 = np.einsum("ij,ij->i", candidates, candidates)
+        accepted = (length2 <= 1) & (length2 >= 0.001)
+        v[todo[accepted]] = candidates[accepted]
+        todo = todo[~accepted]
+    v = np.where((_dot(v, normals) < 0)[:, None], -v, v)
+    return _normalize(v)
+
+
+def trace(
+    scene: LocalScene,
+    origins: np.ndarray,
+    directions: np.ndarray,
+    pixels: np.ndarray,
+    n_pixels: int,
+    rng: np.random.Generator,
+    rays: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    # Batched equivalent of TracerCompute.Radiance: every ray advances by one bounce
+    # per iteration, the recursive branches of the C# code become masks, and the
+    # reflection/refraction split below the split depth spawns extra rays.
+    # rays, when given, counts the intersection tests done for each pixel
+    radiance = np.zeros((n_pixels, 3), np.float64)
+    weights = np.ones_like(origins)
+    depth = 0
+    while len(origins):
+        if rays is not None:
+            np.add.at(rays, pixels, 1)
+        ids, distances = intersect(scene, origins, directions)
+        hit = ids >= 0
+        origins, directions, weights, pixels = (
+            origins[hit],
+            directions[hit],
+            weights[hit],
+            pixels[hit],
+        )
+        ids, distances = ids[hit], distances[hit]
+
+        np.add.at(radiance, pixels, weights * scene.emission[ids])
+        depth += 1
+        if depth > scene.kill_depth or not len(origins):
+            break
+
+        weights = weights * scene.color[ids]
+        points = origins + distances[:, None] * directions
+        normals = _normalize(points - scene.position[ids])
+        cos_dn = _dot(normals, directions)
+        into = cos_dn < 0
+        oriented = np.where(into[:, None], normals, -normals)
+        reflected = directions - 2 * cos_dn[:, None] * normals
+
+        reflection = scene.reflection[ids]
+        new_directions = np.where(
+            (reflection == Reflection.SPEC)[:, None], reflected, directions
+        )
+
+        diffuse = reflection == Reflection.DIFF
+        if diffuse.any():
+            new_directions[diffuse] = random_hemisphere(rng, oriented[diffuse])
+
+        extra = None
+        refractive = np.flatnonzero(reflection == Reflection.REFR)
+        if len(refractive):
+            d = directions[refractive]
+            n = normals[refractive]
+            r_into = into[refractive]
+            factor = np.where(
+                r_into, AIR_TO_GLASS_REFRACTION_INDEX, GLASS_TO_AIR_REFRACTION_INDEX
+            )
+            attack = _dot(d, oriented[refractive])
+            cos2t = 1 - factor * factor * (1 - attack * attack)
+
+            # Total internal reflection keeps the reflected direction and weight
+            new_directions[refractive] = reflected[refractive]
+            refracting = cos2t >= 0
+            refractive, d, n, r_into, factor, attack, cos2t = (
+                refractive[refracting],
+                d[refracting],
+                n[refracting],
+                r_into[refracting],
+                factor[refracting],
+                attack[refracting],
+                cos2t[refracting],
+            )
+            refracted = _normalize(
+                factor[:, None] * d
+                - (np.where(r_into, 1.0, -1.0) * (attack * factor + np.sqrt(cos2t)))[
+                    :, None
+                ]
+                * n
+            )
+            c = 1 - np.where(r_into, -attack, _dot(refracted, n))
+            reflectance = BASE_REFLECTANCE + (1 - BASE_REFLECTANCE) * c**5
+            transmittance = 1 - reflectance
+
+            if depth > scene.split_depth:
+                probability = 0.25 + 0.5 * reflectance
+                reflect = rng.random(len(refractive)) < probability
+                new_directions[refractive[~reflect]] = refracted[~reflect]
+                weights[refractive] *= np.where(
+                    reflect,
+                    reflectance / probability,
+                    transmittance / (1 - probability),
+                )[:, None]
+            else:
+                extra = (
+                    points[refractive],
+                    refracted,
+                    weights[refractive] * transmittance[:, None],
+                    pixels[refractive],
+                )
+                weights[refractive] *= reflectance[:, None]
+
+        origins, directions = points, new_directions
+        if extra is not None:
+            origins = np.concatenate([origins, extra[0]])
+            directions = np.concatenate([directions, extra[1]])
+            weights = np.concatenate([weights, extra[2]])
+            pixels = np.concatenate([pixels, extra[3]])
+    return radiance
+
+
+def camera_rays(
+    scene: LocalScene,
+    payload: Payload,
+    pixels: np.ndarray,
+    rng: np.random.Generator,
+) -> Tuple[np.ndarray, np.ndarray]:
+    i = payload.coord_x + pixels // payload.task_width
+    j = payload.coord_y + pixels % payload.task_width
+    rd = rng.random((len(pixels), 2))
+    directions = _normalize(
+        scene.camera_direction
+        + ((rd[:, 1] + i) / scene.img_height - 0.5)[:, None] * scene.inc_y
+        + ((rd[:, 0] + j) / scene.img_width - 0.5)[:, None] * scene.inc_x
+    )
+    origins = scene.camera_position + scene.camera_length * directions
+    return origins, directions
+
+
+def to_pixels(samples: np.ndarray) -> np.ndarray:
+    # Same gamma correction and BGR channel order as the C# worker
+    return (np.power(samples[..., ::-1], GAMMA) * 255 + 0.5).astype(np.uint8)
+
+
+def error_metric(samples: np.ndarray, reference: np.ndarray) -> float:
+    diff = 255 * (samples.astype(np.float32) - reference.astype(np.float32))
+    return float(np.mean(diff * diff))
+
+
+def compute_payload(
+    scene: Union[Scene, LocalScene],
+    payload: Payload,
+    previous: Optional[TracerResult] = None,
+    error_threshold: float = DEFAULT_ERROR_THRESHOLD,
+    next_result_id: str = "",
+    rng: Optional[np.random.Generator] = None,
+) -> bytes:
+    if not isinstance(scene, LocalScene):
+        scene = LocalScene(scene)
+    if (
+        scene.img_height <= 0
+        or scene.img_width <= 0
+        or payload.task_height <= 0
+        or payload.task_width <= 0
+        or payload.samples <= 0
+        or payload.coord_x < 0
+        or payload.coord_y < 0
+    ):
+        raise ValueError("Bad payload")
+    rng = rng if rng is not None else np.random.default_rng()
+
+    n_pixels = payload.task_width * payload.task_height
+    n_previous = previous.n_samples_per_pixel if previous is not None else 0
+    n_next = payload.samples + n_previous
+
+    radiance = np.zeros((n_pixels, 3), np.float64)
+    n_rays = n_pixels * payload.samples
+    batch_size = max(1, MAX_BATCH_ELEMENTS // max(1, scene.n_spheres))
+    for start in range(0, n_rays, batch_size):
+        pixels = np.arange(start, min(start + batch_size, n_rays)) % n_pixels
+        origins, directions = camera_rays(scene, payload, pixels, rng)
+        radiance += trace(scene, origins, directions, pixels, n_pixels, rng)
+
+    samples = radiance / n_next
+    if previous is not None:
+        samples += previous.samples.reshape(n_pixels, 3) * (n_previous / n_next)
+    samples = np.clip(samples, 0.0, 1.0).astype(np.float32)
+
+    is_final = (
+        previous is not None
+        and error_metric(samples, previous.samples.reshape(n_pixels, 3))
+        <= error_threshold
+    )
+    return encode_result(payload, n_next, is_final, samples, next_result_id)
+
+
+def encode_result(
+    payload: Payload,
+    n_samples_per_pixel: int,
+    is_final: bool,
+    samples: np.ndarray,
+    next_result_id: str = "",
+) -> bytes:
+    # Layout of the TracerResult sent back by the C# worker
+    next_id = b"" if is_final else next_result_id.encode("ascii")
+    return b"".join(
+        [
+            RESULT_HEADER.pack(
+                payload.coord_x,
+                payload.coord_y,
+                payload.task_width,
+                payload.task_height,
+                n_samples_per_pixel,
+                int(is_final),
+            ),
+            to_pixels(samples).tobytes(),
+            samples.astype("<f4").tobytes(),
+            next_id[:NEXT_RESULT_ID_SIZE].ljust(NEXT_RESULT_ID_SIZE, b"\0"),
+        ]
+    )
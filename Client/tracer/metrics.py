@@ -0,0 +1,234 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Queue
+from queue import Empty
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Steps of the life of a tile result, in order. submitted is when the client knows
+# the result is coming: after the task is sent, or when the previous result of the
+# tile names it. completed is when the watcher sees it done, decoded when it is in
+# the framebuffer and displayed when it is composed into a frame
+SUBMITTED = "submitted"
+COMPLETED = "completed"
+DOWNLOAD_START = "download_start"
+DOWNLOAD_END = "download_end"
+DECODED = "decoded"
+DISPLAYED = "displayed"
+STAGES = [SUBMITTED, COMPLETED, DOWNLOAD_START, DOWNLOAD_END, DECODED, DISPLAYED]
+TOTAL = "total"
+
+# Upper bounds of the histogram buckets exported to Prometheus (s)
+BUCKETS = [
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+]
+PERCENTILES = [50, 95, 99]
+
+
+class MetricsRecorder:
+    # Handed to every process through the shared context, the timestamps are
+    # gathered by the MetricsCollector of the main process
+    def __init__(self, queue: Optional[Queue] = None):
+        self.queue = queue if queue is not None else Queue()
+
+    def record(
+        self, stage: str, result_id: Optional[str], tile: Optional[tuple] = None
+    ) -> None:
+        if result_id:
+            self.queue.put((stage, result_id, time.time(), tile))
+
+
+class LatencyTracker:
+    # Time taken by the results to go from one stage to the next one they went
+    # through, with the total from the first stage to the displayed one, overall and
+    # for each refinement generation of the tiles
+    def __init__(self):
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.generation: Dict[str, int] = {}
+        self.generations_per_tile: Dict[tuple, int] = {}
+        self.latencies: Dict[str, List[float]] = {s: [] for s in STAGES[1:] + [TOTAL]}
+        self.by_generation: Dict[int, List[float]] = {}
+        self.counts: Dict[str, int] = {s: 0 for s in STAGES}
+
+    def observe(
+        self, stage: str, result_id: str, t: float, tile: Optional[tuple]
+    ) -> None:
+        stages = self.stages.setdefault(result_id, {})
+        if stage in stages:
+            # Downloaded again after a failure, the download time is the one of the
+            # last attempt
+            if stage == DOWNLOAD_START:
+                stages[stage] = t
+            return
+        self.counts[stage] += 1
+        stages[stage] = t
+        if stage == SUBMITTED and tile is not None:
+            generation = self.generations_per_tile.get(tile, 0)
+            self.generations_per_tile[tile] = generation + 1
+            self.generation[result_id] = generation
+        index = STAGES.index(stage)
+        previous = [stages[s] for s in STAGES[:index] if s in stages]
+        if previous and stage != SUBMITTED:
+            self.latencies[stage].append(max(0.0, t - previous[-1]))
+        if stage == DISPLAYED:
+            del self.stages[result_id]
+            if previous:
+                total = max(0.0, t - previous[0])
+                self.latencies[TOTAL].append(total)
+                generation = self.generation.pop(result_id, None)
+                if generation is not None:
+                    self.by_generation.setdefault(generation, []).append(total)
+
+    def report(self) -> dict:
+        return {
+            "stages": {s: summarize(v) for s, v in self.latencies.items()},
+            "generations": {
+                str(g): summarize(v) for g, v in sorted(self.by_generation.items())
+            },
+            "counts": dict(self.counts),
+        }
+
+    def prometheus(self) -> str:
+        lines = [
+            "# HELP pitracer_tile_stage_seconds Time taken by tile results to reach "
+            "a stage from the previous one",
+            "# TYPE pitracer_tile_stage_seconds histogram",
+        ]
+        for stage, values in self.latencies.items():
+            counts = np.searchsorted(np.sort(values), BUCKETS, side="right")
+            for bound, count in zip(BUCKETS, counts):
+                lines.append(
+                    f'pitracer_tile_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}'
+                )
+            lines.append(
+                f'pitracer_tile_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {len(values)}'
+            )
+            lines.append(
+                f'pitracer_tile_stage_seconds_sum{{stage="{stage}"}} {sum(values)}'
+            )
+            lines.append(
+                f'pitracer_tile_stage_seconds_count{{stage="{stage}"}} {len(values)}'
+            )
+        lines.append(
+            "# HELP pitracer_tile_results_total Tile results that reached each stage"
+        )
+        lines.append("# TYPE pitracer_tile_results_total counter")
+        for stage, count in self.counts.items():
+            lines.append(f'pitracer_tile_results_total{{stage="{stage}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+def summarize(values: List[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    p = np.percentile(values, PERCENTILES)
+    return {
+        "count": len(values),
+        "mean": float(np.mean(values)),
+        "max": float(np.max(values)),
+        **{f"p{q}": float(v) for q, v in zip(PERCENTILES, p)},
+    }
+
+
+class MetricsCollector:
+    # Gathers the timestamps recorded by all the processes, serves them on
+    # http://localhost:port/metrics in the Prometheus text format if a port is
+    # given, and writes the JSON report when closed
+    def __init__(
+        self,
+        recorder: MetricsRecorder,
+        port: Optional[int] = None,
+        report_path: Optional[str] = None,
+    ):
+        self.recorder = recorder
+        self.report_path = report_path
+        self.tracker = LatencyTracker()
+        self.lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self.collect, daemon=True)
+        self.thread.start()
+        self.server: Optional[ThreadingHTTPServer] = None
+        if port is not None:
+            self.server = ThreadingHTTPServer(("localhost", port), self.handler())
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            print(f"Metrics served on http://localhost:{port}/metrics")
+
+    def handler(self):
+        collector = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                with collector.lock:
+                    body = collector.tracker.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def drain(self, timeout: float) -> int:
+        n = 0
+        try:
+            event = self.recorder.queue.get(timeout=timeout)
+            while True:
+                with self.lock:
+                    self.tracker.observe(*event)
+                n += 1
+                event = self.recorder.queue.get_nowait()
+        except Empty:
+            pass
+        return n
+
+    def collect(self) -> None:
+        while self.running:
+            self.drain(0.25)
+
+    def report(self) -> dict:
+        with self.lock:
+            return self.tracker.report()
+
+    def close(self) -> None:
+        self.running = False
+        self.thread.join()
+        while self.drain(0.1):
+            pass
+        if self.server is not None:
+            self.server.shutdown()
+        report = self.report()
+        for stage, summary in report["stages"].items():
+            if summary["count"]:
+                print(
+                    f"{stage:<15} p50 {summary['p50'] * 1000:9.1f} ms"
+                    f"  p95 {summary['p95'] * 1000:9.1f} ms"
+                    f"  p99 {summary['p99'] * 1000:9.1f} ms  ({summary['count']})"
+                )
+        if self.report_path:
+            with open(self.report_path, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"Latency report written to {self.report_path}")
@@ -1,5 +1,6 @@
+import struct
 from dataclasses import dataclass, field
-from typing import List
+from typing import Iterable, Iterator, List, Optional, Union
 
 import numpy as np
 
@@ -33,27 +34,183 @@ class Sphere:
         self.reflection = reflection
         self.max_reflectivity = max_reflectivity
 
-    def to_bytes(self):
-        return (
+    def to_bytes(self) -> bytes:
+        return SphereArray.from_spheres([self]).to_bytes()
+
+
+# Same layout as the sphere records read by the worker
+SPHERE_DTYPE = np.dtype(
+    [
+        ("radius", "<f4"),
+        ("position", "<f4", (3,)),
+        ("emission", "<f4", (3,)),
+        ("color", "<f4", (3,)),
+        ("reflection", "<i4"),
+        ("max_reflectivity", "<f4"),
+    ]
+)
+
+
+class SphereArray:
+    # Spheres of a scene stored as records of SPHERE_DTYPE, the scene serializes in a
+    # single copy. Indexing with an int gives a Sphere, anything else (slices, masks,
+    # index arrays) gives another SphereArray, a view when NumPy allows it.
+    # Transforms return new arrays
+    def __init__(self, data: Optional[np.ndarray] = None):
+        self.data = data if data is not None else np.zeros(0, SPHERE_DTYPE)
+
+    @classmethod
+    def empty(cls, n: int) -> "SphereArray":
+        data = np.zeros(n, SPHERE_DTYPE)
+        data["max_reflectivity"] = -1.0
+        return cls(data)
+
+    @classmethod
+    def from_spheres(cls, spheres: Iterable[Sphere]) -> "SphereArray":
+        if isinstance(spheres, SphereArray):
+            return spheres
+        return cls(
             np.array(
                 [
-                    self.radius,
-                    self.position[0],
-                    self.position[1],
-                    self.position[2],
-                    self.emission[0],
-                    self.emission[1],
-                    self.emission[2],
-                    self.color[0],
-                    self.color[1],
-                    self.color[2],
+                    (
+                        s.radius,
+                        s.position,
+                        s.emission,
+                        s.color,
+                        s.reflection,
+                        s.max_reflectivity,
+                    )
+                    for s in spheres
                 ],
-                dtype=np.float32,
-            ).tobytes()
-            + self.reflection.to_bytes(4, "little")
-            + np.array([self.max_reflectivity], dtype=np.float32).tobytes()
+                SPHERE_DTYPE,
+            )
         )
 
+    @classmethod
+    def from_arrays(
+        cls,
+        radius,
+        position,
+        emission=0.0,
+        color=0.0,
+        reflection=Reflection.DIFF,
+        max_reflectivity=-1.0,
+    ) -> "SphereArray":
+        # Every field is broadcast to the number of radii
+        radius = np.asarray(radius, np.float32).reshape(-1)
+        spheres = cls.empty(len(radius))
+        spheres.radius = radius
+        spheres.position = position
+        spheres.emission = emission
+        spheres.color = color
+        spheres.reflection = reflection
+        spheres.max_reflectivity = max_reflectivity
+        return spheres
+
+    @classmethod
+    def from_bytes(cls, data) -> "SphereArray":
+        # No copy, data can be a memory map
+        return cls(np.frombuffer(data, SPHERE_DTYPE))
+
+    def to_bytes(self) -> bytes:
+        return self.data.tobytes()
+
+    @property
+    def radius(self) -> np.ndarray:
+        return self.data["radius"]
+
+    @radius.setter
+    def radius(self, value) -> None:
+        self.data["radius"] = value
+
+    @property
+    def position(self) -> np.ndarray:
+        return self.data["position"]
+
+    @position.setter
+    def position(self, value) -> None:
+        self.data["position"] = value
+
+    @property
+    def emission(self) -> np.ndarray:
+        return self.data["emission"]
+
+    @emission.setter
+    def emission(self, value) -> None:
+        self.data["emission"] = value
+
+    @property
+    def color(self) -> np.ndarray:
+        return self.data["color"]
+
+    @color.setter
+    def color(self, value) -> None:
+        self.data["color"] = value
+
+    @property
+    def reflection(self) -> np.ndarray:
+        return self.data["reflection"]
+
+    @reflection.setter
+    def reflection(self, value) -> None:
+        self.data["reflection"] = value
+
+    @property
+    def max_reflectivity(self) -> np.ndarray:
+        return self.data["max_reflectivity"]
+
+    @max_reflectivity.setter
+    def max_reflectivity(self, value) -> None:
+        self.data["max_reflectivity"] = value
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, index) -> Union[Sphere, "SphereArray"]:
+        if isinstance(index, (int, np.integer)):
+            r = self.data[index]
+            return Sphere(
+                float(r["radius"]),
+                r["position"].tolist(),
+                r["emission"].tolist(),
+                r["color"].tolist(),
+                int(r["reflection"]),
+                float(r["max_reflectivity"]),
+            )
+        return SphereArray(self.data[index])
+
+    def __iter__(self) -> Iterator[Sphere]:
+        return (self[i] for i in range(len(self)))
+
+    def __add__(self, other: Iterable[Sphere]) -> "SphereArray":
+        return SphereArray.concatenate([self, SphereArray.from_spheres(other)])
+
+    @staticmethod
+    def concatenate(arrays: Iterable["SphereArray"]) -> "SphereArray":
+        return SphereArray(np.concatenate([a.data for a in arrays]))
+
+    def copy(self) -> "SphereArray":
+        return SphereArray(self.data.copy())
+
+    def translated(self, offset) -> "SphereArray":
+        spheres = self.copy()
+        spheres.position += np.asarray(offset, np.float32)
+        return spheres
+
+    def scaled(self, factor: float, origin=(0.0, 0.0, 0.0)) -> "SphereArray":
+        spheres = self.copy()
+        origin = np.asarray(origin, np.float32)
+        spheres.position = origin + (spheres.position - origin) * factor
+        spheres.radius *= factor
+        return spheres
+
+    def rotated(self, matrix, origin=(0.0, 0.0, 0.0)) -> "SphereArray":
+        spheres = self.copy()
+        origin = np.asarray(origin, np.float32)
+        matrix = np.asarray(matrix, np.float32)
+        spheres.position = origin + (spheres.position - origin) @ matrix.T
+        return spheres
+
 
 class TracerPayload:
     def __init__(self, args, coord_x=0, coord_y=0):
@@ -87,29 +244,37 @@ class TracerPayload:
 
 
 class TracerResult:
+    HEADER = struct.Struct("<6i")
+
     def __init__(self, result: bytes):
-        self.coord_x = int.from_bytes(result[0:4], "little")
-        self.coord_y = int.from_bytes(result[4:8], "little")
-        self.task_width = int.from_bytes(result[8:12], "little")
-        self.task_height = int.from_bytes(result[12:16], "little")
-        self.n_samples_per_pixel = int.from_bytes(result[16:20], "little")
-        self.isFinal = int.from_bytes(result[20:24], "little")
-        pixel_offset = 24
-        pixels_size = self.task_height * self.task_width * 3
-        samples_offset = pixel_offset + pixels_size
-        samples_size = self.task_height * self.task_width * 3 * 4
-        next_result_id_offset = samples_offset + samples_size
-        self.pixels = list(result[pixel_offset:samples_offset])
-        self.samples = list(result[samples_offset:next_result_id_offset])
-        self.nextResultId = result[next_result_id_offset:].decode("ascii")
+        self.raw = result
+        (
+            self.coord_x,
+            self.coord_y,
+            self.task_width,
+            self.task_height,
+            self.n_samples_per_pixel,
+            self.isFinal,
+        ) = self.HEADER.unpack_from(result)
+        shape = (self.task_height, self.task_width, 3)
+        n_values = self.task_height * self.task_width * 3
+        pixel_offset = self.HEADER.size
+        samples_offset = pixel_offset + n_values
+        next_result_id_offset = samples_offset + n_values * 4
+        self.pixels = np.frombuffer(result, np.uint8, n_values, pixel_offset).reshape(
+            shape
+        )
+        self.samples = np.frombuffer(
+            result, np.dtype("<f4"), n_values, samples_offset
+        ).reshape(shape)
+        self.nextResultId = bytes(result[next_result_id_offset:]).decode("ascii")
+
+    def __reduce__(self):
+        # Only the downloaded buffer crosses process boundaries, the views are rebuilt
+        return TracerResult, (self.raw,)
 
     def pixels_to_numpy_array(self) -> np.ndarray:
-        return np.flip(
-            np.array(self.pixels, np.uint8).reshape(
-                (self.task_height, self.task_width, 3)
-            ),
-            axis=0,
-        )
+        return np.flip(self.pixels, axis=0)
 
 
 @dataclass
@@ -152,6 +317,11 @@ class Camera:
             dtype=np.float32,
         ).tobytes()
 
+    @classmethod
+    def from_bytes(cls, data) -> "Camera":
+        c = np.frombuffer(data, "<f4", 8).tolist()
+        return cls(c[0], c[1], c[2:5], c[5:8])
+
 
 @dataclass
 class Scene:
@@ -160,15 +330,31 @@ class Scene:
     kill_depth: int
     split_depth: int
     camera: Camera
-    spheres: List[Sphere]
+    spheres: Union[SphereArray, List[Sphere]]
+
+    HEADER = struct.Struct("<4i")
+
+    def __post_init__(self):
+        self.spheres = SphereArray.from_spheres(self.spheres)
 
     def to_bytes(self) -> bytes:
-        pb = []
-        pb.extend(self.img_width.to_bytes(4, "little"))
-        pb.extend(self.img_height.to_bytes(4, "little"))
-        pb.extend(self.kill_depth.to_bytes(4, "little"))
-        pb.extend(self.split_depth.to_bytes(4, "little"))
-        pb.extend(self.camera.to_bytes())
-        for s in self.spheres:
-            pb.extend(s.to_bytes())
-        return bytes(pb)
+        return b"".join(
+            [
+                self.HEADER.pack(
+                    self.img_width, self.img_height, self.kill_depth, self.split_depth
+                ),
+                self.camera.to_bytes(),
+                self.spheres.to_bytes(),
+            ]
+        )
+
+    @classmethod
+    def from_bytes(cls, data) -> "Scene":
+        # The spheres are a view of data
+        data = memoryview(data)
+        camera_end = cls.HEADER.size + 32
+        return cls(
+            *cls.HEADER.unpack_from(data),
+            Camera.from_bytes(data[cls.HEADER.size : camera_end]),
+            SphereArray.from_bytes(data[camera_end:]),
+        )
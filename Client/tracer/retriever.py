@@ -1,42 +1,88 @@
 import time
+from concurrent.futures import ThreadPoolExecutor
 from queue import Empty
+from threading import BoundedSemaphore
 
 import grpc
 
+from tracer.metrics import DOWNLOAD_END, DOWNLOAD_START
 from tracer.objects import TracerResult
 from tracer.shared_context import SharedContext
+from tracer.trace_events import span, tile_label
 from armonik.client.results import ArmoniKResults
 
 
-def retrieve_finished_result(ctx: SharedContext, result_id: str) -> bool:
+def retrieve_finished_result(
+    ctx: SharedContext, client: ArmoniKResults, result_id: str
+) -> bool:
     try:
-        with grpc.insecure_channel(ctx.server_url) as channel:
-            result = TracerResult(
-                ArmoniKResults(channel).download_result_data(result_id, ctx.session_id)
-            )
-            if not result.isFinal:
-                ctx.to_watch_queue.put(result.nextResultId)
-            ctx.to_display_queue.put(result)
-            ctx.finalised_queue.put((result.coord_x, result.coord_y, result.isFinal))
-            return True
+        if ctx.metrics is not None:
+            ctx.metrics.record(DOWNLOAD_START, result_id)
+        with span(ctx.trace, "download", "retriever", result_id=result_id):
+            data = client.download_result_data(result_id, ctx.session_id)
+        if ctx.metrics is not None:
+            ctx.metrics.record(DOWNLOAD_END, result_id)
+        downloaded(ctx, result_id, data)
+        return True
     except Exception as e:
         print(f"Exception while retrieving results : {e}")
     return False
 
 
-def start_retriever(*ctx):
+def downloaded(ctx: SharedContext, result_id: str, data: bytes) -> None:
+    result = TracerResult(data)
+    tile = (result.coord_x, result.coord_y, result.task_width, result.task_height)
+    if ctx.cache is not None:
+        with span(ctx.trace, "cache_store", "retriever", tile=tile_label(tile)):
+            ctx.cache.store(result)
+    if not result.isFinal:
+        ctx.watch(result.nextResultId, tile)
+    with span(
+        ctx.trace,
+        "decode",
+        "retriever",
+        result_id=result_id,
+        tile=tile_label(tile),
+        samples=result.n_samples_per_pixel,
+    ):
+        ctx.publish(ctx.framebuffer.write(result), result_id)
+
+
+def download(
+    ctx: SharedContext,
+    client: ArmoniKResults,
+    result_id: str,
+    slots: BoundedSemaphore,
+) -> None:
+    try:
+        if not retrieve_finished_result(ctx, client, result_id):
+            time.sleep(0.5)
+            ctx.to_retrieve_queue.put(result_id)
+    finally:
+        ctx.to_retrieve_queue.task_done()
+        slots.release()
+
+
+def start_retriever(concurrency: int, *ctx):
     print("Started retrieving")
     ctx = SharedContext(*ctx)
-    try:
-        while not ctx.stop_retrieving_flag:
-            try:
-                result_id = ctx.to_retrieve_queue.get(timeout=1.0)
-                if not retrieve_finished_result(ctx, result_id):
-                    ctx.to_retrieve_queue.put(result_id)
-                    time.sleep(0.5)
-                ctx.to_retrieve_queue.task_done()
-            except Empty:
-                pass
-    except KeyboardInterrupt:
-        pass
+    # One channel for the whole run, downloads are multiplexed over it
+    with grpc.insecure_channel(ctx.server_url) as channel, ThreadPoolExecutor(
+        concurrency
+    ) as executor:
+        client = ArmoniKResults(channel)
+        slots = BoundedSemaphore(concurrency)
+        try:
+            while not ctx.stop_retrieving_flag:
+                if not slots.acquire(timeout=1.0):
+                    continue
+                try:
+                    result_id = ctx.to_retrieve_queue.get(timeout=1.0)
+                except Empty:
+                    slots.release()
+                    continue
+                executor.submit(download, ctx, client, result_id, slots)
+        except KeyboardInterrupt:
+            pass
+        executor.shutdown(wait=True, cancel_futures=True)
     print("Retriever Exited")
@@ -0,0 +1,123 @@
+import argparse
+import json
+import os
+import struct
+from typing import Optional, Tuple
+
+import numpy as np
+
+from tracer.generators import generate
+from tracer.objects import SPHERE_DTYPE, Camera, Reflection, Scene, Sphere, SphereArray
+from tracer.scene import camera as default_camera, get_scene
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+# Binary scene file: header, camera record and sphere records, the last two laid out
+# as in the scene sent to the workers so that the file can be uploaded as it is
+MAGIC = b"PISC"
+VERSION = 1
+HEADER = struct.Struct("<4sIII")
+CAMERA_SIZE = 32
+SPHERES_OFFSET = HEADER.size + CAMERA_SIZE
+# Specs that can only be meant as files, never taken for a generator
+SCENE_FILE_SUFFIXES = (".json", ".toml", ".pisc")
+
+
+def save_scene_file(path: str, camera: Camera, spheres: SphereArray) -> None:
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(spheres), 0))
+        f.write(camera.to_bytes())
+        f.write(spheres.to_bytes())
+
+
+def load_scene_file(path: str) -> Tuple[Camera, SphereArray]:
+    # The spheres stay in the memory map, nothing is copied before the upload
+    data = np.memmap(path, np.uint8, "r")
+    if len(data) < SPHERES_OFFSET:
+        raise ValueError(f"{path} is not a scene file")
+    magic, version, n_spheres, _ = HEADER.unpack(bytes(data[: HEADER.size]))
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a scene file")
+    if version != VERSION:
+        raise ValueError(f"Unsupported scene file version {version} in {path}")
+    end = SPHERES_OFFSET + n_spheres * SPHERE_DTYPE.itemsize
+    if len(data) < end:
+        raise ValueError(f"{path} is truncated")
+    return Camera.from_bytes(
+        data[HEADER.size : SPHERES_OFFSET]
+    ), SphereArray.from_bytes(data[SPHERES_OFFSET:end])
+
+
+def parse_sphere(d: dict) -> Sphere:
+    reflection = d.get("reflection", Reflection.DIFF)
+    if isinstance(reflection, str):
+        reflection = getattr(Reflection, reflection.upper())
+    return Sphere(
+        d["radius"],
+        d["position"],
+        d.get("emission", [0.0, 0.0, 0.0]),
+        d.get("color", [0.0, 0.0, 0.0]),
+        reflection,
+        d.get("max_reflectivity", -1.0),
+    )
+
+
+def parse_description(d: dict) -> Tuple[Camera, SphereArray]:
+    # {"camera": {...Camera fields}, "spheres": [{...Sphere fields}],
+    #  "generators": ["random_field:count=100,seed=1"]}
+    camera = Camera(**d["camera"]) if "camera" in d else default_camera
+    parts = [SphereArray.from_spheres([parse_sphere(s) for s in d.get("spheres", [])])]
+    parts.extend(generate(spec) for spec in d.get("generators", []))
+    return camera, SphereArray.concatenate(parts)
+
+
+def load_scene_description(path: str) -> Tuple[Camera, SphereArray]:
+    if path.endswith(".toml"):
+        if tomllib is None:
+            raise ValueError("TOML scenes need Python 3.11 or later")
+        with open(path, "rb") as f:
+            return parse_description(tomllib.load(f))
+    with open(path) as f:
+        return parse_description(json.load(f))
+
+
+def load_scene(
+    spec: Optional[str],
+    img_width: int,
+    img_height: int,
+    kill_depth: int,
+    split_depth: int,
+) -> Scene:
+    # spec is a scene file (.json, .toml or binary), a generator like
+    # random_field:count=1000,seed=1, or None for the default scene
+    if spec is None:
+        return get_scene(img_width, img_height, kill_depth, split_depth)
+    if os.path.exists(spec):
+        if spec.endswith((".json", ".toml")):
+            camera, spheres = load_scene_description(spec)
+        else:
+            camera, spheres = load_scene_file(spec)
+    elif spec.endswith(SCENE_FILE_SUFFIXES) or os.sep in spec or "/" in spec:
+        raise FileNotFoundError(f"Scene file {spec} not found")
+    else:
+        camera, spheres = default_camera, generate(spec)
+    return Scene(img_width, img_height, kill_depth, split_depth, camera, spheres)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes a binary PiTracer scene file")
+    parser.add_argument(
+        "scene", help="scene description (.json, .toml) or generator to convert"
+    )
+    parser.add_argument("output", help="scene file to write")
+    args = parser.parse_args()
+    scene = load_scene(args.scene, 0, 0, 0, 0)
+    save_scene_file(args.output, scene.camera, scene.spheres)
+    print(f"{len(scene.spheres)} spheres written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
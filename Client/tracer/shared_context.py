@@ -1,7 +1,11 @@
+import logging
+import pickle
 from dataclasses import dataclass
-from multiprocessing import JoinableQueue, Value
+from multiprocessing import Condition, JoinableQueue, RawArray, RawValue, Value
 from typing import Any, Callable, Optional
 
+from tracer.metrics import DECODED, SUBMITTED
+
 
 def default_cancellation(fut: Any):
     getattr(fut, "cancel", lambda: None)()
@@ -22,6 +26,7 @@ class Token:
 @dataclass
 class Flag:
     value: Value
+    changed: Optional[Condition] = None
 
     def __bool__(self):
         return self.is_set()
@@ -30,22 +35,119 @@ class Flag:
         return self.value.value != 0
 
     def set(self):
-        self.value.value = 1
+        self.update(1)
 
     def reset(self):
-        self.value.value = 0
+        self.update(0)
+
+    def update(self, value: int):
+        if self.changed is None:
+            self.value.value = value
+            return
+        with self.changed:
+            self.value.value = value
+            self.changed.notify_all()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        # Until the flag is set, instead of polling it
+        if self.changed is None or self.is_set():
+            return self.is_set()
+        with self.changed:
+            return self.changed.wait_for(self.is_set, timeout)
+
+
+class SharedBytes:
+    # Value serialized in a fixed size shared buffer. Writers take the lock, readers
+    # don't: the version is odd while a write is in progress and a copy is only kept
+    # if the version didn't change during it. The decoded value is kept per process
+    # until the version changes, so reading it is usually two memory reads
+    def __init__(
+        self,
+        size: int,
+        changed: Condition,
+        encode: Callable[[Any], bytes] = pickle.dumps,
+        decode: Callable[[bytes], Any] = pickle.loads,
+        value: Any = None,
+    ):
+        self.data = RawArray("c", size)
+        self.length = RawValue("i", 0)
+        self.version = RawValue("l", 0)
+        self.changed = changed
+        self.encode = encode
+        self.decode = decode
+        self.cached_version = -1
+        self.cached = None
+        self.set(value)
+
+    def get(self) -> Any:
+        while True:
+            version = self.version.value
+            if version == self.cached_version:
+                return self.cached
+            if version % 2:
+                continue
+            raw = self.data.raw[: self.length.value]
+            if self.version.value == version:
+                self.cached = self.decode(raw)
+                self.cached_version = version
+                return self.cached
+
+    def set(self, value: Any) -> None:
+        raw = self.encode(value)
+        if len(raw) > len(self.data):
+            raise ValueError(
+                f"Value of {len(raw)} bytes doesn't fit in {len(self.data)} bytes"
+            )
+        with self.changed:
+            self.version.value += 1
+            self.data[: len(raw)] = raw
+            self.length.value = len(raw)
+            self.version.value += 1
+            self.changed.notify_all()
+
+
+def encode_str(value: str) -> bytes:
+    return value.encode("utf-8")
+
+
+def decode_str(raw: bytes) -> str:
+    return raw.decode("utf-8")
+
+
+class ControlBlock:
+    # Parameters and flags read by every process in their loops, kept in shared
+    # memory rather than behind a manager process so that reading them doesn't
+    # cost a round trip. Writes notify the processes waiting on changed
+    def __init__(self, server_url: str = "", logging_level: int = logging.INFO):
+        self.changed = Condition()
+        self.server_url = SharedBytes(
+            1024, self.changed, encode_str, decode_str, server_url
+        )
+        self.session_id = SharedBytes(256, self.changed, encode_str, decode_str, "")
+        # TaskOptions, pickled
+        self.task_options = SharedBytes(16384, self.changed)
+        self.logging_level = RawValue("i", logging_level)
+        self.stop_watching = Flag(RawValue("i", 0), self.changed)
+        self.stop_retrieving = Flag(RawValue("i", 0), self.changed)
+        self.stop_display = Flag(RawValue("i", 0), self.changed)
+        self.reset_display = Flag(RawValue("i", 0), self.changed)
 
 
 class SharedContext:
     def __init__(
         self,
-        params,
+        control: ControlBlock,
         to_watch_queue: Optional[JoinableQueue] = None,
         to_retrieve_queue: Optional[JoinableQueue] = None,
         to_display_queue: Optional[JoinableQueue] = None,
         finalised_queue: Optional[JoinableQueue] = None,
+        framebuffer=None,
+        journal=None,
+        cache=None,
+        metrics=None,
+        trace=None,
     ):
-        self.params = params
+        self.control = control
         self.to_watch_queue = (
             to_watch_queue if to_watch_queue is not None else JoinableQueue()
         )
@@ -58,59 +160,96 @@ class SharedContext:
         self.finalised_queue = (
             finalised_queue if finalised_queue is not None else JoinableQueue()
         )
+        self.framebuffer = framebuffer
+        self.journal = journal
+        self.cache = cache
+        self.metrics = metrics
+        self.trace = trace
+
+    @property
+    def process_args(self) -> tuple:
+        return (
+            self.control,
+            self.to_watch_queue,
+            self.to_retrieve_queue,
+            self.to_display_queue,
+            self.finalised_queue,
+            self.framebuffer,
+            self.journal,
+            self.cache,
+            self.metrics,
+            self.trace,
+        )
+
+    def watch(self, result_id: str, tile: tuple) -> None:
+        if self.journal is not None:
+            self.journal.watched(result_id, tile)
+        if self.metrics is not None:
+            self.metrics.record(SUBMITTED, result_id, tile)
+        self.to_watch_queue.put(result_id)
+
+    def publish(self, update, result_id: Optional[str] = None) -> None:
+        # update is already in the framebuffer
+        update.result_id = result_id
+        if self.journal is not None:
+            self.journal.received(result_id, update)
+        if self.metrics is not None:
+            self.metrics.record(DECODED, result_id)
+        self.to_display_queue.put(update)
+        self.finalised_queue.put(update)
 
     @property
     def server_url(self) -> str:
-        return self.params[0]
+        return self.control.server_url.get()
 
     @property
     def session_id(self) -> str:
-        return self.params[1]
+        return self.control.session_id.get()
+
+    @session_id.setter
+    def session_id(self, value):
+        self.control.session_id.set(value)
 
     @property
     def task_options(self):
-        return self.params[2]
+        return self.control.task_options.get()
 
     @task_options.setter
     def task_options(self, value):
-        self.params[2] = value
+        self.control.task_options.set(value)
 
     @property
     def logging_level(self):
-        return self.params[3]
+        return self.control.logging_level.value
 
     @property
-    def stop_watching_flag(self):
-        return self.params[4]
+    def stop_watching_flag(self) -> Flag:
+        return self.control.stop_watching
 
-    @property
-    def stop_retrieving_flag(self):
-        return self.params[5]
+    @stop_watching_flag.setter
+    def stop_watching_flag(self, value):
+        self.control.stop_watching.update(int(bool(value)))
 
     @property
-    def stop_display_flag(self):
-        return self.params[6]
+    def stop_retrieving_flag(self) -> Flag:
+        return self.control.stop_retrieving
 
-    @property
-    def reset_display_flag(self):
-        return self.params[7]
+    @stop_retrieving_flag.setter
+    def stop_retrieving_flag(self, value):
+        self.control.stop_retrieving.update(int(bool(value)))
 
-    @reset_display_flag.setter
-    def reset_display_flag(self, value):
-        self.params[7] = value
+    @property
+    def stop_display_flag(self) -> Flag:
+        return self.control.stop_display
 
     @stop_display_flag.setter
     def stop_display_flag(self, value):
-        self.params[6] = value
-
-    @stop_retrieving_flag.setter
-    def stop_retrieving_flag(self, value):
-        self.params[5] = value
+        self.control.stop_display.update(int(bool(value)))
 
-    @stop_watching_flag.setter
-    def stop_watching_flag(self, value):
-        self.params[4] = value
+    @property
+    def reset_display_flag(self) -> Flag:
+        return self.control.reset_display
 
-    @session_id.setter
-    def session_id(self, value):
-        self.params[1] = value
+    @reset_display_flag.setter
+    def reset_display_flag(self, value):
+        self.control.reset_display.update(int(bool(value)))
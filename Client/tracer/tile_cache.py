@@ -0,0 +1,114 @@
+import hashlib
+import os
+import struct
+import threading
+from typing import List, Optional, Tuple
+
+from tracer.objects import Payload, Scene, TracerResult
+
+# Stores between two checks of the actual size of the cache
+EVICTION_CHECK_INTERVAL = 64
+
+
+class TileCache:
+    # Results of the tiles on disk, addressed by the hash of what produced them: the
+    # scene and the payload, plus the error threshold that decides whether the result
+    # is final. A tile has a single file holding its most refined result.
+    # The modification time of the files is the LRU order, it is refreshed on each hit,
+    # and the oldest files are removed once the cache grows past max_bytes.
+    # There is no index, any process of the client can read and write the cache
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int,
+        scene: Scene,
+        samples: int,
+        error_threshold: float,
+    ):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        # Only the digest is kept, the context holding the cache is sent to every
+        # process
+        self.scene_hash = hashlib.sha256(scene.to_bytes()).digest()
+        self.samples = samples
+        self.error_threshold = error_threshold
+        self.stores = 0
+
+    def key(self, payload: Payload) -> str:
+        h = hashlib.sha256(self.scene_hash)
+        h.update(payload.to_bytes())
+        h.update(struct.pack("<f", self.error_threshold))
+        return h.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.bin")
+
+    def payload(self, result: TracerResult) -> Payload:
+        return Payload(
+            result.coord_x,
+            result.coord_y,
+            result.task_width,
+            result.task_height,
+            self.samples,
+        )
+
+    def lookup(self, payload: Payload) -> Optional[TracerResult]:
+        path = self.path(self.key(payload))
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return TracerResult(data)
+
+    def stored_samples(self, path: str) -> int:
+        try:
+            with open(path, "rb") as f:
+                header = f.read(TracerResult.HEADER.size)
+        except FileNotFoundError:
+            return 0
+        if len(header) < TracerResult.HEADER.size:
+            return 0
+        return TracerResult.HEADER.unpack(header)[4]
+
+    def store(self, result: TracerResult) -> None:
+        path = self.path(self.key(self.payload(result)))
+        # Passes of a tile can come back out of order, a less refined one doesn't
+        # replace what is there
+        if self.stored_samples(path) >= result.n_samples_per_pixel:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(result.raw)
+        os.replace(tmp, path)
+        self.stores += 1
+        if self.stores % EVICTION_CHECK_INTERVAL == 0:
+            self.evict()
+
+    def entries(self) -> List[Tuple[float, int, str]]:
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".bin"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self) -> None:
+        entries = self.entries()
+        size = sum(e[1] for e in entries)
+        for _, file_size, path in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
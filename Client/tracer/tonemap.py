@@ -0,0 +1,30 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+TONE_MAPPING_OPERATORS = ("clamp", "reinhard")
+
+
+@dataclass
+class ToneMapper:
+    # Linear RGB samples to the 8-bit BGR pixels the worker would have produced, with
+    # the default values it matches local_engine.to_pixels
+    exposure: float = 0.0
+    operator: str = "clamp"
+    gamma: float = 2.2
+
+    def __call__(self, samples: np.ndarray) -> np.ndarray:
+        x = samples[..., ::-1] * np.float32(2.0**self.exposure)
+        if self.operator == "reinhard":
+            x /= 1 + x
+        np.clip(x, 0.0, 1.0, out=x)
+        np.power(x, np.float32(1 / self.gamma), out=x)
+        x *= 255
+        x += 0.5
+        return x.astype(np.uint8)
+
+    def next_operator(self) -> None:
+        index = TONE_MAPPING_OPERATORS.index(self.operator)
+        self.operator = TONE_MAPPING_OPERATORS[
+            (index + 1) % len(TONE_MAPPING_OPERATORS)
+        ]
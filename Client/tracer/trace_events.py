@@ -0,0 +1,129 @@
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from multiprocessing import current_process
+from typing import Optional, Set
+
+
+class TraceRecorder:
+    # Chrome trace events, each process appends them to a file of its own in directory
+    # with one write per event, like the journal, so that nothing is lost when a
+    # process is killed. merge_traces gathers the files into a single trace that
+    # Perfetto or chrome://tracing can load. Timestamps are taken from the wall clock,
+    # the one clock every process agrees on
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.fd: Optional[int] = None
+        self.pid: Optional[int] = None
+        self.named_threads: Set[int] = set()
+        self.lock = threading.Lock()
+
+    def __reduce__(self):
+        return TraceRecorder, (self.directory,)
+
+    def open(self) -> None:
+        # Also reached in the children forked with the recorder of their parent
+        self.pid = os.getpid()
+        self.fd = os.open(
+            os.path.join(self.directory, f"{self.pid}.jsonl"),
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+            0o644,
+        )
+        self.named_threads = set()
+        self.write(
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": self.pid,
+                "args": {"name": current_process().name},
+            }
+        )
+
+    def write(self, event: dict) -> None:
+        os.write(self.fd, (json.dumps(event) + "\n").encode("utf-8"))
+
+    def event(self, event: dict) -> None:
+        with self.lock:
+            if self.fd is None or self.pid != os.getpid():
+                self.open()
+            tid = threading.get_native_id()
+            if tid not in self.named_threads:
+                self.named_threads.add(tid)
+                self.write(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": self.pid,
+                        "tid": tid,
+                        "args": {"name": threading.current_thread().name},
+                    }
+                )
+        event["pid"] = self.pid
+        event["tid"] = tid
+        self.write(event)
+
+    @contextmanager
+    def span(self, name: str, category: str, **args):
+        start = time.time_ns()
+        try:
+            yield
+        finally:
+            self.event(
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": start / 1000,
+                    "dur": (time.time_ns() - start) / 1000,
+                    "args": args,
+                }
+            )
+
+    def instant(self, name: str, category: str, **args) -> None:
+        self.event(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "i",
+                "s": "t",
+                "ts": time.time_ns() / 1000,
+                "args": args,
+            }
+        )
+
+
+def span(recorder: Optional[TraceRecorder], name: str, category: str, **args):
+    if recorder is None:
+        return nullcontext()
+    return recorder.span(name, category, **args)
+
+
+def instant(
+    recorder: Optional[TraceRecorder], name: str, category: str, **args
+) -> None:
+    if recorder is not None:
+        recorder.instant(name, category, **args)
+
+
+def tile_label(tile: tuple) -> str:
+    # Same naming as the results of the tasks, with the size of the tile
+    return "_".join(str(v) for v in tile[:4])
+
+
+def merge_traces(directory: str, path: str) -> None:
+    events = []
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name)) as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Last line of a process killed while writing it
+                    continue
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    shutil.rmtree(directory, ignore_errors=True)
+    print(f"Trace with {len(events)} events written to {path}")
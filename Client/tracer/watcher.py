@@ -1,22 +1,29 @@
+from datetime import datetime, timedelta
 from multiprocessing import Queue
 from queue import Empty
 from threading import Thread
 import time
-from typing import cast
+from typing import Iterator, Optional, cast
 
+from google.protobuf.timestamp_pb2 import Timestamp
 from grpc import insecure_channel
 from armonik.client import ArmoniKResults
-from armonik.common.filter import DurationFilter
+from armonik.client.results import ResultFieldFilter
+from armonik.common import Direction, Result
+from armonik.common.filter import DateFilter, Filter
 from armonik.protogen.common.results_fields_pb2 import (
     ResultField,
     ResultRawField,
     RESULT_RAW_ENUM_FIELD_SESSION_ID,
     RESULT_RAW_ENUM_FIELD_CREATED_AT,
+    RESULT_RAW_ENUM_FIELD_COMPLETED_AT,
     RESULT_RAW_ENUM_FIELD_RESULT_ID,
 )
 from armonik.protogen.common.results_filters_pb2 import Filters, FiltersAnd, FilterField
 
+from tracer.metrics import COMPLETED
 from tracer.shared_context import SharedContext, Token
+from tracer.trace_events import instant, span
 from armonik.common import ResultStatus, StringFilter
 from armonik.protogen.client.events_service_pb2_grpc import EventsStub
 from armonik.protogen.common.events_common_pb2 import (
@@ -40,7 +47,7 @@ RESULT_ID_FILTER = StringFilter(
     FiltersAnd,
     FilterField,
 )
-RESULT_CREATED_AT_FILTER = DurationFilter(
+RESULT_CREATED_AT_FILTER = DateFilter(
     ResultField(
         result_raw_field=ResultRawField(field=RESULT_RAW_ENUM_FIELD_CREATED_AT)
     ),
@@ -48,14 +55,110 @@ RESULT_CREATED_AT_FILTER = DurationFilter(
     FiltersAnd,
     FilterField,
 )
+RESULT_COMPLETED_AT_FILTER = DateFilter(
+    ResultField(
+        result_raw_field=ResultRawField(field=RESULT_RAW_ENUM_FIELD_COMPLETED_AT)
+    ),
+    Filters,
+    FiltersAnd,
+    FilterField,
+)
+RESULT_STATUS_FILTER = ResultFieldFilter.STATUS
+
+FINISHED_STATUSES = [ResultStatus.COMPLETED, ResultStatus.ABORTED]
+# Completion timestamps are not guaranteed to become visible in order
+WATERMARK_OVERLAP = timedelta(seconds=5)
+POLL_MIN_INTERVAL = 0.25
+POLL_MAX_INTERVAL = 3.0
+
+
+def finished_results_filter(session_id: str, since: Optional[datetime]) -> Filter:
+    session = cast(StringFilter, RESULT_SESSION_FILTER == session_id)
+    completed = session & (RESULT_STATUS_FILTER == ResultStatus.COMPLETED)
+    if since is not None:
+        timestamp = Timestamp()
+        timestamp.FromDatetime(since - WATERMARK_OVERLAP)
+        completed = completed & (RESULT_COMPLETED_AT_FILTER >= timestamp)
+    # Aborted results may not carry a completion date, they are always listed
+    return completed | (session & (RESULT_STATUS_FILTER == ResultStatus.ABORTED))
+
+
+def list_pending_results(
+    client: ArmoniKResults, session_id: str, batch_size: int = 100
+) -> Iterator[Result]:
+    # Outputs of the tasks that didn't complete, queued follow-up tasks included
+    result_filter = (RESULT_SESSION_FILTER == session_id) & (
+        RESULT_STATUS_FILTER == ResultStatus.CREATED
+    )
+    page = 0
+    total = 1
+    while total > page * batch_size:
+        total, results = client.list_results(result_filter, page, batch_size)
+        yield from results
+        page += 1
+
+
+def list_finished_results(
+    client: ArmoniKResults,
+    session_id: str,
+    since: Optional[datetime],
+    batch_size: int = 100,
+) -> Iterator[Result]:
+    result_filter = finished_results_filter(session_id, since)
+    page = 0
+    total = 1
+    while total > page * batch_size:
+        total, results = client.list_results(
+            result_filter,
+            page,
+            batch_size,
+            RESULT_COMPLETED_AT_FILTER,
+            Direction.ASC,
+        )
+        yield from results
+        page += 1
+
+
+def poll_interval(tasks: dict) -> float:
+    outstanding = sum(1 for s in list(tasks.values()) if s not in FINISHED_STATUSES)
+    if outstanding == 0:
+        return POLL_MAX_INTERVAL
+    return max(POLL_MIN_INTERVAL, POLL_MAX_INTERVAL / (1 + outstanding / 32))
+
+
+class FinishedResultsReporter:
+    # Forwards each finished result once, whichever of the event stream or a listing
+    # saw it first, and keeps the completion watermark of the listings
+    def __init__(self, out_queue: Queue, tasks: dict):
+        self.out_queue = out_queue
+        self.tasks = tasks
+        self.reported = set()
+        self.watermark: Optional[datetime] = None
+
+    def report(self, result_id: str, status: ResultStatus) -> None:
+        if status not in FINISHED_STATUSES or result_id in self.reported:
+            return
+        if self.tasks.get(result_id) in FINISHED_STATUSES:
+            return
+        self.reported.add(result_id)
+        self.out_queue.put((result_id, status))
+
+    def listed(self, r: Result) -> None:
+        if r.status == ResultStatus.COMPLETED and r.completed_at:
+            self.watermark = max(self.watermark or r.completed_at, r.completed_at)
+        self.report(r.result_id, r.status)
+
+    def backfill(self, client: ArmoniKResults, session_id: str) -> None:
+        for r in list_finished_results(client, session_id, self.watermark):
+            self.listed(r)
 
 
 def watch_finished_results(
-    ctx: SharedContext, out_queue: Queue, cancellation_token: Token
+    ctx: SharedContext, out_queue: Queue, cancellation_token: Token, tasks: dict
 ):
+    reporter = FinishedResultsReporter(out_queue, tasks)
     while not ctx.stop_watching_flag:
         try:
-
             with insecure_channel(ctx.server_url) as channel:
                 subscription = EventsStub(channel).GetEvents(
                     EventSubscriptionRequest(
@@ -64,51 +167,55 @@ def watch_finished_results(
                     )
                 )
                 cancellation_token.fut = subscription
+                # The subscription is already issued: whatever completed before it, or
+                # while we were disconnected, is caught up by a one-shot listing
+                with span(ctx.trace, "backfill", "watcher"):
+                    reporter.backfill(ArmoniKResults(channel), ctx.session_id)
                 for e in subscription:
-                    result_id: str = e.result_status_update.result_id
-                    result_status: ResultStatus = e.result_status_update.status
-                    if result_status in [ResultStatus.COMPLETED, ResultStatus.ABORTED]:
-                        out_queue.put((result_id, result_status))
+                    instant(
+                        ctx.trace,
+                        "event",
+                        "watcher",
+                        result_id=e.result_status_update.result_id,
+                        status=e.result_status_update.status,
+                    )
+                    reporter.report(
+                        e.result_status_update.result_id,
+                        e.result_status_update.status,
+                    )
         except Exception as e:
             disp = "\n".join(format_exception(type(e), e, e.__traceback__))
             if "Locally cancelled by application!" not in disp:
                 print(f"Exception while watching results : {e}")
+                time.sleep(POLL_MIN_INTERVAL)
 
 
 def poll_results(
     ctx: SharedContext, out_queue: Queue, cancellation_token: Token, tasks: dict
 ):
     _ = cancellation_token
-    batch_size = 100
+    reporter = FinishedResultsReporter(out_queue, tasks)
     while not ctx.stop_watching_flag:
         try:
             with insecure_channel(ctx.server_url) as channel:
                 client = ArmoniKResults(channel)
-                i = 0
-                n = 1
-                while n > i * batch_size and not ctx.stop_watching_flag:
-                    n, results = client.list_results(
-                        cast(StringFilter, RESULT_SESSION_FILTER == ctx.session_id),
-                        i,
-                        batch_size,
-                        RESULT_ID_FILTER,
-                    )
-                    for r in results:
-                        if r.status in [
-                            ResultStatus.COMPLETED,
-                            ResultStatus.ABORTED,
-                        ] and tasks.get(r.result_id) not in [
-                            ResultStatus.COMPLETED,
-                            ResultStatus.ABORTED,
-                        ]:
-                            out_queue.put((r.result_id, r.status))
-                    i += 1
+                while not ctx.stop_watching_flag:
+                    with span(ctx.trace, "backfill", "watcher"):
+                        reporter.backfill(client, ctx.session_id)
+                    time.sleep(poll_interval(tasks))
         except Exception as e:
             disp = "\n".join(format_exception(type(e), e, e.__traceback__))
             if "Locally cancelled by application!" not in disp:
                 print(f"Exception while watching results : {e}")
         if not ctx.stop_watching_flag:
-            time.sleep(3.0)
+            time.sleep(POLL_MAX_INTERVAL)
+
+
+def completed(ctx: SharedContext, result_id: str) -> None:
+    if ctx.metrics is not None:
+        ctx.metrics.record(COMPLETED, result_id)
+    instant(ctx.trace, "completed", "watcher", result_id=result_id)
+    ctx.to_retrieve_queue.put(result_id)
 
 
 def start_watcher(use_polling: bool, *ctx):
@@ -120,7 +227,7 @@ def start_watcher(use_polling: bool, *ctx):
     thread = (
         Thread(target=poll_results, args=(ctx, q, token, followed_tasks))
         if use_polling
-        else Thread(target=watch_finished_results, args=(ctx, q, token))
+        else Thread(target=watch_finished_results, args=(ctx, q, token, followed_tasks))
     )
     thread.start()
     try:
@@ -132,7 +239,7 @@ def start_watcher(use_polling: bool, *ctx):
                         result_id, ResultStatus.UNSPECIFIED
                     )
                     if status == ResultStatus.COMPLETED:
-                        ctx.to_retrieve_queue.put(result_id)
+                        completed(ctx, result_id)
                     ctx.to_watch_queue.task_done()
             except Empty:
                 pass
@@ -148,7 +255,7 @@ def start_watcher(use_polling: bool, *ctx):
                         ResultStatus.COMPLETED,
                         None,
                     ]:
-                        ctx.to_retrieve_queue.put(result_id)
+                        completed(ctx, result_id)
             except Empty:
                 pass
     except KeyboardInterrupt:
@@ -91,7 +91,13 @@ public class SampleComputerService : WorkerStreamWrapper
         threshold = 10f;
       }
 
-      if (previousResult.HasValue)
+      taskHandler.TaskOptions.Options.TryGetValue("clientRefinement", out var clientRefinement);
+      if (bool.TryParse(clientRefinement, out var refinedByClient) && refinedByClient)
+      {
+        logger_.LogInformation("Final result as refinement is driven by the client");
+        result.IsFinal = true;
+      }
+      else if (previousResult.HasValue)
       {
         var errorMetric = new MSE().GetMeanMetric(result.RawSamples, previousResult.Value.RawSamples);
         if (errorMetric > threshold)